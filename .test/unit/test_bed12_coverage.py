@@ -0,0 +1,48 @@
+import os
+import sys
+import numpy as np
+import pytest
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(__file__), "..", "..", "workflow", "scripts")
+)
+from bed12_coverage import add_blocks, coverage_runs
+
+
+def brute_force_runs(cov):
+    runs = []
+    for pos, depth in enumerate(cov.tolist()):
+        if runs and runs[-1][1] == pos and runs[-1][2] == depth:
+            runs[-1][1] = pos + 1
+        else:
+            runs.append([pos, pos + 1, depth])
+    return [tuple(run) for run in runs if run[2] != 0]
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 7, 64, 1000])
+def test_coverage_runs_across_chunks(chunk_size):
+    rng = np.random.default_rng(0)
+    length = 500
+    starts = rng.integers(0, length, 40)
+    ends = np.minimum(starts + rng.integers(1, 80, 40), length)
+    # a block at the end of the contig so a run ends at its last base
+    starts, ends = np.append(starts, length - 30), np.append(ends, length)
+    diff = np.zeros(length + 1, dtype=np.int32)
+    add_blocks(diff, starts, ends)
+    runs = [
+        run
+        for chunk in coverage_runs(diff, chunk_size=chunk_size)
+        for run in zip(*(a.tolist() for a in chunk))
+    ]
+    assert runs == brute_force_runs(np.cumsum(diff[:-1]))
+
+
+def test_coverage_runs_skips_zero_coverage():
+    diff = np.zeros(11, dtype=np.int32)
+    add_blocks(diff, np.array([2, 4]), np.array([4, 6]))
+    runs = [
+        run
+        for chunk in coverage_runs(diff, chunk_size=3)
+        for run in zip(*(a.tolist() for a in chunk))
+    ]
+    assert runs == [(2, 6, 1)]
@@ -0,0 +1,53 @@
+import os
+import sys
+import numpy as np
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(__file__), "..", "..", "workflow", "scripts")
+)
+from cpg_density import count_cpgs
+from cpg_index import find_cpgs
+
+
+def brute_force_counts(cpgs, fibers):
+    num = np.zeros(cpgs.shape[0], dtype=np.int32)
+    den = np.zeros(cpgs.shape[0], dtype=np.int32)
+    for st, en, calls in fibers:
+        for idx, pos in enumerate(cpgs.tolist()):
+            # the C or the G of the CpG is in [st, en)
+            if pos + 1 >= st and pos < en:
+                den[idx] += 1
+            num[idx] += sum(call in (pos, pos + 1) for call in calls)
+    return num, den
+
+
+def block(rows):
+    """count_cpgs input from (contig, start, end, calls) rows."""
+    return (
+        np.array([contig for contig, _st, _en, _calls in rows]),
+        np.array([st for _contig, st, _en, _calls in rows]),
+        np.array([en for _contig, _st, en, _calls in rows]),
+        np.array([len(calls) for _contig, _st, _en, calls in rows]),
+        np.array([c for _contig, _st, _en, calls in rows for c in calls]),
+    )
+
+
+def test_count_cpgs_matches_brute_force():
+    rng = np.random.default_rng(0)
+    seq = "".join(rng.choice(list("ACGT"), 400))
+    cpgs = {"chr1": find_cpgs(seq)}
+    fibers = []
+    for _ in range(30):
+        st = int(rng.integers(0, 380))
+        en = int(min(st + rng.integers(1, 120), 400))
+        # unlifted calls are -1
+        fibers.append((st, en, rng.integers(st, en, 5).tolist() + [-1]))
+    rows = [("chr1", st, en, calls) for st, en, calls in fibers]
+    # two blocks of rows, with fibers on a contig that is not in the index
+    blocks = [block(rows[:12]), block(rows[12:] + [("chrUn", 0, 50, [10])])]
+    counts = count_cpgs(blocks, cpgs)
+    assert list(counts) == ["chr1"]
+    num, den_diff = counts["chr1"]
+    expected_num, expected_den = brute_force_counts(cpgs["chr1"], fibers)
+    np.testing.assert_array_equal(num, expected_num)
+    np.testing.assert_array_equal(np.cumsum(den_diff)[:-1], expected_den)
@@ -0,0 +1,54 @@
+import os
+import sys
+import numpy as np
+import pytest
+from sklearn.mixture import GaussianMixture
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(__file__), "..", "..", "workflow", "scripts")
+)
+from gmm1d import SegmentedGMM
+
+
+def segments(seed=0):
+    rng = np.random.default_rng(seed)
+    values = []
+    for n, frac in [(200, 0.3), (80, 0.1), (500, 0.5)]:
+        n_high = int(n * frac)
+        values.append(
+            np.concatenate(
+                [rng.gamma(4, 0.15, n - n_high), rng.normal(2.5, 0.6, n_high)]
+            )
+        )
+    offsets = np.zeros(len(values) + 1, dtype=np.int64)
+    np.cumsum([v.shape[0] for v in values], out=offsets[1:])
+    return values, offsets
+
+
+@pytest.mark.parametrize("means_init", [[0.5, 2.2], None])
+def test_segmented_gmm_matches_sklearn(means_init):
+    values, offsets = segments()
+    # converge tightly so the fits do not depend on how KMeans splits the data
+    model = SegmentedGMM(means_init=means_init, tol=1e-12, max_iter=10_000)
+    model.fit(np.concatenate(values), offsets)
+    assert model.converged_.all()
+    proba = model.predict_upper_proba(np.concatenate(values), offsets)
+    for i, x in enumerate(values):
+        kwargs = {} if means_init is None else {"means_init": [[m] for m in means_init]}
+        gmm = GaussianMixture(
+            n_components=2, tol=1e-12, max_iter=10_000, random_state=0, **kwargs
+        ).fit(x.reshape(-1, 1))
+        order = np.argsort(gmm.means_.ravel())
+        np.testing.assert_allclose(
+            np.sort(model.means_[i]), gmm.means_.ravel()[order], rtol=1e-4
+        )
+        np.testing.assert_allclose(
+            model.variances_[i][np.argsort(model.means_[i])],
+            gmm.covariances_.ravel()[order],
+            rtol=1e-4,
+        )
+        np.testing.assert_allclose(
+            proba[offsets[i] : offsets[i + 1]],
+            gmm.predict_proba(x.reshape(-1, 1))[:, order[1]],
+            atol=1e-6,
+        )
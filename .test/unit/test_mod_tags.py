@@ -0,0 +1,86 @@
+import array
+import os
+import sys
+import numpy as np
+import pysam
+import pytest
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(__file__), "..", "..", "workflow", "scripts")
+)
+from mod_tags import mod_binary, mods_to_arrays
+
+M6A = mods_to_arrays([("A", 0, "a"), ("T", 1, "a")])
+
+
+def record(mm, ml, seq="AATTACGTAT", is_reverse=False):
+    rec = pysam.AlignedSegment()
+    rec.query_name = "m/1/ccs"
+    rec.query_sequence = seq
+    rec.flag = 16 if is_reverse else 4
+    rec.set_tag("MM", mm)
+    if ml is not None:
+        rec.set_tag("ML", array.array("B", ml))
+    return rec
+
+
+def random_record(rng, is_reverse):
+    """Record with random A+a, C+m, and T-a calls on the sequenced molecule,
+    stored reverse complemented when is_reverse as in an aligned bam."""
+    seq = "".join(rng.choice(list("ACGT"), 300))
+    groups, ml = [], []
+    for base, prefix in [("A", "A+a"), ("C", "C+m"), ("T", "T-a")]:
+        sites = [i for i, b in enumerate(seq) if b == base]
+        called = set(rng.choice(len(sites), len(sites) // 3, replace=False).tolist())
+        skips, skip = [], 0
+        for idx in range(len(sites)):
+            if idx in called:
+                skips.append(str(skip))
+                skip = 0
+            else:
+                skip += 1
+        groups.append(",".join([prefix] + skips) + ";")
+        ml += rng.integers(0, 256, len(skips)).tolist()
+    if is_reverse:
+        seq = seq[::-1].translate(str.maketrans("ACGT", "TGCA"))
+    return record("".join(groups), ml, seq=seq, is_reverse=is_reverse)
+
+
+@pytest.mark.parametrize("is_reverse", [False, True])
+def test_mod_binary_matches_pysam(is_reverse):
+    rng = np.random.default_rng(0)
+    for _ in range(20):
+        rec = random_record(rng, is_reverse)
+        # modified_bases is on the stored sequence, like mod_binary
+        expected = np.zeros(rec.query_length, dtype=np.uint8)
+        for (_base, _strand, code), calls in rec.modified_bases.items():
+            for pos, qual in calls:
+                if code == "a" and qual >= 100:
+                    expected[pos] = 1
+        np.testing.assert_array_equal(mod_binary(rec, M6A, min_ml=100), expected)
+
+
+def test_mod_binary_marks_calls_above_min_ml():
+    rec = record("A+a,0,2;T-a,1;", [250, 100, 250])
+    np.testing.assert_array_equal(
+        np.flatnonzero(mod_binary(rec, M6A, min_ml=200)), [0, 3]
+    )
+
+
+def test_mod_binary_without_ml_marks_every_call():
+    rec = record("A+a,0,2;T-a,1;", None)
+    np.testing.assert_array_equal(np.flatnonzero(mod_binary(rec, M6A)), [0, 3, 8])
+
+
+@pytest.mark.parametrize(
+    "mm, ml",
+    [
+        ("A+a,0,2;T-a,1;", [250, 250]),
+        ("A+a,0,2;T-a,1;", [250, 250, 250, 250, 250]),
+        ("A+a,0,2;T-a,1;", []),
+        ("A+a,;T-a,1;", [250, 250]),
+    ],
+)
+def test_mod_binary_rejects_ml_not_matching_mm(mm, ml):
+    # htslib rejects these tags, so the record has no modifications
+    assert not mod_binary(record(mm, ml), M6A).any()
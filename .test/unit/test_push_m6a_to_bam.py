@@ -0,0 +1,78 @@
+import os
+import sys
+import numpy as np
+import pytest
+from sklearn.mixture import GaussianMixture
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(__file__), "..", "..", "workflow", "scripts")
+)
+from push_m6a_to_bam import merge_molecules, predict_m6a
+
+
+def pre_trained_model():
+    rng = np.random.default_rng(0)
+    ipdRatios = np.concatenate([rng.normal(0.5, 0.1, 500), rng.normal(2.2, 0.3, 500)])
+    return GaussianMixture(n_components=2, means_init=[[0.5], [2.2]]).fit(
+        ipdRatios.reshape(-1, 1)
+    )
+
+
+def test_predict_m6a_batch_without_enough_calls():
+    molecules = [None, (np.arange(5), np.random.rand(5))]
+    calls = predict_m6a(molecules, pre_trained_model=pre_trained_model())
+    assert calls == [None, None]
+    assert predict_m6a(molecules) == [None, None]
+
+
+def test_predict_m6a_skips_short_molecules():
+    molecules = [
+        (np.arange(1, 6), np.full(5, 3.0)),
+        (np.arange(1, 31), np.concatenate([np.full(15, 0.5), np.full(15, 5.0)])),
+    ]
+    calls = predict_m6a(molecules, pre_trained_model=pre_trained_model())
+    assert calls[0] is None
+    np.testing.assert_array_equal(calls[1], np.arange(15, 30))
+
+
+class Record:
+    def __init__(self, query_name):
+        self.query_name = query_name
+
+
+class Bam:
+    def __init__(self, names):
+        self.records = [Record(name) for name in names]
+
+    def fetch(self, until_eof=False):
+        return iter(self.records)
+
+
+def test_merge_molecules_pairs_records_in_zmw_order():
+    molecules = [("m/1/ccs", "a"), ("m/2/ccs", "b"), ("m/4/ccs", "c")]
+    bam = Bam(["m/1/ccs", "m/3/ccs", "m/4/ccs"])
+    pairs = [(rec.query_name, m) for rec, m in merge_molecules(molecules, bam)]
+    assert pairs == [("m/1/ccs", "a"), ("m/3/ccs", None), ("m/4/ccs", "c")]
+
+
+def test_merge_molecules_matches_names_within_a_zmw():
+    molecules = [("m/1/ccs/fwd", "a"), ("m/1/ccs/rev", "b"), ("m/2/ccs/fwd", "c")]
+    bam = Bam(["m/1/ccs/rev", "m/1/ccs/fwd", "m/2/ccs/rev", "m/2/ccs/fwd"])
+    pairs = [(rec.query_name, m) for rec, m in merge_molecules(molecules, bam)]
+    assert pairs == [
+        ("m/1/ccs/rev", "b"),
+        ("m/1/ccs/fwd", "a"),
+        ("m/2/ccs/rev", None),
+        ("m/2/ccs/fwd", "c"),
+    ]
+
+
+@pytest.mark.parametrize(
+    "molecule_zmws, bam_zmws",
+    [([1, 3, 2], [1, 2, 3]), ([1, 2, 3], [1, 3, 2])],
+)
+def test_merge_molecules_raises_out_of_order(molecule_zmws, bam_zmws):
+    molecules = [(f"m/{zmw}/ccs", zmw) for zmw in molecule_zmws]
+    bam = Bam([f"m/{zmw}/ccs" for zmw in bam_zmws])
+    with pytest.raises(ValueError):
+        list(merge_molecules(molecules, bam))
@@ -117,13 +117,15 @@ rule bigwig:
         "benchmarks/{sm}/bigwig/{data}.tbl"
     resources:
         disk_mb=16 * 1024,
-        mem_mb=16 * 1024,
+        mem_mb=8 * 1024,
         time=240,
-    threads: 8
+    threads: 1
     priority: 100
+    params:
+        script=workflow.source_path("../scripts/bed12_coverage.py"),
     shell:
         """
-        # bedtools genomecov is slow with -split, so we do it in parallel
-        (cut -f 1 {input.fai} | parallel -n 1 -k $'grep -w "^{{}}" {input.bed} | bedtools genomecov -split -bg -g {input.fai} -i -' | sort -S 4G --parallel={threads} -k1,1 -k2,2n > {output.bed} ) 2> {log} 
+        # coverage of the bed12 blocks, as bedtools genomecov -split -bg, already sorted
+        python {params.script} {input.fai} {input.bed} {output.bed} 2> {log}
         bedGraphToBigWig {output.bed} {input.fai} {output.bw} 2>> {log}
         """
@@ -2,6 +2,9 @@
 # shared utilites for the pipeline
 #
 import os
+import re
+import json
+import hashlib
 
 
 def get_chunk(wc):
@@ -210,6 +213,14 @@ def check_for_reference():
     ), f"Missing index for the ref: {ref}.fai\nCreate an index for {ref}:\n samtools faidx {ref}"
 
 
+def get_cpg_index(wc):
+    """CpG index of the reference, keyed by the md5 of its .fai so that it is
+    shared by every sample and rebuilt when the reference changes."""
+    with open(f"{ref}.fai", "rb") as fai:
+        checksum = hashlib.md5(fai.read()).hexdigest()
+    return f"results/cpg_index/{checksum}.cpg.npz"
+
+
 def bigwig_results(bigwig):
     if bigwig:
         return expand(
@@ -220,6 +231,46 @@ def bigwig_results(bigwig):
     return []
 
 
+def profile_option(benchmark):
+    """--profile option for a python script that writes its json sidecar next
+    to the benchmark table of the rule, if profile_scripts is set."""
+
+    def option(wc):
+        if not profile_scripts:
+            return ""
+        sidecar = profile_sidecar(benchmark.format(**dict(wc.items())))
+        return f"--profile {sidecar}"
+
+    return option
+
+
+def profile_sidecar(benchmark):
+    prefix = re.sub(r"\.tbl$", "", benchmark)
+    return f"{prefix}.json"
+
+
+def summarise_profiles(files):
+    """Sum the stage timings, fibers, and bases in the json sidecars that exist
+    for a set of benchmark tables and keep the largest peak RSS."""
+    rollup = {"count": 0, "wall_seconds": 0, "stages": {}, "fibers": 0, "bases": 0}
+    rollup["peak_rss_mb"] = 0
+    for f in files:
+        sidecar = profile_sidecar(f)
+        if not os.path.exists(sidecar):
+            continue
+        profile = json.load(open(sidecar))
+        for stage, seconds in profile["stages"].items():
+            rollup["stages"][stage] = rollup["stages"].get(stage, 0) + seconds
+        for key in ["wall_seconds", "fibers", "bases"]:
+            rollup[key] += profile[key]
+        rollup["peak_rss_mb"] = max(rollup["peak_rss_mb"], profile["peak_rss_mb"])
+        rollup["count"] += 1
+    if rollup["count"] > 0:
+        rollup["fibers_per_second"] = rollup["fibers"] / rollup["wall_seconds"]
+        rollup["bases_per_second"] = rollup["bases"] / rollup["wall_seconds"]
+    return rollup
+
+
 def summarise_runtimes(inputs, sample):
     rtn = ""
     for job, files in inputs.items():
@@ -229,9 +280,27 @@ def summarise_runtimes(inputs, sample):
             hours += float(second_line[0]) / 3600
             cpu_hours += float(second_line[9]) / 3600
         rtn += f"{sample}\t{job}\t{hours:.4f}\t{cpu_hours:.4f}\t{len(files)}\n"
+        # wall hours per stage from the json sidecars of the python scripts
+        profile = summarise_profiles(files)
+        for stage, seconds in profile["stages"].items():
+            rtn += f"{sample}\t{job}:{stage}\t{seconds/3600:.4f}\tNA"
+            rtn += f"\t{profile['count']}\n"
     return rtn
 
 
+def summarise_profile_json(inputs):
+    profiles = {job: summarise_profiles(files) for job, files in inputs.items()}
+    return {job: profile for job, profile in profiles.items() if profile["count"] > 0}
+
+
+def write_benchmark_summaries(inputs, output, sample):
+    """Write the runtimes and the profile roll-up of the help_benchmark rule."""
+    with open(output.runtimes, "w") as out:
+        out.write(summarise_runtimes(inputs, sample))
+    with open(output.profile, "w") as out:
+        out.write(json.dumps(summarise_profile_json(inputs), indent=2))
+
+
 def custom_scatteritems(sm):
     n_chunks = get_number_of_chunks(sm)
     chunks_to_process = n_chunks
@@ -259,15 +328,15 @@ def train_gmm_input_bam(wc):
     return format(rules.primrose.output.bam, scatteritem=item, sm=wc.sm)
 
 
-def train_gmm_input_csv(wc):
+def train_gmm_input_npz(wc):
     n_chunks = get_number_of_chunks(wc.sm)
     item = f"1-of-{n_chunks}"
-    return format(rules.ipdSummary.output.csv, scatteritem=item, sm=wc.sm)
+    return format(rules.ipd_cache.output.npz, scatteritem=item, sm=wc.sm)
 
 
 def help_benchmark_input(wc):
     sm = wc.sm
-    return {
+    inputs = {
         "align": custom_gather(rules.align.benchmark, sm=sm),
         "bigbed": custom_gather(rules.bigbed.benchmark, data=output_types, sm=sm),
         "fiber_table": custom_gather(rules.fiber_table.benchmark, sm=sm),
@@ -277,3 +346,6 @@ def help_benchmark_input(wc):
         "primrose": custom_gather(rules.primrose.benchmark, sm=sm),
         "nucleosome": custom_gather(rules.nucleosome.benchmark, sm=sm),
     }
+    if use_ipdsummary:
+        inputs["gmm"] = custom_gather(rules.gmm.benchmark, sm=sm)
+    return inputs
@@ -1,8 +1,33 @@
+rule cpg_index:
+    input:
+        ref=ref,
+        fai=f"{ref}.fai",
+    output:
+        npz="results/cpg_index/{checksum}.cpg.npz",
+    conda:
+        env
+    log:
+        "logs/cpg_index/{checksum}.log",
+    resources:
+        time=60,
+    params:
+        script=workflow.source_path("../scripts/cpg_index.py"),
+    benchmark:
+        "benchmarks/cpg_index/{checksum}.tbl"
+    threads: 1
+    priority: 20
+    shell:
+        """
+        python {params.script} {input.ref} {output.npz} 2> {log}
+        """
+
+
 rule cpg_dinucleotide:
     input:
         ref=ref,
+        index=get_cpg_index,
     output:
-        bed="results/{sm}/density/{sm}.CpG.reference.bed",
+        bed="results/{sm}/density/{sm}.CpG.reference.bed.gz",
     conda:
         env,
     log:
@@ -10,22 +35,23 @@ rule cpg_dinucleotide:
     resources:
         time=60,
     params:
-        script=workflow.source_path("../scripts/density/cpg-reference.sh"),
+        script=workflow.source_path("../scripts/cpg_index.py"),
     benchmark:
         "benchmarks/{sm}/density/CpG-reference.tbl",
-    threads: 4
+    threads: 1
     priority: 20
     shell:
         """
-        sh {params.script} {input.ref} {output.bed} 2> {log}
+        python {params.script} --bed {output.bed} {input.ref} {input.index} 2> {log}
         """
 
 rule density_methylation:
     input:
+        fai=f"{ref}.fai",
+        index=get_cpg_index,
         tbl=rules.joint_fiber_table.output.tbl,
-        cpg_ref=rules.cpg_dinucleotide.output.bed,
     output:
-        bed="results/{sm}/density/{sm}.CpG.bed",
+        bed="results/{sm}/density/{sm}.CpG.bed.gz",
     conda:
         env,
     log:
@@ -33,14 +59,15 @@ rule density_methylation:
     resources:
         time=60,
     params:
-        script=workflow.source_path("../scripts/density/cpg-methylation-proportion.sh"),
+        script=workflow.source_path("../scripts/cpg_density.py"),
     benchmark:
         "benchmarks/{sm}/density/CpG.tbl",
     threads: 4
     priority: 20
     shell:
         """
-        sh {params.script} {input.cpg_ref} {input.tbl} {output.bed} 2> {log}
+        python {params.script} --threads {threads} \
+            {input.fai} {input.index} {input.tbl} {output.bed} 2> {log}
         """
 
 rule density_dinucleosome:
@@ -48,7 +75,7 @@ rule density_dinucleosome:
         fai=f"{ref}.fai",
         tbl=rules.joint_fiber_table.output.tbl,
     output:
-        bed="results/{sm}/density/{sm}.dinuc.bed",
+        bed="results/{sm}/density/{sm}.dinuc.bed.gz",
     conda:
         env,
     log:
@@ -56,14 +83,15 @@ rule density_dinucleosome:
     resources:
         time=60,
     params:
-        script=workflow.source_path("../scripts/density/di-nucleosome-proportion.sh"),
+        script=workflow.source_path("../scripts/fiber_density.py"),
     benchmark:
         "benchmarks/{sm}/density/dinuc.tbl",
     threads: 4
     priority: 20
     shell:
         """
-        sh {params.script} {input.fai} {input.tbl} {output.bed} 2> {log}
+        python {params.script} nuc --threads {threads} \
+            {input.fai} {input.tbl} {output.bed} 2> {log}
         """
 
 rule density_msp:
@@ -71,7 +99,7 @@ rule density_msp:
         fai=f"{ref}.fai",
         tbl=rules.joint_fiber_table.output.tbl,
     output:
-        bed="results/{sm}/density/{sm}.msp.bed",
+        bed="results/{sm}/density/{sm}.msp.bed.gz",
     conda:
         env,
     log:
@@ -79,34 +107,13 @@ rule density_msp:
     resources:
         time=60,
     params:
-        script=workflow.source_path("../scripts/density/msp-proportion.sh"),
+        script=workflow.source_path("../scripts/fiber_density.py"),
     benchmark:
         "benchmarks/{sm}/density/msp.tbl",
     threads: 4
     priority: 20
     shell:
         """
-        sh {params.script} {input.fai} {input.tbl} {output.bed} 2> {log}
-        """
-
-rule density_results:
-    input:
-        dens0=rules.cpg_dinucleotide.output.bed,
-        dens1=rules.density_methylation.output.bed,
-        dens2=rules.density_msp.output.bed,
-        dens3=rules.density_dinucleosome.output.bed,
-    output:
-        dens0gz="results/{sm}/density/{sm}.CpG.reference.bed.gz",
-        dens1gz="results/{sm}/density/{sm}.CpG.bed.gz",
-        dens2gz="results/{sm}/density/{sm}.msp.bed.gz",
-        dens3gz="results/{sm}/density/{sm}.dinuc.bed.gz",
-    log:
-        "logs/{sm}/density/zip.{sm}.log",
-    shell:
-        """
-        bgzip -f -@ 4 {input.dens0} > {output.dens0gz} 2> {log}
-        bgzip -f -@ 4 {input.dens1} > {output.dens1gz} 2> {log}
-        bgzip -f -@ 4 {input.dens2} > {output.dens2gz} 2> {log}
-        bgzip -f -@ 4 {input.dens3} > {output.dens3gz} 2> {log}
-        rm -f input.dens0 input.dens1 input.dens2 input.dens3
+        python {params.script} msp --threads {threads} \
+            {input.fai} {input.tbl} {output.bed} 2> {log}
         """
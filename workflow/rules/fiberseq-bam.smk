@@ -4,7 +4,7 @@
 rule train_gmm:
     input:
         bam=train_gmm_input_bam,
-        csv=train_gmm_input_csv,
+        npz=train_gmm_input_npz,
     output:
         model="results/{sm}/{sm}.gmm_model.pkl",
     conda:
@@ -24,7 +24,7 @@ rule train_gmm:
     shell:
         """
         python {params.gmm} -v --threads {threads} \
-            {input.csv} {input.bam} \
+            {input.npz} {input.bam} \
             --train -o {output.model} \
             2> {log}
         """
@@ -35,7 +35,7 @@ rule gmm:
         get_gmm_model,  # can be empty if we are training per fiber
         ccs=rules.primrose.output.bam,
         pbi=rules.primrose.output.pbi,
-        csv=rules.ipdSummary.output.csv,
+        npz=rules.ipd_cache.output.npz,
     output:
         bam=temp("temp/{sm}/gmm.{scatteritem}.bam"),
     threads: 4
@@ -52,12 +52,13 @@ rule gmm:
         + get_gmm_model(wc)
         if gmm_model
         else "",
+        profile=profile_option("benchmarks/{sm}/gmm/{scatteritem}.tbl"),
     benchmark:
         "benchmarks/{sm}/gmm/{scatteritem}.tbl"
-    priority: 1000  # Run this as fast as possible so we can delete the csv from idpSummary.
+    priority: 1000
     shell:
         """
-        python {params.gmm} -v {params.model} --threads {threads} {input.csv} {input.ccs} > {output.bam} 2> {log}
+        python {params.gmm} -v {params.model} {params.profile} --threads {threads} {input.npz} {input.ccs} > {output.bam} 2> {log}
         """
 
 
@@ -98,6 +98,29 @@ rule ipdSummary:
         """
 
 
+rule ipd_cache:
+    input:
+        csv=rules.ipdSummary.output.csv,
+    output:
+        npz=temp("temp/{sm}/ipdSummary.{scatteritem}.npz"),
+    threads: 1
+    resources:
+        mem_mb=8 * 1024,
+    conda:
+        env
+    log:
+        "logs/{sm}/ipd_cache/{scatteritem}.log",
+    benchmark:
+        "benchmarks/{sm}/ipd_cache/{scatteritem}.tbl"
+    params:
+        ipd_cache=workflow.source_path("../scripts/ipd_cache.py"),
+    priority: 1000  # Run this as fast as possible so we can delete the csv from idpSummary.
+    shell:
+        """
+        python {params.ipd_cache} -v {input.csv} {output.npz} 2> {log}
+        """
+
+
 rule compress_ipdSummary:
     input:
         csv=rules.ipdSummary.output.csv,
@@ -1,143 +1,183 @@
+import argparse
+import logging
+import os
+import subprocess
+import tempfile
 import pysam
-from pybedtools import BedTool
-import sys
 import numpy as np
 from tqdm import tqdm
-import pyfaidx as pf
-
-
-bam = pysam.AlignmentFile(sys.argv[1], "rb")  # aligned bam
-bed = BedTool(sys.argv[2])  # aligned bed
-
-output_bam_name = sys.argv[1][:-3] + "m6A.tagged.bam"
-
-header = bam.header.to_dict()
-
-output_bam = pysam.AlignmentFile(output_bam_name, "wb", header=header)
-
-bed_dict = {}
-
-# bed to dictionary conversion for random access to methylation
-# marks encoded in the bed file
-
-for interval in bed:
-
-    name = str(interval.name)
-
-    methylations = np.fromstring(interval[-1], sep=",", dtype=np.float64)
-
-    bed_dict[name] = (methylations, int(interval.start))
-
-
-def coordinateConversion_MMTag(sequence, base, modification_coords):
-    """Sequence is array of bases. Base is a base
-    for conversion to the coordinate system
-    used in the MM tag."""
-
-    mask = sequence == bytes(base, encoding="utf-8")
-    # find all masks = boolean Array
-
-    coords = modification_coords[
-        sequence[modification_coords] == bytes(base, encoding="utf-8")
-    ]
-    # when working with double stranded data we can only use modifications
-    # on the specifc base that the modification would fall on on that strand
-    # i.e. As  on + , Ts on -, we only want the mods that = that base of interest
-
-    MM_coords = ",".join(list((np.diff(np.cumsum(mask)[coords]) - 1).astype(str)))
-
-    return MM_coords
-
-
-with output_bam as out_f:  # open output bam file
-
-    with bam as in_f:  # open input bam file, iterate through,
-        # and write modification to output bam
-        for read in tqdm(in_f):
-
-            name_list = read.query_name.split("/")
-            new_name = str(name_list[1] + "/" + name_list[0])
-
-            # new_name = str(read.query_name)
-
-            methylations = bed_dict.get(new_name)
-
-            if type(methylations) != type(None):
-
-                ap = np.vstack(read.get_aligned_pairs(matches_only=True)).T
-
-                # adjust bed to genomic coordinates
-                # search for adjusted coordinates
-                # in ap -- take the molecular coordinates that aligned
-
-                genomic_m6a = methylations[0].astype(int) + methylations[1]
-
-                mol_m6a = ap[
-                    0, np.isin(ap[1], genomic_m6a)
-                ]  # this is coordinates of query sequence
-                # we need coordinates of query alignemnt sequence
-
-                sequence = np.frombuffer(
-                    bytes(read.query_sequence, "utf-8"), dtype="S1"
+from mod_tags import sequence_array, encode_mods, add_mods
+from liftover import reference_to_query
+
+
+def parse_bed_line(line):
+    """Name, genomic m6A positions, and the block starts relative to the
+    fiber start, from an aligned bed12 line."""
+    fields = line.rstrip("\n").split("\t")
+    methylations = np.array(fields[-1].split(","), dtype=np.int64)
+    return fields[3], (methylations, int(fields[1]))
+
+
+def bed_key(name):
+    # bed names are zmw/smrt_cell
+    zmw, smrt_cell = name.split("/")[:2]
+    return smrt_cell, int(zmw)
+
+
+def read_key(read):
+    # read names are smrt_cell/zmw/ccs
+    name_list = read.query_name.split("/")
+    return name_list[0], int(name_list[1])
+
+
+def read_bed_dict(bed_file):
+    # bed to dictionary conversion for random access to methylation
+    # marks encoded in the bed file
+    bed_dict = {}
+    with open(bed_file) as bed:
+        for line in bed:
+            name, methylations = parse_bed_line(line)
+            bed_dict[name] = methylations
+    return bed_dict
+
+
+def dict_join(reads, bed_file):
+    """Yield (read, methylations) for the reads in the bed, holding the
+    whole bed in memory."""
+    bed_dict = read_bed_dict(bed_file)
+    for read in reads:
+        name_list = read.query_name.split("/")
+        new_name = str(name_list[1] + "/" + name_list[0])
+
+        # new_name = str(read.query_name)
+
+        methylations = bed_dict.get(new_name)
+        if methylations is not None:
+            yield read, methylations
+
+
+def sorted_bed(bed_file, tmp_dir):
+    """Yield (key, methylations) for the bed lines in the order of read_key,
+    sorting the bed on disk with sort so memory does not grow with it."""
+    keyed = os.path.join(tmp_dir, "keyed.bed")
+    with open(bed_file) as bed, open(keyed, "w") as out:
+        for line in bed:
+            smrt_cell, zmw = bed_key(line.split("\t", 4)[3])
+            out.write(f"{smrt_cell}\t{zmw:012d}\t{line}")
+    env = dict(os.environ, LC_ALL="C")
+    sort = subprocess.Popen(
+        ["sort", "-t", "\t", "-k1,1", "-k2,2", "-T", tmp_dir, keyed],
+        stdout=subprocess.PIPE,
+        text=True,
+        env=env,
+    )
+    for line in sort.stdout:
+        _smrt_cell, _zmw, line = line.split("\t", 2)
+        name, methylations = parse_bed_line(line)
+        yield bed_key(name), methylations
+    if sort.wait() != 0:
+        raise subprocess.CalledProcessError(sort.returncode, sort.args)
+
+
+def sorted_join(reads, bed_file):
+    """Yield (read, methylations) for the reads in the bed, merging reads
+    sorted by name (samtools sort -n) with the bed sorted on disk.
+    If a fiber is in the bed more than once the last line is used."""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        intervals = sorted_bed(bed_file, tmp_dir)
+        pending = next(intervals, None)
+        last_key, match = None, None
+        for read in reads:
+            key = read_key(read)
+            if last_key is not None and key < last_key:
+                raise ValueError(
+                    f"{read.query_name} is out of order, "
+                    "sort the bam with samtools sort -n."
                 )
+            if key != last_key:
+                match = None
+            last_key = key
+            while pending is not None and pending[0] <= key:
+                if pending[0] == key:
+                    match = pending[1]
+                pending = next(intervals, None)
+            if match is not None:
+                yield read, match
+
+
+def add_m6a(read, methylations):
+    # adjust bed to genomic coordinates
+    # search for adjusted coordinates
+    # in the aligned pairs -- take the molecular coordinates that aligned
+    genomic_m6a = np.unique(methylations[0] + methylations[1])
+
+    # this is coordinates of query sequence
+    mol_m6a = reference_to_query(read, genomic_m6a)
+    # we need coordinates of query alignemnt sequence
+
+    sequence = sequence_array(read)
+
+    ##########
+    # np.sum(np.isin(sequence[mol_m6a[1:-1]],['G','C']))
+    # -- this will retrieve count of methylation calls with poor alignment
+    # where reference does not match up A/T
+    #########
+
+    # # need to encode per strand
+    # # A+a encodes forward strand ( check As , offset of As )
+    # # T-a encodes reverse strand ( check Ts , offset of Ts )
+
+    # if the MM tag exists we append to the existing
+    # tags, otherwise we initialize them
+    mods, probabilities = encode_mods(sequence, mol_m6a[1:-1])
+    add_mods(read, mods, probabilities)
+
+
+def parse():
+    parser = argparse.ArgumentParser(
+        description="Add m6A calls from an aligned bed12 to the MM and ML tags "
+        "of an aligned bam, writing <bam prefix>.m6A.tagged.bam.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("bam", help="aligned bam")
+    parser.add_argument("bed", help="aligned bed12 of m6A calls")
+    parser.add_argument(
+        "-n",
+        "--name-sorted",
+        help="The bam is sorted by read name (samtools sort -n). The bed is "
+        "sorted on disk and joined to it a fiber at a time, so memory does not "
+        "grow with the number of fibers.",
+        action="store_true",
+    )
+    parser.add_argument(
+        "-v", "--verbose", help="increase logging verbosity", action="store_true"
+    )
+    args = parser.parse_args()
+    log_format = "[%(levelname)s][Time elapsed (ms) %(relativeCreated)d]: %(message)s"
+    log_level = logging.DEBUG if args.verbose else logging.WARNING
+    logging.basicConfig(format=log_format, level=log_level)
+    return args
+
+
+def main():
+    args = parse()
+    bam = pysam.AlignmentFile(args.bam, "rb")  # aligned bam
+
+    output_bam_name = args.bam[:-3] + "m6A.tagged.bam"
+
+    header = bam.header.to_dict()
+
+    output_bam = pysam.AlignmentFile(output_bam_name, "wb", header=header)
+
+    join = sorted_join if args.name_sorted else dict_join
+
+    with output_bam as out_f:  # open output bam file
+        with bam as in_f:  # open input bam file, iterate through,
+            # and write modification to output bam
+            for read, methylations in join(tqdm(in_f), args.bed):
+                add_m6a(read, methylations)
+                out_f.write(read)
 
-                ##########
-                # np.sum(np.isin(sequence[mol_m6a[1:-1]],['G','C']))
-                # -- this will retrieve count of methylation calls with poor alignment
-                # where reference does not match up A/T
-                #########
-
-                # # need to encode per strand
-                # # A+a encodes forward strand ( check As , offset of As )
-                # # T-a encodes reverse strand ( check Ts , offset of Ts )
-
-                # need to grab all A and all T positions
-                # and then frame methylation positions in
-                # the appropriate base-space
-
-                A_mods = coordinateConversion_MMTag(sequence, "A", mol_m6a[1:-1])
-                T_mods = coordinateConversion_MMTag(sequence, "T", mol_m6a[1:-1])
-
-                # need to check if MM tag exists
-                # if "MM" tag exists -- we are going to
-                # append to the existing tag
-                # otherwise, we initialize the tag
-
-                mod_count = A_mods.count(",") + 1 + T_mods.count(",") + 1
-
-                mods = "A+a," + A_mods + ";" + "T-a," + T_mods + ";"
-                new_probabilities = [255] * mod_count
-                # check if tag exists
-
-                if read.has_tag("MM"):
-                    # if has tag
-                    # we need to modify the flag
-
-                    original_mods = read.get_tag("MM")
-                    new_mods = str(original_mods) + mods
-
-                    original_probs = list(read.get_tag("ML"))
-                    # 					print(original_probs)
-                    new_probs = (
-                        np.array(original_probs + new_probabilities)
-                        .astype(int)
-                        .tolist()
-                    )
-
-                    # read.set_tag('MM', new_mods, value_type = 'Z', replace = True)
-                    # read.set_tag('ML', new_probs, value_type = 'B', replace = True)
-
-                    new_tags = [("MM", new_mods, "Z"), ("ML", new_probs, "C")]
-
-                    for tag_set in read.get_tags():
-                        if tag_set[0] != "MM" and tag_set[0] != "ML":
-
-                            new_tags.append(tag_set)
-
-                    read.set_tags(new_tags)
-
-                else:
-                    # if does not have tag just add it
-                    read.tags += [("MM:Z:", mods)]
 
-                out_f.write(read)
+if __name__ == "__main__":
+    main()
@@ -6,8 +6,17 @@ import logging
 import pomegranate as pom
 import array
 import git
+import json
+import multiprocessing as mp
+from collections import deque
+import numba
+from numba import njit, prange
+from bgzf import split_threads
+from profiling import Profile, NO_PROFILE
+from mod_tags import MIN_ML_SCORE, mod_binary, mods_to_arrays, sequence_array
 
 D_TYPE = np.int64
+NUC_TAGS = ["ns", "nl", "as", "al"]
 
 
 def get_commit_hash(short=7):
@@ -64,6 +73,32 @@ def parse():
         help="Output bam or json file.",
         type=argparse.FileType("w"),
     )
+    parser.add_argument(
+        "-b",
+        "--batch-size",
+        help="Number of fibers to decode with the HMM at once, and to send to each worker process when using more than one thread.",
+        type=int,
+        default=1000,
+    )
+    parser.add_argument(
+        "--viterbi",
+        help="Decode with viterbi instead of maximum a posteriori (the default of pomegranate's predict).",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--min-ml-score",
+        help="Skip m6A calls with an ML score below this, as with the "
+        "pipeline's min_ml_score and ft extract. When training (no --model) "
+        "they are also left out of the HMM training data, so a higher score "
+        "trains on fewer but surer calls.",
+        type=int,
+        default=MIN_ML_SCORE,
+    )
+    parser.add_argument(
+        "--profile",
+        help="Write time per stage, throughput, and peak memory to this json file.",
+        default=None,
+    )
     parser.add_argument("-t", "--threads", help="n threads to use", type=int, default=1)
     parser.add_argument(
         "-v", "--verbose", help="increase logging verbosity", action="store_true"
@@ -89,29 +124,192 @@ def assign_states(model):
     return actuated, nucleated
 
 
-def get_mods_from_rec(rec, mods=[("A", 0, "a"), ("T", 1, "a")], mask=True):
-    if rec.modified_bases is None:
+def read_hmm_json(filename):
+    """Read the start, transition, emission, and end log probabilities
+    of a trained two state discrete HMM from the pomegranate json model.
+    Emitting states keep the order they have in the baked model so that
+    state labels match the output of hmm.predict."""
+    with open(filename) as handle:
+        model = json.load(handle)
+    states = model["states"]
+    emitting = [
+        i for i, state in enumerate(states) if state["distribution"] is not None
+    ]
+    n_states = len(emitting)
+    assert emitting == list(range(n_states)), "Emitting states must come first"
+    start_index = model.get("start_index", None)
+    if start_index is None:
+        start_index = [state["name"] for state in states].index(model["start"]["name"])
+    end_index = model["end_index"]
+
+    with np.errstate(divide="ignore"):
+        log_emit = np.full((n_states, 2), -np.inf)
+        for i in emitting:
+            for key, prob in states[i]["distribution"]["parameters"][0].items():
+                log_emit[i, int(float(key))] = np.log(prob)
+
+        log_start = np.full(n_states, -np.inf)
+        log_trans = np.full((n_states, n_states), -np.inf)
+        log_end = np.full(n_states, -np.inf)
+        for edge in model["edges"]:
+            a, b, prob = int(edge[0]), int(edge[1]), float(edge[2])
+            if a == start_index and b < n_states:
+                log_start[b] = np.log(prob)
+            elif a < n_states and b == end_index:
+                log_end[a] = np.log(prob)
+            elif a < n_states and b < n_states:
+                log_trans[a, b] = np.log(prob)
+
+    # models without edges to the end state are not finite and ignore it
+    if np.isinf(log_end).all():
+        log_end[:] = 0.0
+    return log_start, log_trans, log_emit, log_end
+
+
+def assign_states_from_emissions(log_emit):
+    if log_emit[0, 1] > log_emit[1, 1]:
+        return 0, 1
+    return 1, 0
+
+
+@njit
+def _pair_lse(x, y):
+    # same log sum exp as pomegranate so that posteriors match
+    if x == np.inf or y == np.inf:
+        return np.inf
+    if x == -np.inf:
+        return y
+    if y == -np.inf:
+        return x
+    if x > y:
+        return x + np.log(np.exp(y - x) + 1)
+    return y + np.log(np.exp(x - y) + 1)
+
+
+@njit
+def _viterbi(obs, log_start, log_trans, log_emit, log_end, path):
+    n, m = obs.shape[0], log_start.shape[0]
+    v = np.empty((n, m))
+    tb = np.empty((n, m), dtype=np.int8)
+    for j in range(m):
+        v[0, j] = log_start[j] + log_emit[j, obs[0]]
+    for t in range(1, n):
+        for j in range(m):
+            best, arg = -np.inf, 0
+            for i in range(m):
+                score = v[t - 1, i] + log_trans[i, j]
+                if score > best:
+                    best, arg = score, i
+            v[t, j] = best + log_emit[j, obs[t]]
+            tb[t, j] = arg
+    best, state = -np.inf, 0
+    for j in range(m):
+        score = v[n - 1, j] + log_end[j]
+        if score > best:
+            best, state = score, j
+    for t in range(n - 1, -1, -1):
+        path[t] = state
+        state = tb[t, state]
+
+
+@njit
+def _maximum_a_posteriori(obs, log_start, log_trans, log_emit, log_end, path):
+    n, m = obs.shape[0], log_start.shape[0]
+    f = np.empty((n, m))
+    b = np.empty((n, m))
+    for j in range(m):
+        f[0, j] = log_start[j] + log_emit[j, obs[0]]
+        b[n - 1, j] = log_end[j]
+    for t in range(1, n):
+        for j in range(m):
+            total = -np.inf
+            for i in range(m):
+                total = _pair_lse(total, f[t - 1, i] + log_trans[i, j])
+            f[t, j] = total + log_emit[j, obs[t]]
+    for t in range(n - 2, -1, -1):
+        for i in range(m):
+            total = -np.inf
+            for j in range(m):
+                total = _pair_lse(
+                    total, log_trans[i, j] + log_emit[j, obs[t + 1]] + b[t + 1, j]
+                )
+            b[t, i] = total
+    log_prob = -np.inf
+    for j in range(m):
+        log_prob = _pair_lse(log_prob, f[n - 1, j] + log_end[j])
+    for t in range(n):
+        best, state = -np.inf, 0
+        for j in range(m):
+            score = f[t, j] + b[t, j] - log_prob
+            if score > best:
+                best, state = score, j
+        path[t] = state
+
+
+@njit(parallel=True)
+def decode_batch(
+    packed, offsets, log_start, log_trans, log_emit, log_end, viterbi=False
+):
+    """Decode many fibers at once. packed is the concatenation of the
+    AT space binary arrays and fiber i is packed[offsets[i]:offsets[i+1]].
+    Returns the packed state paths."""
+    paths = np.zeros(packed.shape[0], dtype=np.uint8)
+    for i in prange(offsets.shape[0] - 1):
+        st, en = offsets[i], offsets[i + 1]
+        if en <= st:
+            continue
+        if viterbi:
+            _viterbi(
+                packed[st:en], log_start, log_trans, log_emit, log_end, paths[st:en]
+            )
+        else:
+            _maximum_a_posteriori(
+                packed[st:en], log_start, log_trans, log_emit, log_end, paths[st:en]
+            )
+    return paths
+
+
+@njit
+def fiber_arrays(seq, binary):
+    """Split the modified bases of a fiber into A/T space in one pass.
+    returns: binary of m6A calls at A/Ts, A/T positions, and modified positions"""
+    n_at = 0
+    n_mods = 0
+    for i in range(seq.shape[0]):
+        n_at += seq[i] == ord("A") or seq[i] == ord("T")
+        n_mods += binary[i]
+    at_binary = np.empty(n_at, dtype=np.uint8)
+    at_positions = np.empty(n_at, dtype=D_TYPE)
+    mod_positions = np.empty(n_mods, dtype=D_TYPE)
+    n_at = 0
+    n_mods = 0
+    for i in range(seq.shape[0]):
+        if seq[i] == ord("A") or seq[i] == ord("T"):
+            at_binary[n_at] = binary[i]
+            at_positions[n_at] = i
+            n_at += 1
+        if binary[i]:
+            mod_positions[n_mods] = i
+            n_mods += 1
+    return at_binary, at_positions, mod_positions
+
+
+def get_mods_from_rec(rec, mods=[("A", 0, "a"), ("T", 1, "a")], mask=True, min_ml=0):
+    """Parse the MM/ML tags of a fiber into its m6A calls, skipping calls with
+    an ML score below min_ml. mods are in the orientation of the MM tag.
+    returns: binary of the calls (at A/Ts only if mask), A/T positions, and
+    the positions of the calls, or Nones if there are no calls"""
+    binary = mod_binary(rec, mods_to_arrays(mods), min_ml=min_ml)
+    if binary is None:
         return None, None, None
-    seq = np.frombuffer(bytes(rec.query_sequence, "utf-8"), dtype="S1")
-    positions = []
-    for mod in mods:
-        if mod in rec.modified_bases:
-            pos = np.array(rec.modified_bases[mod], dtype=D_TYPE)[:, 0]
-            positions.append(pos)
-    if len(positions) < 1:
+    seq = sequence_array(rec)
+    at_binary, AT_positions, methylated_positions = fiber_arrays(seq, binary)
+    if methylated_positions.shape[0] < 1:
         return None, None, None
-    methylated_positions = np.concatenate(positions, dtype=D_TYPE)
-    methylated_positions.sort(kind="mergesort")
-
-    AT_mask = (seq == b"A") | (seq == b"T")
-    AT_positions = np.argwhere(AT_mask).transpose()[0]
-
-    binary = np.zeros(shape=len(seq), dtype=np.uint8)
-    binary[methylated_positions] = 1
 
     if mask:
         # TODO check for other mods
-        return binary[AT_mask], AT_positions, methylated_positions
+        return at_binary, AT_positions, methylated_positions
     return binary, AT_positions, methylated_positions
 
 
@@ -139,10 +337,6 @@ def meshMethods(
     simple_ends = np.add(simple_starts, simple_sizes, dtype=D_TYPE)
     hmm_ends = np.add(hmm_starts, hmm_sizes, dtype=D_TYPE)
 
-    # stack with nucleosome boundary
-    simple_stack = np.vstack([simple_starts, simple_ends])
-    hmm_stack = np.vstack([hmm_starts, hmm_ends])
-
     #### processing ideas
 
     #### generate binary array of 0 , 1, 2
@@ -154,6 +348,7 @@ def meshMethods(
     #### to do so call 2 first then overlay 1
 
     #### perform RLE
+    #### (computed from the intervals directly, see interval_rle)
 
     #### stretches of 1s = nucleosomes.
     #### stretches of 2s directly between ones == 0
@@ -161,17 +356,9 @@ def meshMethods(
 
     ### append nucleosome starts/sizes as arrays for consistency and use of np.concatenate
 
-    chromatin_binary = np.zeros(shape=fiber_length).astype(D_TYPE)
-
-    for column in range(hmm_stack.shape[1]):
-
-        chromatin_binary[hmm_stack[0, column] : hmm_stack[1, column]] = 2
-
-    for column in range(simple_stack.shape[1]):
-
-        chromatin_binary[simple_stack[0, column] : simple_stack[1, column]] = 1
-
-    run_length, run_index, run_label = rle(chromatin_binary)
+    run_length, run_index, run_label = interval_rle(
+        simple_starts, simple_ends, hmm_starts, hmm_ends, fiber_length
+    )
 
     # collect all nucleosome starts and sizes
     nucleosome_starts = []
@@ -183,45 +370,18 @@ def meshMethods(
     nucleosome_starts.append(run_index[run_label == 1])
     nucleosome_sizes.append(run_length[run_label == 1])
 
-    # print(chromatin_binary)
-
     # STEP 2
+    # hmm nucs that are not terminal (we will call the ends via a simple caller)
+    # and are flanked by actuated sequence on both sides
     hmm_idx = np.argwhere(run_label == 2).reshape(-1)
+    hmm_idx = hmm_idx[(hmm_idx > 0) & (hmm_idx < len(run_length) - 1)]
+    hmm_idx = hmm_idx[(run_label[hmm_idx - 1] == 0) & (run_label[hmm_idx + 1] == 0)]
 
-    number_of_runs = len(run_length)
-    for idx in hmm_idx:
-
-        if idx > 0 and idx < number_of_runs - 1:
-            # check that it is not a terminal hmm nuc
-            # we will call the ends via a simple caller
-            # print(run_label[hmm_idx - 1])
-            if run_label[idx - 1] == 0 and run_label[idx + 1] == 0:
-                # check that hmm nuc call is flanked by actuated sequence
-
-                hmm_nuc_start, hmm_nuc_size = run_index[idx], run_length[idx]
-                hmm_nuc_end = hmm_nuc_start + hmm_nuc_size
-
-                hmm_nuc_midpoint = int(hmm_nuc_start + int(np.floor(hmm_nuc_size / 2)))
-                lower_mets = methylated_positions[
-                    methylated_positions < hmm_nuc_midpoint
-                ]
-                greater_mets = methylated_positions[
-                    methylated_positions > hmm_nuc_midpoint
-                ]
-
-                if len(lower_mets) == 0 or len(greater_mets) == 0:
-                    continue
-
-                closest_start_idx = np.argmin(np.abs(lower_mets - hmm_nuc_start))
-                closest_end_idx = np.argmin(np.abs(greater_mets - hmm_nuc_end))
-
-                nucleosome_starts.append([lower_mets[closest_start_idx] + 1])
-                nucleosome_sizes.append(
-                    [
-                        greater_mets[closest_end_idx]
-                        - (lower_mets[closest_start_idx] + 1)
-                    ]
-                )
+    hmm_nuc_starts, hmm_nuc_sizes = closest_flanking_methylations(
+        methylated_positions, run_index[hmm_idx], run_length[hmm_idx]
+    )
+    nucleosome_starts.append(hmm_nuc_starts)
+    nucleosome_sizes.append(hmm_nuc_sizes)
 
     nucleosome_starts = np.concatenate(nucleosome_starts)
     nucleosome_sizes = np.concatenate(nucleosome_sizes)
@@ -239,154 +399,328 @@ def meshMethods(
     # next check that it is flanked by 0s
 
 
-def apply_hmm(bam, hmm, nuc_label, cutoff, out, min_dist=46):
-    for rec in bam.fetch(until_eof=True):
-        (
-            binary,
-            AT_positions,
-            methylated_positions,
-        ) = get_mods_from_rec(rec, mask=True)
-        if binary is None:
-            out.write(rec)
-            continue
-        # binary of m6A calls in AT space, and AT positions relative to 0-based fiber start
-
-        simple_starts, simple_sizes, generated_terminal = simpleFind(
-            methylated_positions, binary, cutoff
-        )
+def add_nucleosomes(
+    rec,
+    binary,
+    AT_positions,
+    methylated_positions,
+    state_path,
+    nuc_label,
+    cutoff,
+    min_dist=46,
+):
+    """Combine the simple and HMM calls for a fiber and set the
+    ns/nl/as/al tags on the record."""
+    # binary of m6A calls in AT space, and AT positions relative to 0-based fiber start
 
-        # generated terminal is a boolean indicating if we generated a custom
-        # nucleosome until tht terminal end of the fiber
+    simple_starts, simple_sizes, generated_terminal = simpleFind(
+        methylated_positions, binary, cutoff
+    )
 
-        state_path = hmm.predict(binary)
-        # print(len(binary))
+    # generated terminal is a boolean indicating if we generated a custom
+    # nucleosome until tht terminal end of the fiber
 
-        lengths, starts, labels = rle(state_path)
-        # starts indicate start in AT binary array
-        # lengths indicates length in AT binary space
-        # labels is the state label
+    lengths, starts, labels = rle(state_path)
+    # starts indicate start in AT binary array
+    # lengths indicates length in AT binary space
+    # labels is the state label
 
-        hmm_nucleosome_mask = labels == nuc_label
+    hmm_nucleosome_mask = labels == nuc_label
 
-        hmm_nuc_ends = AT_positions[
-            np.add(starts[hmm_nucleosome_mask], lengths[hmm_nucleosome_mask] - 1)
-        ]
-        hmm_nuc_starts = AT_positions[starts[hmm_nucleosome_mask]]
+    hmm_nuc_ends = AT_positions[
+        np.add(starts[hmm_nucleosome_mask], lengths[hmm_nucleosome_mask] - 1)
+    ]
+    hmm_nuc_starts = AT_positions[starts[hmm_nucleosome_mask]]
 
-        hmm_nuc_sizes = hmm_nuc_ends - hmm_nuc_starts
+    hmm_nuc_sizes = hmm_nuc_ends - hmm_nuc_starts
 
-        hmm_sizing_mask = hmm_nuc_sizes >= cutoff
+    hmm_sizing_mask = hmm_nuc_sizes >= cutoff
 
-        hmm_nuc_sizes = hmm_nuc_sizes[hmm_sizing_mask]
-        hmm_nuc_starts = hmm_nuc_starts[hmm_sizing_mask]
+    hmm_nuc_sizes = hmm_nuc_sizes[hmm_sizing_mask]
+    hmm_nuc_starts = hmm_nuc_starts[hmm_sizing_mask]
 
-        fiber_length = len(rec.query_sequence)
+    fiber_length = len(rec.query_sequence)
 
-        all_starts, all_sizes = meshMethods(
-            simple_starts,
-            simple_sizes,
-            hmm_nuc_starts,
-            hmm_nuc_sizes,
-            methylated_positions,
-            fiber_length,
-            cutoff,
-        )
+    all_starts, all_sizes = meshMethods(
+        simple_starts,
+        simple_sizes,
+        hmm_nuc_starts,
+        hmm_nuc_sizes,
+        methylated_positions,
+        fiber_length,
+        cutoff,
+    )
 
-        output_starts = all_starts
-        output_sizes = all_sizes
+    output_starts = all_starts
+    output_sizes = all_sizes
 
-        # no nucleosomes found, continue
-        if methylated_positions.shape[0] == 0 or output_sizes.shape[0] == 0:
-            out.write(rec)
-            continue
+    # no nucleosomes found, continue
+    if methylated_positions.shape[0] == 0 or output_sizes.shape[0] == 0:
+        return
 
-        # now need to bookend the fibers with the terminal nucleosomes
-        # only need to bookend if hmm or simplecaller did not handle it
-        # i.e. only need to book end front if there is not a 1 present in the nuc_starts
-        # and only nee to book end end if there is not fib-length - 1 in
-        # we dont need artificial ends anymore for nucleosomes
-        # just last methylation to fiber length and 0 to first methylation as nucs
+    # now need to bookend the fibers with the terminal nucleosomes
+    # only need to bookend if hmm or simplecaller did not handle it
+    # i.e. only need to book end front if there is not a 1 present in the nuc_starts
+    # and only nee to book end end if there is not fib-length - 1 in
+    # we dont need artificial ends anymore for nucleosomes
+    # just last methylation to fiber length and 0 to first methylation as nucs
 
-        front_terminal_nuc_start = 0
-        front_terminal_nuc_end = methylated_positions[0]
-        front_terminal_nuc_size = front_terminal_nuc_end - front_terminal_nuc_start
+    front_terminal_nuc_start = 0
+    front_terminal_nuc_end = methylated_positions[0]
+    front_terminal_nuc_size = front_terminal_nuc_end - front_terminal_nuc_start
 
-        if not generated_terminal:
-            end_terminal_nuc_start = np.maximum(
-                methylated_positions[-1], output_starts[-1] + output_sizes[-1] + 1
-            )
-            if end_terminal_nuc_start != methylated_positions[-1]:
-                all_sizes[-1] = (
-                    fiber_length - output_starts[-1]
-                )  # resize the last nucleosome call to the end of fiber
-                output_sizes[-1] = all_sizes[-1]
-            else:
-                end_terminal_nuc_size = fiber_length - end_terminal_nuc_start
-                output_starts = np.append(output_starts, [end_terminal_nuc_start])
-                output_sizes = np.append(output_sizes, [end_terminal_nuc_size])
-                all_starts = output_starts
-                all_sizes = output_sizes
-
-        output_starts = np.concatenate(
-            [[front_terminal_nuc_start], all_starts], dtype=D_TYPE
-        )
-        output_sizes = np.concatenate(
-            [[front_terminal_nuc_size], all_sizes], dtype=D_TYPE
+    if not generated_terminal:
+        end_terminal_nuc_start = np.maximum(
+            methylated_positions[-1], output_starts[-1] + output_sizes[-1] + 1
         )
+        if end_terminal_nuc_start != methylated_positions[-1]:
+            all_sizes[-1] = (
+                fiber_length - output_starts[-1]
+            )  # resize the last nucleosome call to the end of fiber
+            output_sizes[-1] = all_sizes[-1]
+        else:
+            end_terminal_nuc_size = fiber_length - end_terminal_nuc_start
+            output_starts = np.append(output_starts, [end_terminal_nuc_start])
+            output_sizes = np.append(output_sizes, [end_terminal_nuc_size])
+            all_starts = output_starts
+            all_sizes = output_sizes
+
+    output_starts = np.concatenate(
+        [[front_terminal_nuc_start], all_starts], dtype=D_TYPE
+    )
+    output_sizes = np.concatenate([[front_terminal_nuc_size], all_sizes], dtype=D_TYPE)
 
-        # check that the hmm is only making ranges that are possible.
-        correct_sizes = output_starts[:-1] + output_sizes[:-1] <= output_starts[1:]
-        if not np.all(correct_sizes):
-            logging.warning(
-                f"HMM made invalid ranges for {rec.query_name} skipping nucelosome calling for fiber"
-            )
-            out.write(rec)
-            continue
+    # check that the hmm is only making ranges that are possible.
+    correct_sizes = output_starts[:-1] + output_sizes[:-1] <= output_starts[1:]
+    if not np.all(correct_sizes):
+        logging.warning(
+            f"HMM made invalid ranges for {rec.query_name} skipping nucelosome calling for fiber"
+        )
+        return
 
-        # make the acc arrays
-        acc_starts = (output_starts + output_sizes)[:-1]
-        acc_ends = output_starts[1:]
-        acc_sizes = acc_ends - acc_starts
+    # make the acc arrays
+    acc_starts = (output_starts + output_sizes)[:-1]
+    acc_ends = output_starts[1:]
+    acc_sizes = acc_ends - acc_starts
 
-        # nucs always bookend the fiber, but now changing that here
-        assert (
-            output_starts[0] == 0
-            and output_starts[-1] + output_sizes[-1] == fiber_length
-        )
-        output_starts = output_starts[1:-1]
-        output_sizes = output_sizes[1:-1]
-
-        # check that nucleosomes are not too close to the ends of the fiber, and have non-zero size
-        cond = (
-            (output_starts >= min_dist)
-            & ((output_starts + output_sizes) <= (fiber_length - min_dist))
-            & (output_sizes > 0)
-        )
-        output_starts_2 = output_starts[cond]
-        output_sizes_2 = output_sizes[cond]
-
-        # check that accessible elements are not too close to the ends of the fiber, and have non-zero size
-        cond = (
-            (acc_starts >= min_dist)
-            & ((acc_starts + acc_sizes) <= (fiber_length - min_dist))
-            & (acc_sizes > 0)
+    # nucs always bookend the fiber, but now changing that here
+    assert (
+        output_starts[0] == 0 and output_starts[-1] + output_sizes[-1] == fiber_length
+    )
+    output_starts = output_starts[1:-1]
+    output_sizes = output_sizes[1:-1]
+
+    # check that nucleosomes are not too close to the ends of the fiber, and have non-zero size
+    cond = (
+        (output_starts >= min_dist)
+        & ((output_starts + output_sizes) <= (fiber_length - min_dist))
+        & (output_sizes > 0)
+    )
+    output_starts_2 = output_starts[cond]
+    output_sizes_2 = output_sizes[cond]
+
+    # check that accessible elements are not too close to the ends of the fiber, and have non-zero size
+    cond = (
+        (acc_starts >= min_dist)
+        & ((acc_starts + acc_sizes) <= (fiber_length - min_dist))
+        & (acc_sizes > 0)
+    )
+    acc_starts_2 = acc_starts[cond]
+    acc_sizes_2 = acc_sizes[cond]
+
+    n_msp = acc_starts_2.shape[0]
+    n_nuc = output_starts_2.shape[0]
+    assert (
+        abs(n_msp - n_nuc) < 2
+    ), f"Number of nucleosomes must be within 1 of the number of MSP elements: MSP({n_msp}), Nuc({n_nuc})"
+
+    if output_sizes.shape[0] > 0:
+        rec.set_tag("ns", array.array("I", output_starts_2))
+        rec.set_tag("nl", array.array("I", output_sizes_2))
+    if acc_sizes.shape[0] > 0:
+        rec.set_tag("as", array.array("I", acc_starts_2))
+        rec.set_tag("al", array.array("I", acc_sizes_2))
+
+
+def decode_fibers(binaries, hmm, viterbi=False):
+    """Decode the AT space binary arrays of a batch of fibers
+    with the HMM parameters from read_hmm_json."""
+    lengths = np.array([binary.shape[0] for binary in binaries], dtype=D_TYPE)
+    offsets = np.zeros(lengths.shape[0] + 1, dtype=D_TYPE)
+    np.cumsum(lengths, out=offsets[1:])
+    if offsets[-1] == 0:
+        return [np.zeros(0, dtype=np.uint8) for _ in binaries]
+    packed = np.concatenate(binaries).astype(np.uint8, copy=False)
+    paths = decode_batch(packed, offsets, *hmm, viterbi=viterbi)
+    return np.split(paths, offsets[1:-1])
+
+
+def batched_records(bam, batch_size=1000):
+    batch = []
+    for rec in bam.fetch(until_eof=True):
+        batch.append(rec)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if len(batch) > 0:
+        yield batch
+
+
+def call_batch(
+    batch,
+    hmm,
+    nuc_label,
+    cutoff,
+    min_dist=46,
+    viterbi=False,
+    min_ml=0,
+    profile=NO_PROFILE,
+):
+    """Add nucleosome and MSP tags to a batch of records."""
+    with profile.stage("mods"):
+        fibers = [
+            (rec, *get_mods_from_rec(rec, mask=True, min_ml=min_ml)) for rec in batch
+        ]
+    to_decode = [fiber for fiber in fibers if fiber[1] is not None]
+    with profile.stage("hmm"):
+        state_paths = decode_fibers([fiber[1] for fiber in to_decode], hmm, viterbi)
+    with profile.stage("tags"):
+        for fiber, state_path in zip(to_decode, state_paths):
+            add_nucleosomes(*fiber, state_path, nuc_label, cutoff, min_dist=min_dist)
+
+
+def closest_flanking_methylations(methylated_positions, starts, sizes):
+    """For each hmm nucleosome find the methylation closest to its start
+    among those before its midpoint, and the methylation closest to its end
+    among those after its midpoint. Nucleosomes without methylations on both
+    sides of the midpoint are dropped. On ties the upstream methylation wins.
+    returns: tuple (nucleosome starts, nucleosome sizes) between the methylations
+    """
+    m = methylated_positions
+    n = m.shape[0]
+    ends = starts + sizes
+    midpoints = starts + sizes // 2
+    # methylations < midpoint are m[:n_lower], and > midpoint are m[first_greater:]
+    n_lower = np.searchsorted(m, midpoints, side="left")
+    first_greater = np.searchsorted(m, midpoints, side="right")
+    valid = (n_lower > 0) & (first_greater < n)
+    starts, ends = starts[valid], ends[valid]
+    n_lower, first_greater = n_lower[valid], first_greater[valid]
+    if starts.shape[0] == 0:
+        return np.zeros(0, dtype=D_TYPE), np.zeros(0, dtype=D_TYPE)
+
+    def closest(targets, lo, hi):
+        # index of the value in m[lo:hi] closest to each target
+        right = np.clip(np.searchsorted(m, targets, side="left"), lo, hi - 1)
+        left = np.maximum(right - 1, lo)
+        use_left = np.abs(m[left] - targets) <= np.abs(m[right] - targets)
+        return np.where(use_left, left, right)
+
+    nuc_starts = m[closest(starts, 0, n_lower)] + 1
+    nuc_ends = m[closest(ends, first_greater, n)]
+    return nuc_starts.astype(D_TYPE), (nuc_ends - nuc_starts).astype(D_TYPE)
+
+
+def apply_hmm(
+    bam,
+    hmm,
+    nuc_label,
+    cutoff,
+    out,
+    min_dist=46,
+    batch_size=1000,
+    viterbi=False,
+    min_ml=0,
+    profile=NO_PROFILE,
+):
+    for batch in profile.iterate(batched_records(bam, batch_size), "read"):
+        profile.count_records(batch)
+        call_batch(
+            batch,
+            hmm,
+            nuc_label,
+            cutoff,
+            min_dist=min_dist,
+            viterbi=viterbi,
+            min_ml=min_ml,
+            profile=profile,
         )
-        acc_starts_2 = acc_starts[cond]
-        acc_sizes_2 = acc_sizes[cond]
+        with profile.stage("write"):
+            for rec in batch:
+                out.write(rec)
+
+
+# state shared by the nucleosome calling worker processes
+WORKER = {}
+
+
+def init_worker(header, hmm, nuc_label, cutoff, min_dist, viterbi, min_ml):
+    # the pool already uses all the threads, so keep numba to one per worker
+    numba.set_num_threads(1)
+    WORKER["header"] = pysam.AlignmentHeader.from_dict(header)
+    WORKER["args"] = (hmm, nuc_label, cutoff, min_dist, viterbi, min_ml)
+
+
+def call_batch_worker(rec_strings):
+    batch = [
+        pysam.AlignedSegment.fromstring(rec_string, WORKER["header"])
+        for rec_string in rec_strings
+    ]
+    call_batch(batch, *WORKER["args"])
+    return [
+        [(tag, rec.get_tag(tag)) for tag in NUC_TAGS if rec.has_tag(tag)]
+        for rec in batch
+    ]
+
+
+def write_tagged_batch(batch, job, out, profile=NO_PROFILE):
+    with profile.stage("hmm"):
+        batch_tags = job.get()
+    profile.count_records(batch)
+    with profile.stage("write"):
+        for rec, tags in zip(batch, batch_tags):
+            for tag, value in tags:
+                rec.set_tag(tag, value)
+            out.write(rec)
 
-        n_msp = acc_starts_2.shape[0]
-        n_nuc = output_starts_2.shape[0]
-        assert (
-            abs(n_msp - n_nuc) < 2
-        ), f"Number of nucleosomes must be within 1 of the number of MSP elements: MSP({n_msp}), Nuc({n_nuc})"
 
-        if output_sizes.shape[0] > 0:
-            rec.set_tag("ns", array.array("I", output_starts_2))
-            rec.set_tag("nl", array.array("I", output_sizes_2))
-        if acc_sizes.shape[0] > 0:
-            rec.set_tag("as", array.array("I", acc_starts_2))
-            rec.set_tag("al", array.array("I", acc_sizes_2))
-        out.write(rec)
+def apply_hmm_parallel(
+    bam,
+    hmm,
+    nuc_label,
+    cutoff,
+    out,
+    threads,
+    min_dist=46,
+    batch_size=1000,
+    viterbi=False,
+    min_ml=0,
+    profile=NO_PROFILE,
+):
+    """Read batches of records in this process, call nucleosomes on them in
+    a pool of worker processes, and write the records out in input order.
+    At most two batches per worker are in flight at once to bound memory.
+    The hmm stage of the profile is the time spent waiting on the workers."""
+    init_args = (
+        bam.header.to_dict(),
+        hmm,
+        nuc_label,
+        cutoff,
+        min_dist,
+        viterbi,
+        min_ml,
+    )
+    pending = deque()
+    with mp.Pool(threads, initializer=init_worker, initargs=init_args) as pool:
+        for batch in profile.iterate(batched_records(bam, batch_size), "read"):
+            job = pool.apply_async(
+                call_batch_worker, ([rec.to_string() for rec in batch],)
+            )
+            pending.append((batch, job))
+            if len(pending) >= 2 * threads:
+                write_tagged_batch(*pending.popleft(), out, profile=profile)
+        while len(pending) > 0:
+            write_tagged_batch(*pending.popleft(), out, profile=profile)
 
 
 def simpleFind(methylated_positions, binary, cutoff):
@@ -519,6 +853,42 @@ def simpleFind(methylated_positions, binary, cutoff):
         return simple_nuc_starts, simple_nuc_sizes, False
 
 
+def covered(positions, starts, ends):
+    """Boolean array of whether each position falls within
+    any of the (possibly overlapping) [start, end) intervals."""
+    n_started = np.searchsorted(np.sort(starts), positions, side="right")
+    n_ended = np.searchsorted(np.sort(ends), positions, side="right")
+    return n_started > n_ended
+
+
+def interval_rle(simple_starts, simple_ends, hmm_starts, hmm_ends, length):
+    """rle of an array of the given length where the hmm intervals are
+    painted with 2 and then the simple intervals are painted over them
+    with 1. Works on the interval boundaries so the cost scales with the
+    number of intervals rather than the length of the fiber.
+    returns: tuple (runlengths, startpositions, values)"""
+    starts = np.clip(np.concatenate([simple_starts, hmm_starts]), 0, length)
+    ends = np.clip(np.concatenate([simple_ends, hmm_ends]), 0, length)
+    is_simple = np.arange(starts.shape[0]) < len(simple_starts)
+    # painting an empty or reversed slice does nothing
+    keep = ends > starts
+    starts, ends, is_simple = starts[keep], ends[keep], is_simple[keep]
+
+    # elementary segments between all the interval boundaries
+    bounds = np.unique(np.concatenate([[0, length], starts, ends]).astype(D_TYPE))
+    seg_starts = bounds[:-1]
+    in_simple = covered(seg_starts, starts[is_simple], ends[is_simple])
+    in_hmm = covered(seg_starts, starts[~is_simple], ends[~is_simple])
+    labels = np.where(in_simple, 1, np.where(in_hmm, 2, 0)).astype(D_TYPE)
+
+    # join neighboring segments with the same label into runs
+    new_run = np.ones(labels.shape[0], dtype=bool)
+    new_run[1:] = labels[1:] != labels[:-1]
+    run_index = seg_starts[new_run]
+    run_length = np.diff(np.append(run_index, length))
+    return (run_length, run_index, labels[new_run])
+
+
 def rle(inarray):
     """run length encoding. Partial credit to R rle function.
     Multi datatype arrays catered for including non Numpy
@@ -537,11 +907,17 @@ def rle(inarray):
 
 def main():
     args = parse()
-    bam = pysam.AlignmentFile(args.bam, threads=args.threads, check_sq=False)
+    htslib_threads, processes = split_threads(args.threads)
+    if args.model is None:
+        # the records are all read before training, so htslib gets every thread
+        htslib_threads = args.threads
+    bam = pysam.AlignmentFile(args.bam, threads=htslib_threads, check_sq=False)
     if args.model is None:
         training_set = []
         for idx, rec in enumerate(bam.fetch(until_eof=True)):
-            mods, _AT_pos, _m6a_pos = get_mods_from_rec(rec, mask=True)
+            mods, _AT_pos, _m6a_pos = get_mods_from_rec(
+                rec, mask=True, min_ml=args.min_ml_score
+            )
             if mods is None:
                 continue
             training_set.append(mods)
@@ -552,10 +928,41 @@ def main():
         with args.out as handle:
             handle.write(json_model)
     else:
+        profile = Profile(args.profile)
         out = pysam.AlignmentFile(args.out, "wb", template=bam)
-        hmm = pom.HiddenMarkovModel().from_json(args.model)
-        _actuated_label, nucleated_label = assign_states(hmm)
-        apply_hmm(bam, hmm, nucleated_label, args.cutoff, out, min_dist=args.min_dist)
+        hmm = read_hmm_json(args.model)
+        _actuated_label, nucleated_label = assign_states_from_emissions(hmm[2])
+        if processes > 1:
+            apply_hmm_parallel(
+                bam,
+                hmm,
+                nucleated_label,
+                args.cutoff,
+                out,
+                processes,
+                min_dist=args.min_dist,
+                batch_size=args.batch_size,
+                viterbi=args.viterbi,
+                min_ml=args.min_ml_score,
+                profile=profile,
+            )
+        else:
+            numba.set_num_threads(1)
+            apply_hmm(
+                bam,
+                hmm,
+                nucleated_label,
+                args.cutoff,
+                out,
+                min_dist=args.min_dist,
+                batch_size=args.batch_size,
+                viterbi=args.viterbi,
+                min_ml=args.min_ml_score,
+                profile=profile,
+            )
+        with profile.stage("write"):
+            out.close()
+        profile.write()
 
     return 0
 
@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+import argparse
+import logging
+import os
+import tempfile
+import numpy as np
+import pandas as pd
+import tqdm
+from numba import njit
+from fiber_density import read_fai
+
+# positions to prefix sum at a time when writing runs
+RUN_CHUNK = 1 << 24
+
+
+@njit
+def add_blocks(diff, starts, ends):
+    """Add one over [start, end) of each block to the difference array."""
+    for i in range(starts.shape[0]):
+        diff[starts[i]] += 1
+        diff[ends[i]] -= 1
+
+
+def genome_offsets(contig_lengths):
+    """Offset of each contig in a flat difference array over the genome,
+    with one extra slot per contig for the ends of blocks at its last base.
+    returns: dict of contig to offset, and the size of the array"""
+    offsets = {}
+    size = 0
+    for contig, length in contig_lengths.items():
+        offsets[contig] = size
+        size += length + 1
+    return offsets, size
+
+
+def bed12_blocks(bed, chunksize=100_000):
+    """Yield (contigs, starts, ends) of the blocks in each block of rows of a
+    bed12 file, in reference coordinates."""
+    for chunk in pd.read_csv(
+        bed,
+        sep="\t",
+        header=None,
+        usecols=[0, 1, 10, 11],
+        names=["ct", "st", "sizes", "starts"],
+        dtype={"ct": str, "st": np.int64, "sizes": str, "starts": str},
+        comment="#",
+        chunksize=chunksize,
+    ):
+        # lists may end with a comma
+        sizes = chunk["sizes"].str.rstrip(",")
+        starts = chunk["starts"].str.rstrip(",")
+        counts = starts.str.count(",").to_numpy() + 1
+        block_starts = np.repeat(chunk["st"].to_numpy(), counts) + np.fromstring(
+            ",".join(starts), dtype=np.int64, sep=","
+        )
+        block_sizes = np.fromstring(",".join(sizes), dtype=np.int64, sep=",")
+        yield (
+            np.repeat(chunk["ct"].to_numpy(), counts),
+            block_starts,
+            block_starts + block_sizes,
+        )
+
+
+def count_blocks(blocks, diff, offsets, contig_lengths):
+    """Accumulate the blocks into the flat difference array, clipping them
+    to the contig and skipping those on contigs that are not in the fai."""
+    missing = set()
+    for contigs, starts, ends in blocks:
+        contig_idx = pd.Series(contigs)
+        offset = contig_idx.map(offsets).to_numpy()
+        length = contig_idx.map(contig_lengths).to_numpy()
+        keep = ~np.isnan(offset)
+        for contig in set(contigs[~keep]) - missing:
+            logging.warning(f"Skipping blocks on {contig}, not in the fai.")
+            missing.add(contig)
+        offset = offset[keep].astype(np.int64)
+        length = length[keep].astype(np.int64)
+        starts = np.clip(starts[keep], 0, length) + offset
+        ends = np.clip(ends[keep], 0, length) + offset
+        add_blocks(diff, starts, ends)
+
+
+def coverage_runs(diff, chunk_size=RUN_CHUNK):
+    """Yield (starts, ends, depths) of the runs of equal, non zero coverage
+    from the difference array of one contig, a chunk of positions at a time."""
+    length = diff.shape[0] - 1
+    run_start, run_depth, depth = 0, 0, 0
+    for st in range(0, length, chunk_size):
+        cov = np.cumsum(diff[st : min(st + chunk_size, length)], dtype=np.int64)
+        cov += depth
+        depth = cov[-1]
+        prev = np.empty_like(cov)
+        prev[0] = run_depth
+        prev[1:] = cov[:-1]
+        change = np.flatnonzero(cov != prev)
+        if change.shape[0] == 0:
+            continue
+        starts = np.concatenate(([run_start], st + change[:-1]))
+        ends = st + change
+        depths = np.concatenate(([run_depth], cov[change[:-1]]))
+        run_start, run_depth = st + change[-1], cov[change[-1]]
+        nonzero = depths != 0
+        yield starts[nonzero], ends[nonzero], depths[nonzero]
+    if run_depth != 0:
+        yield (
+            np.array([run_start], dtype=np.int64),
+            np.array([length], dtype=np.int64),
+            np.array([run_depth], dtype=np.int64),
+        )
+
+
+@njit
+def _write_int(buf, n, value):
+    start = n
+    while True:
+        buf[n] = ord("0") + value % 10
+        n += 1
+        value //= 10
+        if value == 0:
+            break
+    buf[start:n] = buf[start:n][::-1].copy()
+    return n
+
+
+@njit
+def format_runs(prefix, starts, ends, depths):
+    """ASCII bytes of the bedGraph lines of runs, each starting with prefix,
+    the contig name and a tab."""
+    buf = np.empty(starts.shape[0] * (prefix.shape[0] + 3 * 21), dtype=np.uint8)
+    n = 0
+    for i in range(starts.shape[0]):
+        buf[n : n + prefix.shape[0]] = prefix
+        n += prefix.shape[0]
+        n = _write_int(buf, n, starts[i])
+        buf[n] = ord("\t")
+        n = _write_int(buf, n + 1, ends[i])
+        buf[n] = ord("\t")
+        n = _write_int(buf, n + 1, depths[i])
+        buf[n] = ord("\n")
+        n += 1
+    return buf[:n]
+
+
+def write_bedgraph(out, diff, offsets, contig_lengths):
+    """Write the coverage of every contig as bedGraph, sorted by contig name
+    and start as bedGraphToBigWig expects."""
+    n_runs = 0
+    for contig in tqdm.tqdm(sorted(contig_lengths)):
+        offset = offsets[contig]
+        prefix = np.frombuffer(f"{contig}\t".encode(), dtype=np.uint8)
+        contig_diff = diff[offset : offset + contig_lengths[contig] + 1]
+        for starts, ends, depths in coverage_runs(contig_diff):
+            out.write(format_runs(prefix, starts, ends, depths).tobytes())
+            n_runs += starts.shape[0]
+    logging.debug(f"Wrote {n_runs} coverage runs.")
+
+
+def parse():
+    """Coverage of the blocks of a bed12 file as a sorted bedGraph."""
+    parser = argparse.ArgumentParser(
+        description="Compute the coverage of the blocks of a bed12 file, as "
+        "bedtools genomecov -split -bg does, in one pass over the bed. The "
+        "bedGraph is written sorted by contig name and start, ready for "
+        "bedGraphToBigWig.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("fai", help="Fasta index of the reference.")
+    parser.add_argument("bed", help="bed12 file, in any order.")
+    parser.add_argument("out", help="Output bedGraph.")
+    parser.add_argument(
+        "--chunksize",
+        help="Number of bed rows to read at a time.",
+        type=int,
+        default=100_000,
+    )
+    parser.add_argument(
+        "--max-memory-mb",
+        help="Keep the coverage of genomes larger than this in a memory-mapped "
+        "file instead of in memory (4 bytes per base).",
+        type=int,
+        default=4096,
+    )
+    parser.add_argument(
+        "--tmp-dir",
+        help="Directory for the memory-mapped file, by default the directory "
+        "of the output.",
+    )
+    parser.add_argument(
+        "-v", "--verbose", help="increase logging verbosity", action="store_true"
+    )
+    args = parser.parse_args()
+    log_format = "[%(levelname)s][Time elapsed (ms) %(relativeCreated)d]: %(message)s"
+    log_level = logging.DEBUG if args.verbose else logging.WARNING
+    logging.basicConfig(format=log_format, level=log_level)
+    return args
+
+
+def main():
+    args = parse()
+    contig_lengths = read_fai(args.fai)
+    offsets, size = genome_offsets(contig_lengths)
+    tmp_dir = args.tmp_dir or os.path.dirname(os.path.abspath(args.out))
+    with tempfile.TemporaryDirectory(dir=tmp_dir) as tmp_dir:
+        if size * 4 > args.max_memory_mb * 1024 * 1024:
+            logging.debug(f"Memory mapping coverage of {size} bases in {tmp_dir}")
+            diff = np.memmap(
+                os.path.join(tmp_dir, "coverage.i32"),
+                dtype=np.int32,
+                mode="w+",
+                shape=(size,),
+            )
+        else:
+            diff = np.zeros(size, dtype=np.int32)
+        blocks = bed12_blocks(args.bed, chunksize=args.chunksize)
+        count_blocks(tqdm.tqdm(blocks), diff, offsets, contig_lengths)
+        with open(args.out, "wb") as out:
+            write_bedgraph(out, diff, offsets, contig_lengths)
+        del diff
+    return 0
+
+
+if __name__ == "__main__":
+    main()
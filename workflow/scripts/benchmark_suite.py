@@ -0,0 +1,421 @@
+#!/usr/bin/env python3
+import argparse
+import array
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import git
+import numpy as np
+import pysam
+import add_nucleosomes as an
+import extract_bed_from_bam as ebb
+import liftover as lift
+from ipd_cache import save_ipd_cache
+from mod_tags import encode_mods
+
+SCRIPTS = os.path.dirname(os.path.abspath(__file__))
+BASES = np.frombuffer(b"ACGT", dtype=np.uint8)
+COMPLEMENT = bytes.maketrans(b"ACGT", b"TGCA")
+CONTIG_LENGTH = 50_000_000
+NUC_LENGTH = 147
+# scale name: (number of fibers, mean read length)
+SCALES = {
+    "tiny": (20, 5_000),
+    "small": (200, 10_000),
+    "medium": (1_000, 15_000),
+    "large": (5_000, 18_000),
+}
+
+
+def synthetic_fiber(rng, read_length, m6a_density, cpg_density=0.7):
+    """A random fiber with nucleosomes separated by 20-80 bp linkers.
+    m6A is called on m6a_density of the linker A/Ts and 1/20th as many
+    nucleosomal ones, and 5mC on cpg_density of the CpGs.
+    returns: sequence, m6A positions, 5mC positions, nucleosome starts"""
+    seq = BASES[rng.integers(0, 4, read_length)]
+    nuc_starts = [int(rng.integers(0, 100))]
+    while nuc_starts[-1] + NUC_LENGTH < read_length:
+        nuc_starts.append(nuc_starts[-1] + NUC_LENGTH + int(rng.integers(20, 80)))
+    nuc_starts = np.array(nuc_starts[:-1], dtype=np.int64)
+    in_nuc = np.zeros(read_length + 1, dtype=np.int64)
+    np.add.at(in_nuc, nuc_starts, 1)
+    np.add.at(in_nuc, nuc_starts + NUC_LENGTH, -1)
+    in_nuc = np.cumsum(in_nuc)[:-1] > 0
+
+    is_at = (seq == ord("A")) | (seq == ord("T"))
+    m6a_rate = np.where(in_nuc, m6a_density / 20, m6a_density)
+    m6a = np.flatnonzero(is_at & (rng.random(read_length) < m6a_rate))
+    is_cpg = (seq[:-1] == ord("C")) & (seq[1:] == ord("G"))
+    cpg = np.flatnonzero(is_cpg & (rng.random(read_length - 1) < cpg_density))
+    return seq, m6a, cpg, nuc_starts
+
+
+def synthetic_cigar(rng, read_length):
+    """Match blocks of 200-2000 bp separated by 1-3 bp insertions or deletions."""
+    cigar = []
+    remaining = read_length
+    while remaining > 0:
+        match = min(remaining, int(rng.integers(200, 2000)))
+        cigar.append((pysam.CMATCH, match))
+        remaining -= match
+        if remaining > 5:
+            indel = int(rng.integers(1, 4))
+            if rng.random() < 0.5:
+                cigar.append((pysam.CINS, indel))
+                remaining -= indel
+            else:
+                cigar.append((pysam.CDEL, indel))
+    return cigar
+
+
+def synthetic_record(rng, header, idx, read_length, m6a_density, aligned):
+    seq, m6a, cpg, nuc_starts = synthetic_fiber(rng, read_length, m6a_density)
+    mm, ml = encode_mods(seq, m6a, rng.integers(200, 256, m6a.shape[0]))
+    cpg_mm, cpg_ml = encode_mods(
+        seq, cpg, rng.integers(0, 256, cpg.shape[0]), mods=[("C", "C+m")]
+    )
+    # linkers between the nucleosomes, tags are in the molecule's orientation
+    acc_starts = nuc_starts[:-1] + NUC_LENGTH
+    acc_lengths = nuc_starts[1:] - acc_starts
+
+    rec = pysam.AlignedSegment(header)
+    rec.query_name = f"m1/{idx}/ccs"
+    sequence = seq.tobytes()
+    rec.flag = 4
+    if aligned:
+        rec.flag = 16 if rng.random() < 0.5 else 0
+        if rec.is_reverse:
+            sequence = sequence.translate(COMPLEMENT)[::-1]
+        rec.reference_id = int(rng.integers(0, len(header.references)))
+        rec.reference_start = int(rng.integers(0, CONTIG_LENGTH - 2 * read_length))
+        rec.mapping_quality = 60
+        rec.cigartuples = synthetic_cigar(rng, read_length)
+    rec.query_sequence = sequence.decode()
+    rec.set_tag("MM", mm + cpg_mm, "Z")
+    rec.set_tag("ML", ml + cpg_ml)
+    rec.set_tag("ec", float(rng.integers(3, 30)), "f")
+    rec.set_tag("ns", array.array("I", nuc_starts))
+    rec.set_tag("nl", array.array("I", np.full(nuc_starts.shape, NUC_LENGTH)))
+    rec.set_tag("as", array.array("I", acc_starts))
+    rec.set_tag("al", array.array("I", acc_lengths))
+    return rec
+
+
+def write_fiber_bam(
+    file, n_fibers, read_length, m6a_density=0.3, aligned=False, seed=42
+):
+    """Write a bam of synthetic fibers with MM/ML, ec, and ns/nl/as/al tags.
+    Read lengths are drawn uniformly from 0.5x to 1.5x read_length. Aligned
+    bams are coordinate sorted and indexed."""
+    rng = np.random.default_rng(seed)
+    sq = [{"SN": f"chr{i+1}", "LN": CONTIG_LENGTH} for i in range(2)] if aligned else []
+    header = pysam.AlignmentHeader.from_dict(
+        {"HD": {"VN": "1.6", "SO": "coordinate" if aligned else "unknown"}, "SQ": sq}
+    )
+    lengths = rng.integers(read_length // 2, 3 * read_length // 2, n_fibers)
+    recs = [
+        synthetic_record(rng, header, idx, int(length), m6a_density, aligned)
+        for idx, length in enumerate(lengths)
+    ]
+    if aligned:
+        recs.sort(key=lambda rec: (rec.reference_id, rec.reference_start))
+    with pysam.AlignmentFile(file, "wb", header=header) as out:
+        for rec in recs:
+            out.write(rec)
+    if aligned:
+        pysam.index(file)
+    return int(lengths.sum())
+
+
+def write_ipd_cache(bam_file, file, seed=42):
+    """Write an ipd_cache.py npz for the fibers in an unaligned bam with the
+    ipdRatios of m6A and other A/Ts drawn from a high and a low lognormal."""
+    rng = np.random.default_rng(seed)
+    names, tpls, ipds = [], [], []
+    with pysam.AlignmentFile(bam_file, check_sq=False) as bam:
+        for rec in bam.fetch(until_eof=True):
+            _binary, at_positions, m6a = an.get_mods_from_rec(rec)
+            is_m6a = np.isin(at_positions, m6a)
+            names.append(rec.query_name)
+            # ipdSummary positions are one based
+            tpls.append(at_positions + 1)
+            ipds.append(
+                np.where(
+                    is_m6a,
+                    rng.lognormal(np.log(3), 0.4, is_m6a.shape[0]),
+                    rng.lognormal(np.log(0.8), 0.5, is_m6a.shape[0]),
+                )
+            )
+    offsets = np.zeros(len(names) + 1, dtype=np.int64)
+    np.cumsum([tpl.shape[0] for tpl in tpls], out=offsets[1:])
+    coverage = [np.full(tpl.shape, 10) for tpl in tpls]
+    save_ipd_cache(file, names, offsets, tpls, ipds, coverage)
+
+
+def write_hmm_json(file):
+    """A two state pomegranate json model with an actuated and a nucleated state."""
+    emissions = [{"0": 0.4, "1": 0.6}, {"0": 0.95, "1": 0.05}]
+    states = [
+        {
+            "class": "State",
+            "name": f"s{i}",
+            "distribution": {
+                "name": "DiscreteDistribution",
+                "dtype": "int",
+                "parameters": [emission],
+            },
+        }
+        for i, emission in enumerate(emissions)
+    ]
+    states += [
+        {"class": "State", "name": "None-start", "distribution": None},
+        {"class": "State", "name": "None-end", "distribution": None},
+    ]
+    edges = [[2, 0, 0.5], [2, 1, 0.5], [0, 0, 0.9], [0, 1, 0.1]]
+    edges += [[1, 1, 0.99], [1, 0, 0.01]]
+    model = {
+        "class": "HiddenMarkovModel",
+        "name": "synthetic",
+        "states": states,
+        "start_index": 2,
+        "end_index": 3,
+        "edges": [edge + [1, None] for edge in edges],
+    }
+    with open(file, "w") as out:
+        json.dump(model, out)
+
+
+def commit_hash(short=7):
+    try:
+        repo = git.Repo(SCRIPTS, search_parent_directories=True)
+    except git.exc.InvalidGitRepositoryError:
+        return None
+    return repo.git.rev_parse(repo.head.commit.hexsha, short=short)
+
+
+def time_it(func, repeats, warm_up=True):
+    """Time func repeats times, after one untimed run to compile any numba code."""
+    if warm_up:
+        func()
+    times = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - started)
+    return {"seconds": min(times), "median_seconds": float(np.median(times))}
+
+
+def time_script(command, repeats):
+    """Time a script end to end, numba compilation included."""
+
+    def run():
+        subprocess.run(
+            command, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+
+    return time_it(run, repeats, warm_up=False)
+
+
+def micro_benchmarks(bam_file, aligned_file, hmm_file, repeats, cutoff=65):
+    with pysam.AlignmentFile(bam_file, check_sq=False) as bam:
+        recs = list(bam.fetch(until_eof=True))
+    with pysam.AlignmentFile(aligned_file) as bam:
+        aligned_recs = list(bam.fetch(until_eof=True))
+    mods = [an.get_mods_from_rec(rec, mask=True) for rec in recs]
+    hmm = an.read_hmm_json(hmm_file)
+    state_paths = an.decode_fibers([binary for binary, _, _ in mods], hmm)
+    simple_calls = [an.simpleFind(meth, binary, cutoff) for binary, _, meth in mods]
+    nucs = [ebb.get_nucleosomes(rec) for rec in recs]
+    aligned_pairs = [lift.get_aligned_pairs(rec) for rec in aligned_recs]
+    aligned_nucs = [ebb.get_nucleosomes(rec) for rec in aligned_recs]
+
+    def mesh_methods():
+        for (starts, sizes, _), (ns, nl), rec, (_, _, meth) in zip(
+            simple_calls, nucs, recs, mods
+        ):
+            an.meshMethods(starts, sizes, ns, nl, meth, rec.query_length, cutoff)
+
+    def liftover():
+        for rec, pairs, (ns, nl) in zip(aligned_recs, aligned_pairs, aligned_nucs):
+            lift.liftover_helper(pairs, ns, ns + nl, rec.query_length, rec.is_reverse)
+
+    def bed_blocks():
+        for rec, (ns, nl) in zip(recs, nucs):
+            ebb.make_bed_blocks(ns, nl, np.int64(0), np.int64(rec.query_length))
+
+    benchmarks = {
+        "get_mods_from_rec": lambda: [an.get_mods_from_rec(rec) for rec in recs],
+        "simpleFind": lambda: [
+            an.simpleFind(meth, binary, cutoff) for binary, _, meth in mods
+        ],
+        "decode_fibers": lambda: an.decode_fibers([m[0] for m in mods], hmm),
+        "rle": lambda: [an.rle(path) for path in state_paths],
+        "meshMethods": mesh_methods,
+        "get_aligned_pairs": lambda: [
+            lift.get_aligned_pairs(rec) for rec in aligned_recs
+        ],
+        "liftover_helper": liftover,
+        "make_bed_blocks": bed_blocks,
+    }
+    results = {}
+    for name, func in benchmarks.items():
+        results[name] = time_it(func, repeats)
+        logging.info(f"{name}: {results[name]['seconds']:.4f} s")
+    return results
+
+
+def script_benchmarks(bam_file, aligned_file, npz_file, hmm_file, tmp, repeats):
+    def script(name):
+        return [sys.executable, os.path.join(SCRIPTS, name)]
+
+    beds = ["-m", f"{tmp}/m6a.bed", "-c", f"{tmp}/cpg.bed"]
+    beds += ["-n", f"{tmp}/nuc.bed", "-a", f"{tmp}/msp.bed"]
+    commands = {
+        "add_nucleosomes.py": script("add_nucleosomes.py")
+        + ["-m", hmm_file, bam_file, f"{tmp}/nuc.bam"],
+        "push_m6a_to_bam.py": script("push_m6a_to_bam.py")
+        + [npz_file, bam_file, "-o", f"{tmp}/gmm.bam"],
+        "extract_bed_from_bam.py": script("extract_bed_from_bam.py")
+        + [bam_file]
+        + beds,
+        "extract_bed_from_bam.py --reference": script("extract_bed_from_bam.py")
+        + [aligned_file, "--reference"]
+        + beds,
+    }
+    results = {}
+    for name, command in commands.items():
+        results[name] = time_script(command, repeats)
+        logging.info(f"{name}: {results[name]['seconds']:.2f} s")
+    return results
+
+
+def run_scale(scale, tmp, args):
+    n_fibers, read_length = SCALES[scale]
+    bam_file = f"{tmp}/{scale}.bam"
+    aligned_file = f"{tmp}/{scale}.aligned.bam"
+    hmm_file = f"{tmp}/hmm.json"
+    bases = write_fiber_bam(bam_file, n_fibers, read_length, seed=args.seed)
+    write_fiber_bam(aligned_file, n_fibers, read_length, aligned=True, seed=args.seed)
+    write_hmm_json(hmm_file)
+    logging.info(f"Made {n_fibers:,} synthetic fibers with {bases:,} bases")
+    results = {"fibers": n_fibers, "bases": bases}
+    results["functions"] = micro_benchmarks(
+        bam_file, aligned_file, hmm_file, args.repeats
+    )
+    if not args.skip_scripts:
+        npz_file = f"{tmp}/{scale}.npz"
+        write_ipd_cache(bam_file, npz_file, seed=args.seed)
+        results["scripts"] = script_benchmarks(
+            bam_file, aligned_file, npz_file, hmm_file, tmp, args.script_repeats
+        )
+    return results
+
+
+def compare_to_baseline(results, baseline, tolerance):
+    """Log the speed of each benchmark relative to the baseline.
+    returns: number of benchmarks more than tolerance slower than the baseline"""
+    regressions = 0
+    for scale, scale_results in results["scales"].items():
+        for kind in ["functions", "scripts"]:
+            old_results = baseline["scales"].get(scale, {}).get(kind, {})
+            for name, result in scale_results.get(kind, {}).items():
+                if name not in old_results:
+                    continue
+                ratio = result["seconds"] / old_results[name]["seconds"]
+                message = f"{scale} {name}: {ratio:.2f}x the baseline time"
+                if ratio > 1 + tolerance:
+                    regressions += 1
+                    logging.warning(f"Regression in {message}")
+                else:
+                    logging.info(message)
+    return regressions
+
+
+def parse():
+    """Time the fiberseq scripts on synthetic fibers."""
+    parser = argparse.ArgumentParser(
+        description="Benchmark the python scripts on synthetic fiber-seq bams and store the timings as a json baseline.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        "-o", "--out", help="Output json with the timings.", default=sys.stdout
+    )
+    parser.add_argument(
+        "-s",
+        "--scales",
+        help="Sizes of the synthetic data to benchmark.",
+        nargs="+",
+        choices=SCALES.keys(),
+        default=["tiny", "small"],
+    )
+    parser.add_argument(
+        "-b",
+        "--baseline",
+        help="json from a previous run to compare the timings to.",
+        default=None,
+    )
+    parser.add_argument(
+        "--tolerance",
+        help="Fraction slower than the baseline that counts as a regression.",
+        type=float,
+        default=0.25,
+    )
+    parser.add_argument(
+        "-r", "--repeats", help="Times to run each function.", type=int, default=5
+    )
+    parser.add_argument(
+        "--script-repeats", help="Times to run each script.", type=int, default=1
+    )
+    parser.add_argument(
+        "--skip-scripts",
+        help="Only time the functions and not the end to end scripts.",
+        action="store_true",
+    )
+    parser.add_argument("--seed", help="Random seed.", type=int, default=42)
+    parser.add_argument(
+        "-v", "--verbose", help="increase logging verbosity", action="store_true"
+    )
+    args = parser.parse_args()
+    log_format = "[%(levelname)s][Time elapsed (ms) %(relativeCreated)d]: %(message)s"
+    log_level = logging.DEBUG if args.verbose else logging.INFO
+    logging.basicConfig(format=log_format, level=log_level)
+    return args
+
+
+def main():
+    args = parse()
+    results = {
+        "commit": commit_hash(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "cpus": os.cpu_count(),
+        "scales": {},
+    }
+    with tempfile.TemporaryDirectory() as tmp:
+        for scale in args.scales:
+            logging.info(f"Running the {scale} benchmarks")
+            results["scales"][scale] = run_scale(scale, tmp, args)
+
+    if args.out is sys.stdout:
+        json.dump(results, sys.stdout, indent=2)
+    else:
+        with open(args.out, "w") as out:
+            json.dump(results, out, indent=2)
+
+    if args.baseline is not None:
+        with open(args.baseline) as handle:
+            regressions = compare_to_baseline(
+                results, json.load(handle), args.tolerance
+            )
+        if regressions > 0:
+            sys.exit(f"{regressions} benchmarks regressed")
+    return 0
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,35 @@
+#!/usr/bin/env python3
+import os
+import shutil
+
+# empty block that ends every BGZF file
+BGZF_EOF = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+# bytes to copy at a time when appending parts
+COPY_SIZE = 1 << 20
+# most threads htslib gets for BGZF (de)compression next to a process pool
+MAX_HTSLIB_THREADS = 2
+
+
+def append_part(out, part, bgzip=False):
+    """Stream the file part onto the open binary file out and remove it. With
+    bgzip the empty block that ends a BGZF part is truncated off first, so
+    the parts join into one BGZF file that the caller ends with BGZF_EOF."""
+    with open(part, "r+b") as handle:
+        if bgzip:
+            size = handle.seek(0, os.SEEK_END)
+            if size >= len(BGZF_EOF):
+                handle.seek(size - len(BGZF_EOF))
+                if handle.read() == BGZF_EOF:
+                    handle.truncate(size - len(BGZF_EOF))
+            handle.seek(0)
+        shutil.copyfileobj(handle, out, COPY_SIZE)
+    os.remove(part)
+
+
+def split_threads(threads):
+    """Split a thread budget between htslib's BGZF (de)compression in the main
+    process and a pool of worker processes, so the two do not oversubscribe
+    the cpus. htslib gets a quarter of the threads, at most MAX_HTSLIB_THREADS.
+    returns: (htslib threads, worker processes)"""
+    htslib = min(MAX_HTSLIB_THREADS, threads // 4)
+    return max(htslib, 1), max(threads - htslib, 1)
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+import argparse
+import logging
+import numpy as np
+import pandas as pd
+import pysam
+import tqdm
+from cpg_index import load_cpg_index
+from fiber_density import WRITE_SIZE, write_bgzf_parts
+
+
+def table_calls(table, chunksize=100_000):
+    """Yield (contigs, starts, ends, counts, calls) from each block of rows of
+    a fiber table that are aligned, with the reference positions of the 5mC
+    calls of all the fibers concatenated and counts the calls of each fiber."""
+    for chunk in pd.read_csv(
+        table,
+        sep="\t",
+        usecols=["#ct", "st", "en", "ref_5mC"],
+        dtype=str,
+        chunksize=chunksize,
+    ):
+        st = pd.to_numeric(chunk["st"], errors="coerce").to_numpy()
+        en = pd.to_numeric(chunk["en"], errors="coerce").to_numpy()
+        aligned = ~np.isnan(st) & ~np.isnan(en) & (st != en)
+        chunk, st, en = chunk[aligned], st[aligned], en[aligned]
+        if chunk.shape[0] == 0:
+            continue
+        # lists end with a comma, and unlifted calls are -1
+        calls = chunk["ref_5mC"].fillna(".").str.rstrip(",")
+        calls = calls.where(calls != ".", "")
+        counts = np.where(calls == "", 0, calls.str.count(",") + 1)
+        yield (
+            chunk["#ct"].to_numpy(),
+            st.astype(np.int64),
+            en.astype(np.int64),
+            counts,
+            np.fromstring(",".join(calls[counts > 0]), dtype=np.int64, sep=","),
+        )
+
+
+def count_cpgs(fibers, cpgs):
+    """Count, for every CpG, the fibers that span its C or G and the 5mC
+    calls on its C or G.
+    returns: dict of contig to call and fiber counts per CpG"""
+    counts = {}
+    missing = set()
+    for contigs, starts, ends, n_calls, calls in fibers:
+        call_contigs = np.repeat(contigs, n_calls)
+        for contig in np.unique(contigs):
+            if contig not in cpgs:
+                if contig not in missing:
+                    logging.warning(f"Skipping fibers on {contig}, not in the index.")
+                    missing.add(contig)
+                continue
+            positions = cpgs[contig].astype(np.int64)
+            n = positions.shape[0]
+            if contig not in counts:
+                counts[contig] = (
+                    np.zeros(n, dtype=np.int32),
+                    np.zeros(n + 1, dtype=np.int32),
+                )
+            num, den_diff = counts[contig]
+            on_contig = contigs == contig
+            # CpGs at st - 1 through en - 1 overlap the fiber
+            los = np.searchsorted(positions, starts[on_contig] - 1, side="left")
+            his = np.searchsorted(positions, ends[on_contig], side="left")
+            den_diff += np.bincount(los, minlength=n + 1).astype(np.int32)
+            den_diff -= np.bincount(his, minlength=n + 1).astype(np.int32)
+            # a call is on at most one CpG, at the call or the base before
+            on_contig = call_contigs == contig
+            contig_calls = calls[on_contig]
+            contig_calls = contig_calls[contig_calls >= 0]
+            idxs = np.searchsorted(positions, contig_calls - 1, side="left")
+            in_range = idxs < n
+            idxs, contig_calls = idxs[in_range], contig_calls[in_range]
+            hits = positions[idxs] <= contig_calls
+            num += np.bincount(idxs[hits], minlength=n).astype(np.int32)
+    return counts
+
+
+def write_cpgs(task):
+    """Write the calls over the fibers at each CpG of one contig to a BGZF
+    file, as numerator/denominator and proportion."""
+    contig, positions, num, den_diff, part = task
+    if num is None:
+        num = den = np.zeros(positions.shape[0], dtype=np.int32)
+    else:
+        den = np.cumsum(den_diff)[:-1]
+    with pysam.BGZFile(part, "wb") as out:
+        for st in range(0, positions.shape[0], WRITE_SIZE):
+            lines = [
+                f"{contig}\t{pos}\t{pos + 1}\t{n}/{d}\t{n / d if d > 0 else 0:.6g}\n"
+                for pos, n, d in zip(
+                    positions[st : st + WRITE_SIZE].tolist(),
+                    num[st : st + WRITE_SIZE].tolist(),
+                    den[st : st + WRITE_SIZE].tolist(),
+                )
+            ]
+            out.write("".join(lines).encode())
+    return part
+
+
+def parse():
+    """Proportion of the fibers spanning each CpG with a 5mC call."""
+    parser = argparse.ArgumentParser(
+        description="Count the fibers of a fiber table that span each CpG of "
+        "a CpG index and the 5mC calls on its C or G, and write them as a "
+        "bgzipped bed of chrom, start, end, calls/fibers, and proportion, as "
+        "cpg-methylation-proportion.sh does.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("fai", help="Fasta index of the reference.")
+    parser.add_argument("index", help="CpG index from cpg_index.py.")
+    parser.add_argument("table", help="Fiber table from ft extract --all.")
+    parser.add_argument("out", help="Output bgzipped bed.")
+    parser.add_argument(
+        "--chunksize",
+        help="Number of fiber table rows to read at a time.",
+        type=int,
+        default=100_000,
+    )
+    parser.add_argument("-t", "--threads", help="n threads to use", type=int, default=1)
+    parser.add_argument(
+        "-v", "--verbose", help="increase logging verbosity", action="store_true"
+    )
+    args = parser.parse_args()
+    log_format = "[%(levelname)s][Time elapsed (ms) %(relativeCreated)d]: %(message)s"
+    log_level = logging.DEBUG if args.verbose else logging.WARNING
+    logging.basicConfig(format=log_format, level=log_level)
+    return args
+
+
+def main():
+    args = parse()
+    cpgs = load_cpg_index(args.index, fai=args.fai)
+    fibers = table_calls(args.table, chunksize=args.chunksize)
+    counts = count_cpgs(tqdm.tqdm(fibers), cpgs)
+    tasks = [
+        (contig, cpgs[contig]) + counts.get(contig, (None, None))
+        for contig in sorted(cpgs)
+    ]
+    write_bgzf_parts(args.out, write_cpgs, tasks, threads=args.threads)
+    return 0
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+import argparse
+import hashlib
+import logging
+import os
+import numpy as np
+import pysam
+import tqdm
+from ipd_cache import load_ipd_cache
+
+
+def fai_checksum(fai):
+    """md5 of a fasta index, which changes with the names, lengths, and
+    layout of the contigs of the reference."""
+    with open(fai, "rb") as handle:
+        return hashlib.md5(handle.read()).hexdigest()
+
+
+def find_cpgs(sequence):
+    """Sorted positions of the C of every CpG in a sequence, ignoring case.
+    returns: uint32 array"""
+    seq = np.frombuffer(sequence.upper().encode(), dtype=np.uint8)
+    return np.flatnonzero((seq[:-1] == ord("C")) & (seq[1:] == ord("G"))).astype(
+        np.uint32
+    )
+
+
+def build_cpg_index(fasta, out):
+    """Write the CpG positions of every contig of an indexed fasta to an
+    uncompressed npz with the checksum of its .fai. Contig i has CpGs
+    positions[offsets[i]:offsets[i+1]]."""
+    positions = [np.zeros(0, dtype=np.uint32)]
+    with pysam.FastaFile(fasta) as ref:
+        contigs = list(ref.references)
+        for contig in tqdm.tqdm(contigs):
+            positions.append(find_cpgs(ref.fetch(contig)))
+    offsets = np.zeros(len(contigs) + 1, dtype=np.int64)
+    np.cumsum([cpgs.shape[0] for cpgs in positions[1:]], out=offsets[1:])
+    # write to a temporary file so a partial index is never reused
+    tmp = f"{out}.tmp.npz"
+    np.savez(
+        tmp,
+        checksum=np.array(fai_checksum(f"{fasta}.fai")),
+        contigs=np.array(contigs, dtype=str),
+        offsets=offsets,
+        positions=np.concatenate(positions),
+    )
+    os.replace(tmp, out)
+    logging.debug(f"Indexed {offsets[-1]:,} CpGs on {len(contigs):,} contigs")
+
+
+def load_cpg_index(file, fai=None):
+    """Memory map a CpG index, checking that it was built for the reference
+    with index fai if one is given.
+    returns: dict of contig to sorted uint32 CpG positions"""
+    index = load_ipd_cache(file)
+    if fai is not None and str(index["checksum"][()]) != fai_checksum(fai):
+        raise ValueError(f"{file} was not built for the reference indexed by {fai}")
+    offsets = index["offsets"]
+    return {
+        str(contig): index["positions"][offsets[idx] : offsets[idx + 1]]
+        for idx, contig in enumerate(index["contigs"])
+    }
+
+
+def write_cpg_bed(cpgs, out, step=1_000_000):
+    """Write the C of every CpG as a bgzipped bed sorted like sort-bed."""
+    with pysam.BGZFile(out, "wb") as handle:
+        for contig in sorted(cpgs):
+            positions = cpgs[contig]
+            for st in range(0, positions.shape[0], step):
+                lines = [
+                    f"{contig}\t{pos}\t{pos + 1}\n"
+                    for pos in positions[st : st + step].tolist()
+                ]
+                handle.write("".join(lines).encode())
+
+
+def parse():
+    """Build or reuse the index of the CpGs in a reference."""
+    parser = argparse.ArgumentParser(
+        description="Index the CpG positions of a reference in a memory "
+        "mappable npz, keyed by the checksum of the .fai of the reference. An "
+        "existing index that matches the .fai is reused.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("ref", help="Reference fasta with a .fai index.")
+    parser.add_argument("index", help="CpG index npz to build or reuse.")
+    parser.add_argument(
+        "-b", "--bed", help="Also write the CpGs as a bgzipped bed to this file."
+    )
+    parser.add_argument(
+        "-v", "--verbose", help="increase logging verbosity", action="store_true"
+    )
+    args = parser.parse_args()
+    log_format = "[%(levelname)s][Time elapsed (ms) %(relativeCreated)d]: %(message)s"
+    log_level = logging.DEBUG if args.verbose else logging.WARNING
+    logging.basicConfig(format=log_format, level=log_level)
+    return args
+
+
+def main():
+    args = parse()
+    fai = f"{args.ref}.fai"
+    cpgs = None
+    if os.path.exists(args.index):
+        try:
+            cpgs = load_cpg_index(args.index, fai=fai)
+            logging.debug(f"Reusing the CpG index in {args.index}")
+        except ValueError as error:
+            logging.warning(f"{error}, rebuilding it.")
+    if cpgs is None:
+        build_cpg_index(args.ref, args.index)
+        cpgs = load_cpg_index(args.index, fai=fai)
+    if args.bed is not None:
+        write_cpg_bed(cpgs, args.bed)
+    return 0
+
+
+if __name__ == "__main__":
+    main()
@@ -3,27 +3,39 @@ import pysam
 import numpy as np
 import argparse
 import logging
+import multiprocessing as mp
+import os
+import tempfile
+import zipfile
 from numba import njit
 import tqdm
+from profiling import Profile, NO_PROFILE
+from bgzf import BGZF_EOF, append_part
+from ipd_cache import load_ipd_cache
+from mod_tags import MIN_ML_SCORE, join_ints, mod_binary, mods_to_arrays
+from liftover import get_aligned_pairs, liftover_batch
 
 # C+m
 CPG_MODS = [("C", 0, "m")]
 M6A_MODS = [("A", 0, "a"), ("T", 1, "a")]
 D_TYPE = np.int64
+# output bed12 files, in the order they are written for each fiber
+TRACKS = ("nuc", "msp", "m6a", "cpg")
+# bytes of bed12 lines to buffer per output
+BUFFER_SIZE = 1 << 20
 
 
-def get_mod_pos_from_rec(rec, mods=M6A_MODS):
-    if rec.modified_bases_forward is None:
+def get_mod_pos_from_rec(rec, mods=M6A_MODS, min_ml=0):
+    """Sorted positions of the mods in the orientation of the sequenced
+    molecule, skipping calls with an ML score below min_ml."""
+    binary = mod_binary(rec, mods_to_arrays(mods), min_ml=min_ml)
+    if binary is None:
         return None
-    positions = []
-    for mod in mods:
-        if mod in rec.modified_bases_forward:
-            pos = np.array(rec.modified_bases_forward[mod], dtype=D_TYPE)[:, 0]
-            positions.append(pos)
-    if len(positions) < 1:
+    mod_positions = np.flatnonzero(binary).astype(D_TYPE)
+    if mod_positions.shape[0] < 1:
         return None
-    mod_positions = np.concatenate(positions, dtype=D_TYPE)
-    mod_positions.sort(kind="mergesort")
+    if rec.is_reverse:
+        mod_positions = (rec.query_length - 1 - mod_positions)[::-1]
     return mod_positions
 
 
@@ -43,143 +55,417 @@ def get_accessible(rec):
     return get_start_length_tags(rec, start_tag="as", length_tag="al")
 
 
-# len = 7
-# 0|1|2|3|4|5|6
-# 6|5|4|3|2|1|0
-# rev comp [1,5) = [2,6)
-# new_st = len(7) - old_en(5)
-# new_en = len(7) - old_st(1)
 @njit
-def liftover_helper(aligned_pairs, sts, ens, query_length, is_reverse=False):
-    read_pos = aligned_pairs[:, 0]
-    ref_pos = aligned_pairs[:, 1]
-
-    # flip positison if reversed
-    if is_reverse:
-        new_st = query_length - ens
-        new_en = query_length - sts
-        sts = new_st[::-1]
-        ens = new_en[::-1]
-
-    # search of closest matching index
-    st_idxs = np.searchsorted(read_pos, sts, side="left")
-    en_idxs = np.searchsorted(read_pos, ens, side="left")
-    ## remove things that are past the end of the read
-    st_idxs[st_idxs >= ref_pos.shape[0]] = ref_pos.shape[0] - 1
-    en_idxs[en_idxs >= ref_pos.shape[0]] = ref_pos.shape[0] - 1
-    # get the ref positions
-    ref_sts = ref_pos[st_idxs]
-    ref_ens = ref_pos[en_idxs]
-
-    # remove zero length liftovers (past start or end of alignment)
-    keep_idx = ref_ens - ref_sts > 0
-    # if (~keep_idx).any():
-    #    logging.debug(f"removing {(~keep_idx).sum()} zero length liftovers.")
-    return ref_sts[keep_idx], ref_ens[keep_idx]
-
-
-def liftover(rec, sts, ens, aligned_pairs=None):
-    if aligned_pairs is None:
-        aligned_pairs = np.array(rec.get_aligned_pairs(matches_only=True), dtype=D_TYPE)
-    return liftover_helper(
-        aligned_pairs,
-        sts,
-        ens,
-        rec.query_length,
-        is_reverse=rec.is_reverse,
-    )
+def make_bed_blocks(starts, lengths, st, en):
+    """bed12 blocks with 1bp blocks added at the start and end of the fiber
+    if they are not covered.
+    returns: block count, and the blockStarts and blockSizes as ASCII bytes"""
+    head = 1 if starts[0] != 0 else 0
+    tail = 1 if starts[-1] + lengths[-1] != en - st else 0
+    bc = starts.shape[0] + head + tail
+    b_starts = np.empty(bc, dtype=starts.dtype)
+    b_lengths = np.empty(bc, dtype=lengths.dtype)
+    if head:
+        b_starts[0] = 0
+        b_lengths[0] = 1
+    b_starts[head : head + starts.shape[0]] = starts
+    b_lengths[head : head + starts.shape[0]] = lengths
+    if tail:
+        b_starts[-1] = en - st - 1
+        b_lengths[-1] = 1
+    return bc, join_ints(b_starts), join_ints(b_lengths)
+
+
+def get_features(rec, tracks, min_ml=0):
+    """The features of the fiber for each of tracks as (starts, lengths) in
+    the orientation of the molecule, with lengths None for single base calls.
+    Tracks the fiber has no features for are left out."""
+    features = {}
+    if "nuc" in tracks:
+        features["nuc"] = get_nucleosomes(rec)
+    if "msp" in tracks:
+        features["msp"] = get_accessible(rec)
+    if "m6a" in tracks:
+        features["m6a"] = (
+            get_mod_pos_from_rec(rec, mods=M6A_MODS, min_ml=min_ml),
+            None,
+        )
+    if "cpg" in tracks:
+        features["cpg"] = (
+            get_mod_pos_from_rec(rec, mods=CPG_MODS, min_ml=min_ml),
+            None,
+        )
+    return {
+        track: feature for track, feature in features.items() if feature[0] is not None
+    }
 
 
-@njit
-def make_bed_blocks(starts, lengths, st, en):
-    o_starts = ""
-    o_lengths = ""
-    bc = 0
-    if starts[0] != 0:
-        o_starts += "0,"
-        o_lengths += "1,"
-        bc += 1
-    for b_st, b_ln in zip(starts, lengths):
-        o_starts += str(b_st) + ","
-        o_lengths += str(b_ln) + ","
-        bc += 1
-    if starts[-1] + lengths[-1] != en:
-        o_starts += str(en - st - 1) + ","
-        o_lengths += "1,"
-        bc += 1
-    return bc, o_starts[:-1], o_lengths[:-1]
-
-
-def write_bed12(rec, starts, output, lengths=None, aligned_pairs=None):
-    if starts is None:
-        return
+def write_bed12(rec, features, outputs, aligned_pairs=None, region=None):
+    """Write one bed12 line per track for the fiber, with its features as
+    blocks. With aligned_pairs the features of all the tracks are lifted over
+    to the reference together, and with region (contig, start, end) the fiber
+    and its blocks are clipped to it. outputs are binary files."""
     strand = "-" if rec.is_reverse else "+"
     passes = round(rec.get_tag("ec"))
     rgb = "0,0,0"
 
     if aligned_pairs is None:
         ct, st, en = rec.query_name, np.int64(0), np.int64(rec.query_length)
+        blocks = {
+            track: (
+                starts,
+                np.ones(starts.shape, dtype=D_TYPE) if lengths is None else lengths,
+            )
+            for track, (starts, lengths) in features.items()
+        }
     else:
         ct, st, en = (
             rec.reference_name,
             np.int64(rec.reference_start),
             np.int64(rec.reference_end),
         )
-    # add lengths if none are provided
-    if lengths is None:
-        lengths = np.ones(starts.shape, dtype=D_TYPE)
+        if region is not None:
+            st, en = max(st, np.int64(region[1])), min(en, np.int64(region[2]))
+            if st >= en:
+                return
+        blocks = {}
+        lifted = liftover_batch(rec, features, aligned_pairs=aligned_pairs)
+        for track, (l_sts, l_ens) in lifted.items():
+            if region is not None:
+                keep = (l_ens > st) & (l_sts < en)
+                l_sts = np.maximum(l_sts[keep], st)
+                l_ens = np.minimum(l_ens[keep], en)
+            blocks[track] = (l_sts - st, l_ens - l_sts)
+
+    # the same bed 6 and thick start and end for every track
+    prefix = (
+        f"{ct}\t{st}\t{en}\t{rec.query_name}\t{passes}\t{strand}\t"
+        f"{st}\t{en}\t{rgb}\t"
+    ).encode()
+    for track, (starts, lengths) in blocks.items():
+        if starts.shape[0] == 0:
+            continue
+        assert (
+            starts + lengths > en
+        ).sum() == 0, f"Blocks exceed end position of bed12\n{starts}\n{lengths}\n{en}"
 
-    if aligned_pairs is not None:
-        l_sts, l_ens = liftover(
-            rec, starts, starts + lengths, aligned_pairs=aligned_pairs
+        bc, bs, bl = make_bed_blocks(starts, lengths, st, en)
+        if bs[0] != ord("0"):
+            logging.warning("First block start is not 0")
+            continue
+        # bed 12
+        outputs[track].write(
+            b"".join((prefix, b"%d\t" % bc, bl.tobytes(), b"\t", bs.tobytes(), b"\n"))
         )
-        l_len = l_ens - l_sts
-        l_sts -= st
-        starts = l_sts
-        lengths = l_len
-
-    assert (
-        starts + lengths > en
-    ).sum() == 0, f"Blocks exceed end position of bed12\n{starts}\n{lengths}\n{en}"
-
-    bc, bs, bl = make_bed_blocks(starts, lengths, st, en)
-    if bs[0] != "0":
-        logging.warning("First block start is not 0")
-        return
-
-    # write bed 6
-    output.write(f"{ct}\t{st}\t{en}\t{rec.query_name}\t{passes}\t{strand}\t")
-    # think start and end
-    output.write(f"{st}\t{en}\t{rgb}\t")
-    # bed 12
-    output.write(f"{bc}\t{bl}\t{bs}\n")
 
 
-def extract(bam, args):
-    for rec in tqdm.tqdm(bam.fetch(until_eof=True)):
+class FiberStore:
+    """Columnar store of the fibers and all their features, written as an
+    uncompressed npz that load_fiber_store memory maps. Per fiber it has
+    names, query_length, is_reverse, ec, and with reference contig (index
+    into contigs, -1 if unmapped), ref_start, and ref_end. Each track in
+    TRACKS has ragged int32 arrays where fiber i has rows
+    {track}_offsets[i]:{track}_offsets[i+1] of {track}_starts, and for nuc and
+    msp {track}_lengths, in molecular coordinates. With reference they also
+    have {track}_ref_starts and {track}_ref_ends in the same order, -1 where
+    a feature does not lift over. Columns are streamed to raw files in a
+    temporary directory next to file as fibers are added, so memory does not
+    grow with the number of fibers, and copied into file by write."""
+
+    def __init__(self, file, contigs, reference=False):
+        self.file = file
+        self.contigs = list(contigs)
+        self.reference = reference
+        self.tmp_dir = tempfile.TemporaryDirectory(
+            dir=os.path.dirname(os.path.abspath(file))
+        )
+        self.dtypes = {
+            "query_length": np.dtype(np.int64),
+            "is_reverse": np.dtype(bool),
+            "ec": np.dtype(np.float32),
+        }
+        if reference:
+            for column in ("contig", "ref_start", "ref_end"):
+                self.dtypes[column] = np.dtype(np.int64)
+        for track in TRACKS:
+            self.dtypes[f"{track}_offsets"] = np.dtype(np.int64)
+            columns = ["starts"]
+            if track in ("nuc", "msp"):
+                columns.append("lengths")
+            if reference:
+                columns += ["ref_starts", "ref_ends"]
+            for column in columns:
+                self.dtypes[f"{track}_{column}"] = np.dtype(np.int32)
+        self.handles = {
+            column: open(self._path(column), "wb", buffering=BUFFER_SIZE)
+            for column in self.dtypes
+        }
+        self.sizes = dict.fromkeys(self.dtypes, 0)
+        self.names = open(self._path("names"), "w", buffering=BUFFER_SIZE)
+        self.name_width = 1
+        self.n_fibers = 0
+        self.n_features = dict.fromkeys(TRACKS, 0)
+        for track in TRACKS:
+            self._extend(f"{track}_offsets", [0])
+
+    def _path(self, column):
+        return os.path.join(self.tmp_dir.name, column)
+
+    def _extend(self, column, values):
+        values = np.asarray(values, dtype=self.dtypes[column])
+        self.handles[column].write(values.tobytes())
+        self.sizes[column] += values.shape[0]
+
+    def add(self, rec, features, aligned_pairs=None):
+        """Add the fiber with features from get_features for all of TRACKS."""
+        self.names.write(rec.query_name + "\n")
+        self.name_width = max(self.name_width, len(rec.query_name))
+        self.n_fibers += 1
+        self._extend("query_length", [rec.query_length])
+        self._extend("is_reverse", [rec.is_reverse])
+        self._extend("ec", [rec.get_tag("ec")])
+        lifted = {}
+        if self.reference:
+            mapped = not rec.is_unmapped
+            self._extend("contig", [rec.reference_id if mapped else -1])
+            self._extend("ref_start", [rec.reference_start if mapped else -1])
+            self._extend("ref_end", [rec.reference_end if mapped else -1])
+            if mapped:
+                lifted = liftover_batch(
+                    rec, features, aligned_pairs=aligned_pairs, drop=False
+                )
+        for track in TRACKS:
+            starts, lengths = features.get(track, (np.zeros(0, dtype=D_TYPE), None))
+            self.n_features[track] += starts.shape[0]
+            self._extend(f"{track}_offsets", [self.n_features[track]])
+            self._extend(f"{track}_starts", starts)
+            if track in ("nuc", "msp"):
+                self._extend(f"{track}_lengths", lengths if lengths is not None else [])
+            if self.reference:
+                missing = np.full(starts.shape[0], -1)
+                ref_starts, ref_ends = lifted.get(track, (missing, missing))
+                self._extend(f"{track}_ref_starts", ref_starts)
+                self._extend(f"{track}_ref_ends", ref_ends)
+
+    def _write_npy(self, zf, name, dtype, shape, chunks):
+        header = {"descr": np.lib.format.dtype_to_descr(dtype)}
+        header.update(fortran_order=False, shape=shape)
+        with zf.open(f"{name}.npy", "w", force_zip64=True) as out:
+            np.lib.format.write_array_header_2_0(out, header)
+            for chunk in chunks:
+                out.write(chunk)
+
+    def _raw_chunks(self, column):
+        with open(self._path(column), "rb") as handle:
+            yield from iter(lambda: handle.read(BUFFER_SIZE), b"")
+
+    def _name_chunks(self, step=100_000):
+        with open(self._path("names")) as handle:
+            names = []
+            for name in handle:
+                names.append(name[:-1])
+                if len(names) >= step:
+                    yield np.array(names, dtype=f"U{self.name_width}").tobytes()
+                    names = []
+            yield np.array(names, dtype=f"U{self.name_width}").tobytes()
+
+    def write(self):
+        """Copy the columns into the npz at exactly self.file."""
+        for handle in self.handles.values():
+            handle.close()
+        self.names.close()
+        contigs = np.array(self.contigs, dtype=str)
+        with zipfile.ZipFile(self.file, "w", zipfile.ZIP_STORED) as zf:
+            self._write_npy(
+                zf,
+                "names",
+                np.dtype(f"U{self.name_width}"),
+                (self.n_fibers,),
+                self._name_chunks(),
+            )
+            self._write_npy(
+                zf, "contigs", contigs.dtype, contigs.shape, [contigs.tobytes()]
+            )
+            for column, dtype in self.dtypes.items():
+                self._write_npy(
+                    zf, column, dtype, (self.sizes[column],), self._raw_chunks(column)
+                )
+        self.tmp_dir.cleanup()
+        logging.debug(f"Stored {self.n_fibers:,} fibers in {self.file}")
+
+
+def load_fiber_store(file):
+    """Memory map the arrays of a FiberStore.
+    returns: dict of array name to read only np.memmap"""
+    return load_ipd_cache(file)
+
+
+def parse_region(region, header):
+    """samtools style region, e.g. chr1:1,001-2,000 or chr1, as a 0-based half
+    open (contig, start, end)."""
+    if region in header.references:
+        return region, 0, header.get_reference_length(region)
+    contig, _, span = region.rpartition(":")
+    if contig not in header.references:
+        raise ValueError(f"Contig of region {region} is not in the bam header.")
+    length = header.get_reference_length(contig)
+    start, _, end = span.replace(",", "").partition("-")
+    start = int(start) - 1 if start else 0
+    end = int(end) if end else length
+    return contig, max(start, 0), min(end, length)
+
+
+def read_regions_bed(bed, header):
+    regions = []
+    with open(bed) as handle:
+        for line in handle:
+            if line.startswith(("#", "track", "browser")) or not line.strip():
+                continue
+            contig, start, end = line.split("\t")[:3]
+            if contig not in header.references:
+                logging.warning(f"Skipping region on {contig}, not in the bam header.")
+                continue
+            regions.append((contig, int(start), int(end)))
+    return regions
+
+
+def merge_regions(regions):
+    """Sort regions by contig name and start, the order of sort -k1,1 -k2,2n,
+    and merge the ones that overlap or touch."""
+    merged = []
+    for contig, start, end in sorted(regions):
+        if merged and merged[-1][0] == contig and start <= merged[-1][2]:
+            merged[-1] = (contig, merged[-1][1], max(end, merged[-1][2]))
+        else:
+            merged.append((contig, start, end))
+    return merged
+
+
+def fetch_records(bam, regions=None, clip=False):
+    """Yield (rec, region) for every record in the bam, or through the index
+    for the records overlapping sorted, merged regions. Without clip a fiber
+    spanning several regions is only yielded for the first, and region is
+    None so it is written whole."""
+    if regions is None:
+        for rec in bam.fetch(until_eof=True):
+            yield rec, None
+        return
+    previous = (None, 0)
+    for region in regions:
+        contig, start, end = region
+        for rec in bam.fetch(contig, start, end):
+            if clip:
+                yield rec, region
+            elif contig != previous[0] or rec.reference_start >= previous[1]:
+                yield rec, None
+        previous = (contig, end)
+
+
+def extract(
+    records, outputs, reference=False, min_ml=0, store=None, profile=NO_PROFILE
+):
+    """Write the bed12 lines for each (rec, region) in records to the outputs,
+    a dict from a name in TRACKS to a binary file, and add the fibers to
+    store if it is a FiberStore."""
+    tracks = TRACKS if store is not None else outputs
+    records = profile.iterate(records, "read")
+    for rec, region in records:
         aligned_pairs = None
-        if args.reference and rec.is_unmapped:
+        # unmapped fibers have no reference bed12 lines but are still stored
+        unmapped = reference and rec.is_unmapped
+        if unmapped and store is None:
             continue
-        if args.reference:
-            aligned_pairs = np.array(
-                rec.get_aligned_pairs(matches_only=True), dtype=D_TYPE
-            )
-
-        if args.nuc is not None:
-            ns, nl = get_nucleosomes(rec)
-            write_bed12(rec, ns, args.nuc, lengths=nl, aligned_pairs=aligned_pairs)
-            # break
-        if args.msp is not None:
-            msp_s, msp_l = get_accessible(rec)
+        profile.count(fibers=1, bases=rec.query_length)
+        if reference and not unmapped:
+            with profile.stage("aligned_pairs"):
+                aligned_pairs = get_aligned_pairs(rec)
+        with profile.stage("parse"):
+            features = get_features(rec, tracks, min_ml=min_ml)
+        if store is not None:
+            with profile.stage("store"):
+                store.add(rec, features, aligned_pairs=aligned_pairs)
+            if unmapped:
+                continue
+            features = {
+                track: feature
+                for track, feature in features.items()
+                if track in outputs
+            }
+        with profile.stage("bed12"):
             write_bed12(
-                rec, msp_s, args.msp, lengths=msp_l, aligned_pairs=aligned_pairs
+                rec, features, outputs, aligned_pairs=aligned_pairs, region=region
             )
-        if args.m6a is not None:
-            mod_pos = get_mod_pos_from_rec(rec, mods=M6A_MODS)
-            write_bed12(rec, mod_pos, args.m6a, aligned_pairs=aligned_pairs)
-        if args.cpg is not None:
-            mod_pos = get_mod_pos_from_rec(rec, mods=CPG_MODS)
-            write_bed12(rec, mod_pos, args.cpg, aligned_pairs=aligned_pairs)
+
+
+def open_output(file, bgzip=False):
+    if bgzip:
+        return pysam.BGZFile(file, "wb")
+    return open(file, "wb", buffering=BUFFER_SIZE)
+
+
+def index_outputs(files):
+    """Tabix index sorted, BGZF compressed bed12 files."""
+    for file in files:
+        pysam.tabix_index(file, preset="bed", force=True)
+
+
+WORKER = {}
+
+
+def init_worker(bam_file, tracks, reference, min_ml, clip, bgzip, tmp_dir):
+    WORKER["bam"] = pysam.AlignmentFile(bam_file, check_sq=False)
+    WORKER["args"] = (tracks, reference, min_ml, clip, bgzip, tmp_dir)
+
+
+def extract_contig_worker(task):
+    """Extract the regions of one contig into temporary files.
+    returns: the temporary file for each track, and the fibers and bases read"""
+    idx, regions = task
+    tracks, reference, min_ml, clip, bgzip, tmp_dir = WORKER["args"]
+    files = {track: os.path.join(tmp_dir, f"{idx}.{track}.bed") for track in tracks}
+    outputs = {track: open_output(file, bgzip) for track, file in files.items()}
+    profile = Profile(os.devnull)
+    records = fetch_records(WORKER["bam"], regions, clip=clip)
+    extract(records, outputs, reference=reference, min_ml=min_ml, profile=profile)
+    for output in outputs.values():
+        output.close()
+    return files, profile.fibers, profile.bases
+
+
+def extract_parallel(
+    bam_file,
+    outputs,
+    regions,
+    processes,
+    reference=False,
+    min_ml=0,
+    clip=False,
+    bgzip=False,
+    profile=NO_PROFILE,
+):
+    """Extract each contig of the sorted regions in its own worker process and
+    concatenate the results in the order of the regions into the binary
+    outputs. With bgzip the workers compress their own output and the parts
+    are joined without their end of file blocks."""
+    tasks = []
+    for idx, region in enumerate(regions):
+        if idx > 0 and region[0] == regions[idx - 1][0]:
+            tasks[-1][1].append(region)
+        else:
+            tasks.append((len(tasks), [region]))
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        init_args = (bam_file, list(outputs), reference, min_ml, clip, bgzip, tmp_dir)
+        with mp.Pool(processes, initializer=init_worker, initargs=init_args) as pool:
+            results = pool.imap(extract_contig_worker, tasks)
+            results = profile.iterate(tqdm.tqdm(results, total=len(tasks)), "workers")
+            for files, fibers, bases in results:
+                profile.count(fibers=fibers, bases=bases)
+                with profile.stage("merge"):
+                    for track, file in files.items():
+                        append_part(outputs[track], file, bgzip=bgzip)
+    if bgzip:
+        for output in outputs.values():
+            output.write(BGZF_EOF)
 
 
 def parse():
@@ -194,25 +480,34 @@ def parse():
         "-m",
         "--m6a",
         help="Output m6a bed12.",
-        type=argparse.FileType("w"),
+        type=argparse.FileType("wb", BUFFER_SIZE),
     )
     parser.add_argument(
         "-c",
         "--cpg",
         help="Output CpG bed12.",
-        type=argparse.FileType("w"),
+        type=argparse.FileType("wb", BUFFER_SIZE),
     )
     parser.add_argument(
         "-n",
         "--nuc",
         help="Output nucleosomes in bed12.",
-        type=argparse.FileType("w"),
+        type=argparse.FileType("wb", BUFFER_SIZE),
     )
     parser.add_argument(
         "-a",
         "--msp",
         help="Output accessible stretches (MSPs) in bed12.",
-        type=argparse.FileType("w"),
+        type=argparse.FileType("wb", BUFFER_SIZE),
+    )
+    parser.add_argument(
+        "-s",
+        "--store",
+        help="Output a columnar fiber store (npz) of all the features of every "
+        "fiber in molecular, and with --reference, reference coordinates. "
+        "It is written to exactly this path and can be memory mapped with "
+        "load_fiber_store.",
+        default=None,
     )
     parser.add_argument(
         "-r",
@@ -220,11 +515,64 @@ def parse():
         help="Make output bed12 files use reference coordinates.",
         action="store_true",
     )
+    parser.add_argument(
+        "--region",
+        help="Only extract fibers overlapping this samtools style region, "
+        "e.g. chr1:1,000,001-2,000,000. Can be given more than once and needs "
+        "an indexed bam.",
+        action="append",
+        default=None,
+    )
+    parser.add_argument(
+        "--regions-bed",
+        help="Only extract fibers overlapping the regions in this bed file. "
+        "Needs an indexed bam.",
+        default=None,
+    )
+    parser.add_argument(
+        "--clip",
+        help="Clip fibers and their features to the regions. Needs --reference.",
+        action="store_true",
+    )
+    parser.add_argument(
+        "-p",
+        "--processes",
+        help="Extract each contig in its own process and merge the output in "
+        "sorted order. Needs an indexed bam, and unmapped reads are skipped.",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "-z",
+        "--bgzip",
+        help="Write coordinate sorted, BGZF compressed, and tabix indexed bed12 "
+        "files that are ready for tabix and bedToBigBed without sorting. "
+        "Needs --reference and an indexed bam.",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--min-ml-score",
+        help="Skip m6A and CpG calls with an ML score below this, as with the "
+        "pipeline's min_ml_score and ft extract.",
+        type=int,
+        default=MIN_ML_SCORE,
+    )
+    parser.add_argument(
+        "--profile",
+        help="Write time per stage, throughput, and peak memory to this json file.",
+        default=None,
+    )
     parser.add_argument("-t", "--threads", help="n threads to use", type=int, default=4)
     parser.add_argument(
         "-v", "--verbose", help="increase logging verbosity", action="store_true"
     )
     args = parser.parse_args()
+    if args.clip and not args.reference:
+        parser.error("--clip needs --reference")
+    if args.bgzip and not args.reference:
+        parser.error("--bgzip needs --reference")
+    if args.store is not None and (args.processes > 1 or args.clip):
+        parser.error("--store is written by one process without --clip")
     log_format = "[%(levelname)s][Time elapsed (ms) %(relativeCreated)d]: %(message)s"
     log_level = logging.DEBUG if args.verbose else logging.WARNING
     logging.basicConfig(format=log_format, level=log_level)
@@ -233,8 +581,71 @@ def parse():
 
 def main():
     args = parse()
+    profile = Profile(args.profile)
     bam = pysam.AlignmentFile(args.bam, threads=args.threads, check_sq=False)
-    extract(bam, args)
+    outputs = {
+        track: getattr(args, track)
+        for track in TRACKS
+        if getattr(args, track) is not None
+    }
+    files = {track: output.name for track, output in outputs.items()}
+    regions = None
+    if args.region is not None or args.regions_bed is not None:
+        regions = [parse_region(region, bam.header) for region in args.region or []]
+        if args.regions_bed is not None:
+            regions += read_regions_bed(args.regions_bed, bam.header)
+        regions = merge_regions(regions)
+    elif args.processes > 1 or args.bgzip:
+        # whole contigs in sorted order
+        regions = merge_regions(
+            (contig, 0, bam.get_reference_length(contig)) for contig in bam.references
+        )
+    if args.bgzip:
+        if "<stdout>" in files.values():
+            raise ValueError("--bgzip can not write to stdout.")
+        for output in outputs.values():
+            output.close()
+        if args.processes > 1:
+            # the workers compress and their parts are joined as bytes
+            outputs = {track: open(file, "wb") for track, file in files.items()}
+        else:
+            outputs = {
+                track: open_output(file, bgzip=True) for track, file in files.items()
+            }
+    if args.processes > 1:
+        extract_parallel(
+            args.bam,
+            outputs,
+            regions,
+            args.processes,
+            reference=args.reference,
+            min_ml=args.min_ml_score,
+            clip=args.clip,
+            bgzip=args.bgzip,
+            profile=profile,
+        )
+    else:
+        store = None
+        if args.store is not None:
+            store = FiberStore(args.store, bam.references, reference=args.reference)
+        records = tqdm.tqdm(fetch_records(bam, regions, clip=args.clip))
+        extract(
+            records,
+            outputs,
+            reference=args.reference,
+            min_ml=args.min_ml_score,
+            store=store,
+            profile=profile,
+        )
+        if store is not None:
+            with profile.stage("store"):
+                store.write()
+    for output in outputs.values():
+        output.close()
+    if args.bgzip:
+        with profile.stage("index"):
+            index_outputs(files.values())
+    profile.write()
 
 
 if __name__ == "__main__":
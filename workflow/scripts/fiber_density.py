@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+import argparse
+import contextlib
+import logging
+import multiprocessing as mp
+import os
+import tempfile
+import numpy as np
+import pandas as pd
+import pysam
+import tqdm
+from bgzf import BGZF_EOF, append_part
+
+# (min length, max length, min length of the numerator) of the features in
+# each window, as in msp-proportion.sh and di-nucleosome-proportion.sh
+FEATURES = {"msp": (1, None, 150), "nuc": (80, 1000, 300)}
+# lines per write when formatting windows
+WRITE_SIZE = 100_000
+
+
+def read_fai(fai):
+    """Contig lengths from a fasta index, in the order of the index."""
+    lengths = {}
+    with open(fai) as handle:
+        for line in handle:
+            contig, length = line.split("\t")[:2]
+            lengths[contig] = int(length)
+    return lengths
+
+
+def n_windows(length, step):
+    """Windows are the 1bp elements at step * k - 1 for k >= 1 that are
+    before the last base of the contig, as from bedops --chop 1 --stagger."""
+    return max((length - 2) // step, 0)
+
+
+def table_features(table, feature, chunksize=100_000):
+    """Yield (contigs, starts, lengths) of the features with reference
+    coordinates from each block of rows of a fiber table."""
+    starts_col, lengths_col = f"ref_{feature}_starts", f"ref_{feature}_lengths"
+    for chunk in pd.read_csv(
+        table,
+        sep="\t",
+        usecols=["#ct", starts_col, lengths_col],
+        dtype=str,
+        chunksize=chunksize,
+    ):
+        chunk = chunk[chunk[starts_col].notna() & (chunk[starts_col] != ".")]
+        # lists end with a comma
+        starts = chunk[starts_col].str.rstrip(",")
+        chunk = chunk[starts != ""]
+        if chunk.shape[0] == 0:
+            continue
+        starts = starts[starts != ""]
+        lengths = chunk[lengths_col].str.rstrip(",")
+        counts = starts.str.count(",").to_numpy() + 1
+        yield (
+            np.repeat(chunk["#ct"].to_numpy(), counts),
+            np.fromstring(",".join(starts), dtype=np.int64, sep=","),
+            np.fromstring(",".join(lengths), dtype=np.int64, sep=","),
+        )
+
+
+def add_windows(diff, los, his, step):
+    """Add one to the difference array over windows for every window k with
+    lo <= step * k - 1 < hi."""
+    k_los = np.clip(-(-(los + 1) // step), 1, diff.shape[0] - 1)
+    k_his = np.clip(-(-(his + 1) // step), 1, diff.shape[0] - 1)
+    diff += np.bincount(k_los, minlength=diff.shape[0]).astype(diff.dtype)
+    diff -= np.bincount(k_his, minlength=diff.shape[0]).astype(diff.dtype)
+
+
+def count_windows(
+    features,
+    contig_lengths,
+    window=100,
+    step=50,
+    min_length=1,
+    max_length=None,
+    numerator_length=150,
+):
+    """Count the features overlapping each window +/- window bp by at least
+    1bp, in the denominator if their length is in [min_length, max_length]
+    and also in the numerator if it is at least numerator_length.
+    returns: dict of contig to numerator and denominator difference arrays"""
+    diffs = {}
+    missing = set()
+    for contigs, starts, lengths in features:
+        keep = (starts >= 0) & (lengths >= max(min_length, 1))
+        if max_length is not None:
+            keep &= lengths <= max_length
+        contigs, starts, lengths = contigs[keep], starts[keep], lengths[keep]
+        for contig in np.unique(contigs):
+            if contig not in contig_lengths:
+                if contig not in missing:
+                    logging.warning(f"Skipping features on {contig}, not in the fai.")
+                    missing.add(contig)
+                continue
+            if contig not in diffs:
+                size = n_windows(contig_lengths[contig], step) + 2
+                diffs[contig] = (
+                    np.zeros(size, dtype=np.int32),
+                    np.zeros(size, dtype=np.int32),
+                )
+            num_diff, den_diff = diffs[contig]
+            on_contig = contigs == contig
+            los = starts[on_contig] - window
+            his = starts[on_contig] + lengths[on_contig] + window
+            add_windows(den_diff, los, his, step)
+            numerator = lengths[on_contig] >= numerator_length
+            add_windows(num_diff, los[numerator], his[numerator], step)
+    return diffs
+
+
+def write_windows(task):
+    """Prefix sum the difference arrays of one contig and write its windows
+    as numerator/denominator and proportion to a BGZF file."""
+    contig, length, step, num_diff, den_diff, part = task
+    size = n_windows(length, step)
+    if num_diff is None:
+        num = den = np.zeros(size, dtype=np.int32)
+    else:
+        num = np.cumsum(num_diff)[1:-1]
+        den = np.cumsum(den_diff)[1:-1]
+    ends = step * np.arange(1, size + 1)
+    with pysam.BGZFile(part, "wb") as out:
+        for st in range(0, size, WRITE_SIZE):
+            lines = [
+                f"{contig}\t{en - 1}\t{en}\t{n}/{d}\t{n / d if d > 0 else 0:.6g}\n"
+                for en, n, d in zip(
+                    ends[st : st + WRITE_SIZE].tolist(),
+                    num[st : st + WRITE_SIZE].tolist(),
+                    den[st : st + WRITE_SIZE].tolist(),
+                )
+            ]
+            out.write("".join(lines).encode())
+    return part
+
+
+def write_bgzf_parts(out, write_part, tasks, threads=1):
+    """Run write_part on each task, with the path of a BGZF part appended to
+    the task, in a pool of threads processes and concatenate the parts in
+    the order of the tasks as one BGZF file."""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tasks = [
+            task + (os.path.join(tmp_dir, f"{idx}.bed.gz"),)
+            for idx, task in enumerate(tasks)
+        ]
+        pool = mp.Pool(threads) if threads > 1 else contextlib.nullcontext()
+        with pool, open(out, "wb") as handle:
+            parts = (
+                pool.imap(write_part, tasks) if threads > 1 else map(write_part, tasks)
+            )
+            for part in tqdm.tqdm(parts, total=len(tasks)):
+                append_part(handle, part, bgzip=True)
+            handle.write(BGZF_EOF)
+
+
+def write_proportions(out, diffs, contig_lengths, step=50, threads=1):
+    """Write the windows of every contig in sorted order as one BGZF file,
+    formatting and compressing each contig in a pool of threads processes."""
+    contigs = sorted(contig for contig, length in contig_lengths.items() if length > 0)
+    tasks = [
+        (contig, contig_lengths[contig], step) + diffs.get(contig, (None, None))
+        for contig in contigs
+    ]
+    write_bgzf_parts(out, write_windows, tasks, threads=threads)
+
+
+def parse():
+    """Proportion of long MSPs or di-nucleosomes in sliding windows."""
+    parser = argparse.ArgumentParser(
+        description="Count the MSPs or nucleosome footprints of a fiber table "
+        "that overlap windows staggered along the reference, and write the "
+        "proportion that are long MSPs (>=150bp) or di-nucleosomes (>=300bp) "
+        "as a bgzipped bed of chrom, start, end, numerator/denominator, and "
+        "proportion, as msp-proportion.sh and di-nucleosome-proportion.sh do.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("feature", help="Features to count.", choices=list(FEATURES))
+    parser.add_argument("fai", help="Fasta index of the reference.")
+    parser.add_argument("table", help="Fiber table from ft extract --all.")
+    parser.add_argument("out", help="Output bgzipped bed.")
+    parser.add_argument(
+        "-w",
+        "--window",
+        help="Count features within +/- this many bp.",
+        type=int,
+        default=100,
+    )
+    parser.add_argument(
+        "-s", "--step", help="Distance between windows.", type=int, default=50
+    )
+    parser.add_argument(
+        "--min-length",
+        help="Skip features shorter than this, 1 for msp and 80 for nuc by default.",
+        type=int,
+    )
+    parser.add_argument(
+        "--max-length",
+        help="Skip features longer than this, 1000 for nuc by default.",
+        type=int,
+    )
+    parser.add_argument(
+        "--numerator-length",
+        help="Count features at least this long in the numerator, "
+        "150 for msp and 300 for nuc by default.",
+        type=int,
+    )
+    parser.add_argument(
+        "--chunksize",
+        help="Number of fiber table rows to read at a time.",
+        type=int,
+        default=100_000,
+    )
+    parser.add_argument("-t", "--threads", help="n threads to use", type=int, default=1)
+    parser.add_argument(
+        "-v", "--verbose", help="increase logging verbosity", action="store_true"
+    )
+    args = parser.parse_args()
+    defaults = FEATURES[args.feature]
+    for option, default in zip(
+        ("min_length", "max_length", "numerator_length"), defaults
+    ):
+        if getattr(args, option) is None:
+            setattr(args, option, default)
+    log_format = "[%(levelname)s][Time elapsed (ms) %(relativeCreated)d]: %(message)s"
+    log_level = logging.DEBUG if args.verbose else logging.WARNING
+    logging.basicConfig(format=log_format, level=log_level)
+    return args
+
+
+def main():
+    args = parse()
+    contig_lengths = read_fai(args.fai)
+    features = table_features(args.table, args.feature, chunksize=args.chunksize)
+    diffs = count_windows(
+        tqdm.tqdm(features),
+        contig_lengths,
+        window=args.window,
+        step=args.step,
+        min_length=args.min_length,
+        max_length=args.max_length,
+        numerator_length=args.numerator_length,
+    )
+    write_proportions(
+        args.out, diffs, contig_lengths, step=args.step, threads=args.threads
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+import numpy as np
+from numba import njit
+
+# sklearn.mixture.GaussianMixture defaults
+REG_COVAR = 1e-6
+EPS = np.finfo(np.float64).eps
+LOG_2PI = np.log(2 * np.pi)
+
+
+@njit
+def kmeans_split(x):
+    """Optimal 1D two-means split of x, found from prefix sums over the sorted
+    values. Returns a boolean array that is True for the upper cluster."""
+    n = x.shape[0]
+    order = np.argsort(x, kind="mergesort")
+    xs = x[order]
+    total = xs.sum()
+    best, best_i = np.inf, n
+    left = 0.0
+    for i in range(1, n):
+        left += xs[i - 1]
+        # equal values always go to the same cluster
+        if xs[i - 1] == xs[i]:
+            continue
+        right = total - left
+        sse = -(left * left) / i - (right * right) / (n - i)
+        if sse < best:
+            best, best_i = sse, i
+    upper = np.zeros(n, dtype=np.bool_)
+    upper[order[best_i:]] = True
+    return upper
+
+
+@njit
+def m_step(x, resp, weights, means, variances, reg_covar):
+    """Update the two components from the responsibilities of the upper one,
+    the same way sklearn's _estimate_gaussian_parameters does."""
+    n = x.shape[0]
+    nk = np.full(2, 10 * EPS)
+    sx = np.zeros(2)
+    for i in range(n):
+        nk[0] += 1.0 - resp[i]
+        nk[1] += resp[i]
+        sx[0] += (1.0 - resp[i]) * x[i]
+        sx[1] += resp[i] * x[i]
+    means[:] = sx / nk
+    ss = np.zeros(2)
+    for i in range(n):
+        d0, d1 = x[i] - means[0], x[i] - means[1]
+        ss[0] += (1.0 - resp[i]) * d0 * d0
+        ss[1] += resp[i] * d1 * d1
+    variances[:] = ss / nk + reg_covar
+    weights[:] = nk / nk.sum()
+
+
+@njit
+def e_step(x, weights, means, variances, resp):
+    """Fill resp with the posterior of the upper component and
+    return the mean log likelihood of x."""
+    log_w0 = np.log(weights[0]) - 0.5 * (LOG_2PI + np.log(variances[0]))
+    log_w1 = np.log(weights[1]) - 0.5 * (LOG_2PI + np.log(variances[1]))
+    ll = 0.0
+    for i in range(x.shape[0]):
+        d0, d1 = x[i] - means[0], x[i] - means[1]
+        lp0 = log_w0 - 0.5 * d0 * d0 / variances[0]
+        lp1 = log_w1 - 0.5 * d1 * d1 / variances[1]
+        hi = max(lp0, lp1)
+        lse = hi + np.log(np.exp(lp0 - hi) + np.exp(lp1 - hi))
+        resp[i] = np.exp(lp1 - lse)
+        ll += lse
+    return ll / x.shape[0]
+
+
+@njit
+def fit_gmm(x, means_init, max_iter, tol, reg_covar, weights, means, variances):
+    """EM for a two component 1D GMM on x, initialized like GaussianMixture:
+    weights and variances from a k-means split and means from means_init
+    (or the k-means clusters if means_init is nan). Returns True on convergence."""
+    resp = kmeans_split(x).astype(np.float64)
+    m_step(x, resp, weights, means, variances, reg_covar)
+    if not np.isnan(means_init[0]):
+        means[:] = means_init
+    lower_bound = -np.inf
+    for _ in range(max_iter):
+        prev_lower_bound = lower_bound
+        lower_bound = e_step(x, weights, means, variances, resp)
+        m_step(x, resp, weights, means, variances, reg_covar)
+        if abs(lower_bound - prev_lower_bound) < tol:
+            return True
+    return False
+
+
+@njit
+def fit_gmms(values, offsets, means_init, max_iter=500, tol=1e-5, reg_covar=REG_COVAR):
+    """Fit a GMM to each segment values[offsets[i]:offsets[i+1]].
+    returns: weights, means, and variances, each of shape (n_segments, 2),
+    and a boolean array that is False for segments that did not converge."""
+    n = offsets.shape[0] - 1
+    weights = np.zeros((n, 2))
+    means = np.zeros((n, 2))
+    variances = np.zeros((n, 2))
+    converged = np.zeros(n, dtype=np.bool_)
+    for i in range(n):
+        converged[i] = fit_gmm(
+            values[offsets[i] : offsets[i + 1]],
+            means_init,
+            max_iter,
+            tol,
+            reg_covar,
+            weights[i],
+            means[i],
+            variances[i],
+        )
+    return weights, means, variances, converged
+
+
+@njit
+def upper_proba(values, offsets, weights, means, variances):
+    """Posterior probability that each value belongs to the component
+    with the larger mean of the GMM fit to its segment."""
+    proba = np.zeros(values.shape[0])
+    for i in range(offsets.shape[0] - 1):
+        st, en = offsets[i], offsets[i + 1]
+        e_step(values[st:en], weights[i], means[i], variances[i], proba[st:en])
+        if means[i, 0] > means[i, 1]:
+            proba[st:en] = 1.0 - proba[st:en]
+    return proba
+
+
+class SegmentedGMM:
+    """Two component 1D Gaussian mixtures fit independently to many segments
+    of one array at once. A drop in replacement for calling
+    GaussianMixture(n_components=2, covariance_type="full") on every segment."""
+
+    def __init__(self, means_init=None, max_iter=500, tol=1e-5, reg_covar=REG_COVAR):
+        if means_init is None:
+            means_init = [np.nan, np.nan]
+        self.means_init = np.sort(np.asarray(means_init, dtype=np.float64).ravel())
+        self.max_iter = max_iter
+        self.tol = tol
+        self.reg_covar = reg_covar
+
+    def fit(self, values, offsets):
+        self.weights_, self.means_, self.variances_, self.converged_ = fit_gmms(
+            np.ascontiguousarray(values, dtype=np.float64),
+            np.asarray(offsets, dtype=np.int64),
+            self.means_init,
+            self.max_iter,
+            self.tol,
+            self.reg_covar,
+        )
+        return self
+
+    def predict_upper_proba(self, values, offsets):
+        return upper_proba(
+            np.ascontiguousarray(values, dtype=np.float64),
+            np.asarray(offsets, dtype=np.int64),
+            self.weights_,
+            self.means_,
+            self.variances_,
+        )
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+import argparse
+import logging
+import struct
+import zipfile
+import numpy as np
+import pandas as pd
+
+# refName, tpl, base, ipdRatio, coverage
+CSV_COLUMNS = [0, 1, 3, 8, 9]
+CSV_DTYPES = {
+    "refName": str,
+    "tpl": np.uint32,
+    "base": str,
+    "ipdRatio": np.float32,
+    "coverage": np.uint16,
+}
+# size of the fixed part of a zip local file header
+ZIP_LOCAL_HEADER = struct.Struct("<4s2B4HL2L2H")
+
+
+def csv_to_cache(file, out, chunksize=1_000_000):
+    """Convert the m6A rows of an ipdSummary csv into an uncompressed npz
+    with the tpl, ipdRatio, and coverage columns and a molecule index.
+    Molecule i has rows offsets[i]:offsets[i+1]. Rows of a molecule must
+    be contiguous in the csv, which is how ipdSummary writes them."""
+    names, counts = [], []
+    tpl = [np.zeros(0, dtype=np.uint32)]
+    ipdRatio = [np.zeros(0, dtype=np.float32)]
+    coverage = [np.zeros(0, dtype=np.uint16)]
+    for chunk in pd.read_csv(
+        file, usecols=CSV_COLUMNS, dtype=CSV_DTYPES, chunksize=chunksize
+    ):
+        chunk = chunk[chunk.base == "A"]
+        if chunk.shape[0] == 0:
+            continue
+        ref_names = chunk.refName.to_numpy()
+        run_starts = np.flatnonzero(np.append(True, ref_names[1:] != ref_names[:-1]))
+        run_counts = np.diff(np.append(run_starts, ref_names.shape[0]))
+        run_names = list(ref_names[run_starts])
+        # join a molecule that was split across two chunks
+        if len(names) > 0 and names[-1] == run_names[0]:
+            counts[-1] += run_counts[0]
+            run_names, run_counts = run_names[1:], run_counts[1:]
+        names += run_names
+        counts += list(run_counts)
+        tpl.append(chunk.tpl.to_numpy())
+        ipdRatio.append(chunk.ipdRatio.to_numpy())
+        coverage.append(chunk.coverage.to_numpy())
+
+    offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    save_ipd_cache(out, names, offsets, tpl, ipdRatio, coverage)
+    logging.debug(f"Cached {offsets[-1]:,} rows from {len(names):,} molecules")
+
+
+def save_ipd_cache(out, names, offsets, tpl, ipdRatio, coverage):
+    """Write the cache from per molecule (or per chunk) lists of columns."""
+    np.savez(
+        out,
+        names=np.array(names, dtype=str),
+        offsets=np.asarray(offsets, dtype=np.int64),
+        tpl=np.concatenate(tpl).astype(np.uint32, copy=False),
+        ipdRatio=np.concatenate(ipdRatio).astype(np.float32, copy=False),
+        coverage=np.concatenate(coverage).astype(np.uint16, copy=False),
+    )
+
+
+def load_ipd_cache(file):
+    """Memory map the arrays in a npz written by csv_to_cache.
+    returns: dict of array name to read only np.memmap"""
+    arrays = {}
+    with zipfile.ZipFile(file) as zf, open(file, "rb") as handle:
+        for info in zf.infolist():
+            assert (
+                info.compress_type == zipfile.ZIP_STORED
+            ), f"{file} is compressed and cannot be memory mapped"
+            handle.seek(info.header_offset)
+            header = ZIP_LOCAL_HEADER.unpack(handle.read(ZIP_LOCAL_HEADER.size))
+            name_length, extra_length = header[-2], header[-1]
+            handle.seek(name_length + extra_length, 1)
+            # skip the npy header to get to the data
+            version = np.lib.format.read_magic(handle)
+            if version == (1, 0):
+                header = np.lib.format.read_array_header_1_0(handle)
+            else:
+                header = np.lib.format.read_array_header_2_0(handle)
+            shape, fortran_order, dtype = header
+            arrays[info.filename[: -len(".npy")]] = np.memmap(
+                file,
+                dtype=dtype,
+                mode="r",
+                shape=shape,
+                offset=handle.tell(),
+                order="F" if fortran_order else "C",
+            )
+    return arrays
+
+
+def cache_molecules(cache):
+    """Yield (name, tpl, ipdRatio, coverage) for each molecule in the cache."""
+    offsets = cache["offsets"]
+    for idx, name in enumerate(cache["names"]):
+        st, en = offsets[idx], offsets[idx + 1]
+        yield (
+            str(name),
+            cache["tpl"][st:en],
+            cache["ipdRatio"][st:en],
+            cache["coverage"][st:en],
+        )
+
+
+def parse():
+    """Convert ipdSummary csv output into a memory mappable npz cache."""
+    parser = argparse.ArgumentParser(
+        description="", formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument("csv", help="csv file from ipdSummary")
+    parser.add_argument("out", help="Output npz file.")
+    parser.add_argument(
+        "--chunksize",
+        help="Number of csv lines to read at a time.",
+        type=int,
+        default=1_000_000,
+    )
+    parser.add_argument(
+        "-v", "--verbose", help="increase logging verbosity", action="store_true"
+    )
+    args = parser.parse_args()
+    log_format = "[%(levelname)s][Time elapsed (ms) %(relativeCreated)d]: %(message)s"
+    log_level = logging.DEBUG if args.verbose else logging.WARNING
+    logging.basicConfig(format=log_format, level=log_level)
+    return args
+
+
+def main():
+    args = parse()
+    csv_to_cache(args.csv, args.out, chunksize=args.chunksize)
+    return 0
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+import numpy as np
+from numba import njit
+
+
+@njit
+def cigar_aligned_pairs(cigar, reference_start):
+    """(query, reference) positions of the aligned bases from the cigar ops,
+    as from rec.get_aligned_pairs(matches_only=True) but as an int32 array."""
+    n = 0
+    for k in range(cigar.shape[0]):
+        # M, =, and X consume both the query and the reference
+        if cigar[k, 0] == 0 or cigar[k, 0] == 7 or cigar[k, 0] == 8:
+            n += cigar[k, 1]
+    pairs = np.empty((n, 2), dtype=np.int32)
+    q_pos = 0
+    r_pos = reference_start
+    i = 0
+    for k in range(cigar.shape[0]):
+        op, length = cigar[k, 0], cigar[k, 1]
+        if op == 0 or op == 7 or op == 8:
+            for j in range(length):
+                pairs[i, 0] = q_pos + j
+                pairs[i, 1] = r_pos + j
+                i += 1
+            q_pos += length
+            r_pos += length
+        # I and S
+        elif op == 1 or op == 4:
+            q_pos += length
+        # D and N
+        elif op == 2 or op == 3:
+            r_pos += length
+    return pairs
+
+
+def get_aligned_pairs(rec):
+    cigar = np.array(rec.cigartuples, dtype=np.int32).reshape(-1, 2)
+    return cigar_aligned_pairs(cigar, rec.reference_start)
+
+
+# len = 7
+# 0|1|2|3|4|5|6
+# 6|5|4|3|2|1|0
+# rev comp [1,5) = [2,6)
+# new_st = len(7) - old_en(5)
+# new_en = len(7) - old_st(1)
+@njit
+def liftover_helper(aligned_pairs, sts, ens, query_length, is_reverse=False):
+    read_pos = aligned_pairs[:, 0]
+    ref_pos = aligned_pairs[:, 1]
+
+    # flip positison if reversed
+    if is_reverse:
+        new_st = query_length - ens
+        new_en = query_length - sts
+        sts = new_st[::-1]
+        ens = new_en[::-1]
+
+    # search of closest matching index
+    st_idxs = np.searchsorted(read_pos, sts, side="left")
+    en_idxs = np.searchsorted(read_pos, ens, side="left")
+    ## remove things that are past the end of the read
+    st_idxs[st_idxs >= ref_pos.shape[0]] = ref_pos.shape[0] - 1
+    en_idxs[en_idxs >= ref_pos.shape[0]] = ref_pos.shape[0] - 1
+    # get the ref positions
+    ref_sts = ref_pos[st_idxs]
+    ref_ens = ref_pos[en_idxs]
+
+    # remove zero length liftovers (past start or end of alignment)
+    keep_idx = ref_ens - ref_sts > 0
+    # if (~keep_idx).any():
+    #    logging.debug(f"removing {(~keep_idx).sum()} zero length liftovers.")
+    return ref_sts[keep_idx], ref_ens[keep_idx]
+
+
+def liftover(rec, sts, ens, aligned_pairs=None):
+    if aligned_pairs is None:
+        aligned_pairs = get_aligned_pairs(rec)
+    return liftover_helper(
+        aligned_pairs,
+        sts,
+        ens,
+        rec.query_length,
+        is_reverse=rec.is_reverse,
+    )
+
+
+@njit
+def liftover_points_helper(aligned_pairs, positions, query_length, is_reverse=False):
+    read_pos = aligned_pairs[:, 0]
+    ref_pos = aligned_pairs[:, 1]
+    if is_reverse:
+        positions = (query_length - 1 - positions)[::-1]
+    idxs = np.searchsorted(read_pos, positions, side="left")
+    idxs[idxs >= read_pos.shape[0]] = read_pos.shape[0] - 1
+    # drop positions that are inserted, clipped, or past the end of the read
+    keep_idx = read_pos[idxs] == positions
+    return ref_pos[idxs[keep_idx]]
+
+
+def liftover_points(rec, positions, aligned_pairs=None):
+    """Reference positions of the bases at sorted positions in the
+    orientation of the sequenced molecule, dropping those that are not
+    aligned to a reference base."""
+    if aligned_pairs is None:
+        aligned_pairs = get_aligned_pairs(rec)
+    if aligned_pairs.shape[0] == 0:
+        return np.zeros(0, dtype=aligned_pairs.dtype)
+    return liftover_points_helper(
+        aligned_pairs,
+        positions,
+        rec.query_length,
+        is_reverse=rec.is_reverse,
+    )
+
+
+@njit
+def reference_to_query_helper(aligned_pairs, ref_positions):
+    read_pos = aligned_pairs[:, 0]
+    ref_pos = aligned_pairs[:, 1]
+    idxs = np.searchsorted(ref_pos, ref_positions, side="left")
+    idxs[idxs >= ref_pos.shape[0]] = ref_pos.shape[0] - 1
+    # drop positions that are deleted from or outside of the read
+    keep_idx = ref_pos[idxs] == ref_positions
+    return read_pos[idxs[keep_idx]]
+
+
+def reference_to_query(rec, ref_positions, aligned_pairs=None):
+    """Positions on the stored read of the bases aligned to sorted, unique
+    reference positions, dropping those with no aligned base."""
+    if aligned_pairs is None:
+        aligned_pairs = get_aligned_pairs(rec)
+    if aligned_pairs.shape[0] == 0:
+        return np.zeros(0, dtype=aligned_pairs.dtype)
+    return reference_to_query_helper(aligned_pairs, ref_positions)
+
+
+@njit
+def liftover_batch_helper(
+    aligned_pairs, sts, ens, points, query_length, is_reverse=False
+):
+    read_pos = aligned_pairs[:, 0]
+    ref_pos = aligned_pairs[:, 1]
+    if is_reverse:
+        sts, ens = query_length - ens, query_length - sts
+    last = read_pos.shape[0] - 1
+    st_idxs = np.minimum(np.searchsorted(read_pos, sts, side="left"), last)
+    en_idxs = np.minimum(np.searchsorted(read_pos, ens, side="left"), last)
+    ref_sts = ref_pos[st_idxs].astype(np.int64)
+    ref_ens = ref_pos[en_idxs].astype(np.int64)
+    keep = np.empty(sts.shape[0], dtype=np.bool_)
+    for i in range(sts.shape[0]):
+        if points[i]:
+            # the base itself has to be aligned
+            keep[i] = read_pos[st_idxs[i]] == sts[i]
+            ref_ens[i] = ref_sts[i] + 1
+        else:
+            # remove zero length liftovers (past start or end of alignment)
+            keep[i] = ref_ens[i] - ref_sts[i] > 0
+    return ref_sts, ref_ens, keep
+
+
+def liftover_batch(rec, features, aligned_pairs=None, drop=True):
+    """Lift several sets of features of a fiber over in one call. features is
+    a dict of name to (starts, lengths) in the orientation of the molecule,
+    with lengths None for single bases, which are lifted like liftover_points
+    while intervals are lifted like liftover.
+    returns: dict of name to sorted reference starts and ends, or with drop
+    False, to reference starts and ends in the order of the features with -1
+    for those that do not lift over"""
+    if aligned_pairs is None:
+        aligned_pairs = get_aligned_pairs(rec)
+    empty = np.zeros(0, dtype=np.int64)
+    if aligned_pairs.shape[0] == 0:
+        if drop:
+            return {name: (empty, empty) for name in features}
+        return {
+            name: (np.full(starts.shape[0], -1), np.full(starts.shape[0], -1))
+            for name, (starts, _lengths) in features.items()
+        }
+    sts, ens, points = [empty], [empty], [np.zeros(0, dtype=np.bool_)]
+    for starts, lengths in features.values():
+        sts.append(starts)
+        ens.append(starts + (1 if lengths is None else lengths))
+        points.append(np.full(starts.shape[0], lengths is None))
+    ref_sts, ref_ens, keep = liftover_batch_helper(
+        aligned_pairs,
+        np.concatenate(sts).astype(np.int64),
+        np.concatenate(ens).astype(np.int64),
+        np.concatenate(points),
+        rec.query_length,
+        is_reverse=rec.is_reverse,
+    )
+    lifted = {}
+    offset = 0
+    for name, (starts, _lengths) in features.items():
+        idx = slice(offset, offset + starts.shape[0])
+        offset += starts.shape[0]
+        if not drop:
+            lifted[name] = (
+                np.where(keep[idx], ref_sts[idx], -1),
+                np.where(keep[idx], ref_ens[idx], -1),
+            )
+            continue
+        l_sts, l_ens = ref_sts[idx][keep[idx]], ref_ens[idx][keep[idx]]
+        if rec.is_reverse:
+            l_sts, l_ens = l_sts[::-1], l_ens[::-1]
+        lifted[name] = (l_sts, l_ens)
+    return lifted
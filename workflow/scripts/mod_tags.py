@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+from array import array
+import numpy as np
+from numba import njit
+
+# (base the call is on, MM tag prefix) for m6A on each strand
+M6A_MODS = (("A", "A+a"), ("T", "T-a"))
+# ML score below which calls are skipped, the default of the pipeline's
+# min_ml_score and of ft extract
+MIN_ML_SCORE = 200
+
+
+@njit
+def mm_skips(sequence, base, positions):
+    """Number of unmodified `base`s before each modified one, as in the MM tag.
+    positions must be sorted and unique, and those not on `base` are ignored."""
+    skips = np.empty(positions.shape[0], dtype=np.int64)
+    n = 0
+    count = 0
+    idx = 0
+    for pos in positions:
+        if sequence[pos] != base:
+            continue
+        while idx < pos:
+            if sequence[idx] == base:
+                count += 1
+            idx += 1
+        skips[n] = count
+        n += 1
+        count = 0
+        idx = pos + 1
+    return skips[:n]
+
+
+@njit
+def join_ints(values):
+    """ASCII bytes of ",".join(values) for integers."""
+    buf = np.empty(values.shape[0] * 21, dtype=np.uint8)
+    n = 0
+    for i in range(values.shape[0]):
+        if i > 0:
+            buf[n] = ord(",")
+            n += 1
+        value = values[i]
+        if value < 0:
+            buf[n] = ord("-")
+            n += 1
+            value = -value
+        start = n
+        while True:
+            buf[n] = ord("0") + value % 10
+            n += 1
+            value //= 10
+            if value == 0:
+                break
+        buf[start:n] = buf[start:n][::-1].copy()
+    return buf[:n]
+
+
+def sequence_array(rec):
+    return np.frombuffer(rec.query_sequence.encode(), dtype=np.uint8)
+
+
+def encode_mods(sequence, positions, probabilities=255, mods=M6A_MODS):
+    """Encode modifications at sorted positions on the read into MM and ML
+    values. probabilities is a scalar or an array matching positions.
+    returns: MM string and ML array('B'), with one group per base in mods"""
+    positions = np.asarray(positions, dtype=np.int64)
+    probabilities = np.broadcast_to(
+        np.asarray(probabilities, dtype=np.uint8), positions.shape
+    )
+    mm = ""
+    ml = array("B")
+    for base, prefix in mods:
+        skips = mm_skips(sequence, ord(base), positions)
+        if skips.shape[0] == 0:
+            continue
+        mm += prefix + "," + join_ints(skips).tobytes().decode() + ";"
+        ml.frombytes(probabilities[sequence[positions] == ord(base)].tobytes())
+    return mm, ml
+
+
+def add_mods(rec, mm, ml):
+    """Append MM and ML values from encode_mods to the tags on rec,
+    leaving the rest of the tags as they are."""
+    if len(mm) == 0:
+        return
+    if rec.has_tag("MM"):
+        mm = rec.get_tag("MM") + mm
+        if rec.has_tag("ML"):
+            ml = array("B", rec.get_tag("ML")) + ml
+    rec.set_tag("MM", mm, "Z")
+    rec.set_tag("ML", ml)
+
+
+COMPLEMENT = np.zeros(256, dtype=np.uint8)
+for _base, _complement in zip(b"ACGTN", b"TGCAN"):
+    COMPLEMENT[_base] = _complement
+
+
+@njit
+def _parse_int(mm, i):
+    value = 0
+    while i < mm.shape[0] and ord("0") <= mm[i] <= ord("9"):
+        value = value * 10 + mm[i] - ord("0")
+        i += 1
+    return value, i
+
+
+@njit
+def mark_mods(
+    seq, mm, ml, has_ml, mod_bases, mod_strands, mod_codes, min_ml, is_reverse
+):
+    """Walk the raw MM and ML tag bytes once and mark the modified bases.
+    mods are given as parallel arrays of the base, strand (+/-), and single
+    letter code as they appear in the MM tag, i.e. in the orientation of the
+    sequenced molecule. Calls with an ML score below min_ml are skipped, and
+    without an ML tag (has_ml False) every call is marked. An ML tag must have
+    one score per code of every MM call, otherwise a ValueError is raised.
+    returns: uint8 array over the stored query sequence, 1 where modified"""
+    n = seq.shape[0]
+    binary = np.zeros(n, dtype=np.uint8)
+    i = 0
+    ml_idx = 0
+    while i < mm.shape[0]:
+        base = mm[i]
+        strand = mm[i + 1]
+        i += 2
+        # one code per letter, or a single ChEBI number
+        code_start = i
+        while i < mm.shape[0] and mm[i] != ord(",") and mm[i] != ord(";"):
+            if mm[i] == ord("?") or mm[i] == ord("."):
+                break
+            i += 1
+        codes = mm[code_start:i]
+        n_codes = codes.shape[0]
+        if n_codes > 0 and ord("0") <= codes[0] <= ord("9"):
+            n_codes = 1
+        if i < mm.shape[0] and (mm[i] == ord("?") or mm[i] == ord(".")):
+            i += 1
+        want = -1
+        for k in range(mod_bases.shape[0]):
+            if mod_bases[k] == base and mod_strands[k] == strand:
+                for c in range(codes.shape[0]):
+                    if codes[c] == mod_codes[k]:
+                        want = c
+        # skip counts of the canonical base in the molecule's orientation
+        pos = -1
+        while i < mm.shape[0] and mm[i] == ord(","):
+            skip, i = _parse_int(mm, i + 1)
+            if mm[i - 1] == ord(","):
+                raise ValueError("MM tag has an empty skip count")
+            pos += 1
+            while pos < n:
+                if is_reverse:
+                    read_base = COMPLEMENT[seq[n - 1 - pos]]
+                else:
+                    read_base = seq[pos]
+                if read_base == base or base == ord("N"):
+                    if skip == 0:
+                        break
+                    skip -= 1
+                pos += 1
+            if pos >= n:
+                raise ValueError("MM tag refers to bases beyond the sequence length")
+            if has_ml and ml_idx + n_codes > ml.shape[0]:
+                raise ValueError("ML tag has fewer entries than the MM tag has calls")
+            if want >= 0 and (not has_ml or ml[ml_idx + want] >= min_ml):
+                binary[n - 1 - pos if is_reverse else pos] = 1
+            ml_idx += n_codes
+        # step past the ;
+        i += 1
+    if has_ml and ml_idx != ml.shape[0]:
+        raise ValueError("ML tag has more entries than the MM tag has calls")
+    return binary
+
+
+def mods_to_arrays(mods):
+    """(base, strand, code) tuples as used by pysam's modified_bases_forward
+    to the parallel arrays used by mark_mods."""
+    mod_bases = np.array([ord(base) for base, _strand, _code in mods], dtype=np.uint8)
+    mod_strands = np.array(
+        [ord("+-"[strand]) for _base, strand, _code in mods], dtype=np.uint8
+    )
+    mod_codes = np.array([ord(code) for _base, _strand, code in mods], dtype=np.uint8)
+    return mod_bases, mod_strands, mod_codes
+
+
+def pysam_mod_binary(rec, mod_arrays, min_ml=0):
+    """mod_binary from pysam's modified_bases_forward, which has no
+    modifications for records whose MM or ML tag htslib rejects."""
+    n = rec.query_length
+    binary = np.zeros(n, dtype=np.uint8)
+    mods = rec.modified_bases_forward or {}
+    for base, strand, code in zip(*mod_arrays):
+        key = (chr(base), 0 if strand == ord("+") else 1, chr(code))
+        for pos, qual in mods.get(key, []):
+            if qual >= min_ml:
+                binary[n - 1 - pos if rec.is_reverse else pos] = 1
+    return binary
+
+
+def mod_binary(rec, mod_arrays, min_ml=0):
+    """uint8 array over the stored query sequence that is 1 at modified bases,
+    or None if the record has no MM tag. Records whose ML tag does not have
+    one score per MM call fall back to pysam_mod_binary."""
+    if not rec.has_tag("MM"):
+        return None
+    mm = np.frombuffer(rec.get_tag("MM").encode(), dtype=np.uint8)
+    has_ml = rec.has_tag("ML")
+    if has_ml:
+        ml = np.frombuffer(rec.get_tag("ML"), dtype=np.uint8)
+    else:
+        ml = np.zeros(0, dtype=np.uint8)
+    try:
+        return mark_mods(
+            sequence_array(rec), mm, ml, has_ml, *mod_arrays, min_ml, rec.is_reverse
+        )
+    except ValueError:
+        return pysam_mod_binary(rec, mod_arrays, min_ml=min_ml)
@@ -1,4 +1,5 @@
 # build pipeline to generate per fiber GMM model
+from array import array
 import pandas as pd
 import numpy as np
 from sklearn.mixture import GaussianMixture
@@ -8,196 +9,256 @@ import time
 import tqdm
 import pysam
 import multiprocessing as mp
+from collections import deque
+from ipd_cache import load_ipd_cache, cache_molecules, CSV_COLUMNS, CSV_DTYPES
+from liftover import liftover_points
 
 # line format
 # m64018_201129_132425/18/ccs",2,0,G,6,0.814,0.248,0.639,1.273,11
 
-# first arg = csv
+# first arg = csv (or npz cache of the csv from ipd_cache.py)
 # second arg = aligned bam
 # third arg = file_name
 # fourth arg = number of cpus to use
 
-# save dictionary of tpl_arrays per molecule name to then
-# use in converting to genomic coordinates
-# but first write out bed file to file (unaligned fiber coordinates)
-
-
-def trainGMMs(csv):
-    intervals = []
-    molecule_dict = {}
-    # 	print('here')
-    for molecule in tqdm.tqdm(csv.groupby("refName")):
-        # 		print(molecule)
-        molecule_name = molecule[0]
-        molecule_df = molecule[1]
-
-        ec = np.mean(molecule_df["coverage"])  # effective coverage
-
-        data = molecule_df[["tpl", "ipdRatio"]].to_numpy().transpose()
-
-        tpl = data[0].astype(int)
-        ipdRatios = data[1].reshape(-1, 1)
-        if int(ipdRatios.shape[0]) < 25:
-            continue
-
-        gmm = GaussianMixture(
-            n_components=2, n_init=3, max_iter=500, covariance_type="full", tol=1e-5
-        )
-        model = gmm.fit(ipdRatios)
-
-        labels = model.predict_proba(ipdRatios)
-
-        predictions = labels[:, np.argmax(model.means_[:, 0])]
-        fiber_positions_where_methylated = tpl[predictions >= 0.99999999]
+# fit the molecules in the bam, writing the bed file in unaligned
+# fiber coordinates as they are fit and keeping the methylated tpl
+# positions per molecule to then use in converting to genomic coordinates
+
+
+def molecule_zmw(molecule_name):
+    return int(molecule_name.split("/")[1])
+
+
+def bam_zmws(bam_file, threads=1):
+    """ZMW ids of the records in the bam, read in a pass before the csv so
+    molecules that are not in the bam are never loaded or fit."""
+    bam = pysam.AlignmentFile(bam_file, "rb", threads=threads, check_sq=False)
+    zmws = set()
+    for rec in bam.fetch(until_eof=True):
+        zmws.add(int(rec.get_tag("zm")))
+    return zmws
+
+
+def csv_molecules(file, zmws, chunksize=1_000_000):
+    """Read the csv a block at a time and yield (name, tpl, ipdRatio, coverage)
+    for the molecules with a ZMW id in zmws. Rows of a molecule must be
+    contiguous, and a molecule split across blocks is joined."""
+    pending = None
+    for chunk in pd.read_csv(
+        file, usecols=CSV_COLUMNS, dtype=CSV_DTYPES, chunksize=chunksize
+    ):
+        chunk = chunk[chunk.base == "A"]
+        zmw = chunk.refName.str.split("/", n=2).str[1].astype(np.int64)
+        chunk = chunk[zmw.isin(zmws)]
+        for molecule_name, molecule_df in chunk.groupby("refName", sort=False):
+            molecule = (
+                molecule_name,
+                molecule_df["tpl"].to_numpy(),
+                molecule_df["ipdRatio"].to_numpy(),
+                molecule_df["coverage"].to_numpy(),
+            )
+            if pending is not None and pending[0] == molecule_name:
+                molecule = tuple(
+                    [molecule_name]
+                    + [np.concatenate(pair) for pair in zip(pending[1:], molecule[1:])]
+                )
+            elif pending is not None:
+                yield pending
+            pending = molecule
+    if pending is not None:
+        yield pending
+
+
+def npz_molecules(file, zmws):
+    for molecule in cache_molecules(load_ipd_cache(file)):
+        if molecule_zmw(molecule[0]) in zmws:
+            yield molecule
+
+
+def batched(molecules, batch_size):
+    batch = []
+    for molecule in molecules:
+        batch.append(molecule)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if len(batch) > 0:
+        yield batch
+
+
+def trainGMM(molecule):
+    """Fit a GMM to the ipdRatios of one molecule.
+    returns: (name, tpl, methylated tpl positions, effective coverage),
+    or None if the molecule has fewer than 25 calls"""
+    molecule_name, tpl, ipdRatios, coverage = molecule
+
+    ec = np.mean(coverage)  # effective coverage
+
+    tpl = tpl.astype(int)
+    ipdRatios = ipdRatios.astype(np.float64).reshape(-1, 1)
+    if int(ipdRatios.shape[0]) < 25:
+        return None
+
+    gmm = GaussianMixture(
+        n_components=2, n_init=3, max_iter=500, covariance_type="full", tol=1e-5
+    )
+    model = gmm.fit(ipdRatios)
 
-        # full_name = str(molecule_df.refName.iloc[0])
-        molecule_dict[
-            int(molecule_name.split("/")[1])
-        ] = fiber_positions_where_methylated
+    labels = model.predict_proba(ipdRatios)
 
-        chrom = molecule_name
+    predictions = labels[:, np.argmax(model.means_[:, 0])]
+    fiber_positions_where_methylated = tpl[predictions >= 0.99999999]
+    return molecule_name, tpl, fiber_positions_where_methylated, ec
 
-        start, stop = min(tpl), max(tpl)
 
-        blockCount = str(len(fiber_positions_where_methylated) + 2)
+def trainGMMs_worker(molecules):
+    return [trainGMM(molecule) for molecule in molecules]
 
-        blockStarts = ",".join(
-            ["0"]
-            + list((fiber_positions_where_methylated - 1).astype(str))
-            + [str((stop - start) - 1)]
-        )
 
-        blockSizes = ",".join(list(np.ones(int(blockCount), dtype=int).astype(str)))
+def trainGMMs_parallel(batches, threads):
+    """Yield the fits of each batch in input order from a pool of threads
+    processes, with at most two batches per worker in flight at once."""
+    pending = deque()
+    with mp.Pool(threads) as pool:
+        for batch in batches:
+            pending.append(pool.apply_async(trainGMMs_worker, (batch,)))
+            if len(pending) >= 2 * threads:
+                yield pending.popleft().get()
+        while len(pending) > 0:
+            yield pending.popleft().get()
 
-        zmwid = str(molecule_name)
 
-        bed_interval = [
-            chrom,  # chromosome
-            str(start),  # fiber start in genomic coords
-            str(stop),  # fiber stop in genomic coords
-            zmwid,  # ZMW ID
-            str(ec),  # effective coverage
-            ".",
-            str(start),  # fiber start in genomic coords
-            str(stop),  # fiber stop in genomic coords]
-            "128,0,128",
-            blockCount,
-            blockSizes,
-            blockStarts,
-        ]
+def trainGMMs(molecules, threads=1, batch_size=100):
+    """Yield the fit of each molecule with enough calls, in input order,
+    fitting batches of molecules in a pool of threads processes."""
+    batches = batched(molecules, batch_size)
+    if threads > 1:
+        results = trainGMMs_parallel(batches, threads)
+    else:
+        results = map(trainGMMs_worker, batches)
+    for result in results:
+        for fit in result:
+            if fit is not None:
+                yield fit
 
-        intervals.append("\t".join(bed_interval))
 
-    return molecule_dict, intervals
+def unaligned_bed_line(molecule_name, tpl, fiber_positions_where_methylated, ec):
+    chrom = molecule_name
 
+    start, stop = min(tpl), max(tpl)
 
-def main():
+    blockCount = str(len(fiber_positions_where_methylated) + 2)
 
-    prefix = sys.argv[3]
-
-    ### first read in just zmwids
-    ### then read in csv for each block
-    ### avoiding the unused zmwids
-    ### and use multiprocessing
-    ### merge dictionaries
-    ### and merge lists
-
-    csv = pd.read_csv(
-        sys.argv[1],
-        usecols=[0, 1, 3, 8, 9],
-        names=["refName", "tpl", "base", "ipdRatio", "coverage"],
-        dtype={
-            "refName": str,
-            "tpl": int,
-            "base": str,
-            "ipdRatio": float,
-            "coverage": int,
-        },
+    blockStarts = ",".join(
+        ["0"]
+        + list((fiber_positions_where_methylated - 1).astype(str))
+        + [str((stop - start) - 1)]
     )
-    csv = csv[csv.base == "A"]
 
-    molecule_to_zmwid, molecule_file = trainGMMs(csv)
+    blockSizes = ",".join(list(np.ones(int(blockCount), dtype=int).astype(str)))
 
-    molecule_out_name = prefix + ".unaligned.bed"
-    with open(molecule_out_name, "w") as handle:
-        handle.write("\n".join(molecule_file))
-        handle.write("\n")
+    zmwid = str(molecule_name)
 
-    # generate aligned coordinates
+    bed_interval = [
+        chrom,  # chromosome
+        str(start),  # fiber start in genomic coords
+        str(stop),  # fiber stop in genomic coords
+        zmwid,  # ZMW ID
+        str(ec),  # effective coverage
+        ".",
+        str(start),  # fiber start in genomic coords
+        str(stop),  # fiber stop in genomic coords]
+        "128,0,128",
+        blockCount,
+        blockSizes,
+        blockStarts,
+    ]
+    return "\t".join(bed_interval)
 
-    aligned_file = []
-    # iterate through bam and generate genome specific bed file
-    bam = pysam.AlignmentFile(sys.argv[2], "rb")
 
-    for interval in tqdm.tqdm(bam):
+def aligned_bed_line(interval, pos):
+    zmwid = int(interval.get_tag("zm"))
 
-        zmwid = int(interval.get_tag("zm"))
+    start, stop = int(interval.reference_start), int(interval.reference_end)
 
-        if zmwid in molecule_to_zmwid:
+    # tpl positions from the csv are 1-based and in the orientation
+    # of the sequenced molecule, so they are flipped for reverse reads
+    ref_coords = liftover_points(interval, pos - 1) - start
 
-            pos = molecule_to_zmwid[zmwid]
+    chrom = str(interval.reference_name)
 
-            aligned_pairs = (
-                np.array(interval.get_aligned_pairs(matches_only=True))
-                .astype(int)
-                .transpose()
-            )
+    smrt_cell = str(interval.query_name.split("/")[0])
 
-            start, stop = int(interval.reference_start), int(interval.reference_end)
+    blockCount = str(len(ref_coords) + 2)
 
-            if interval.is_reverse:
+    blockStarts = ",".join(
+        ["0"] + list((ref_coords).astype(str)) + [str((stop - start) - 1)]
+    )
 
-                # if the read is reversed. The coordinates from the csv
-                # are in reverse (from the end of the read)
-                # we need to change the positions we get fro the csv
-                # file before we look at aligned pairs
+    blockSizes = ",".join(list(np.ones(int(blockCount), dtype=int).astype(str)))
+
+    bed_interval = [
+        chrom,  # chromosome
+        str(start),  # fiber start in genomic coords
+        str(stop),  # fiber stop in genomic coords
+        str(zmwid) + "/" + smrt_cell,  # fiber name (zmwid + "/" + smrt cell )
+        str(interval.get_tag("ec")),  # effective coverage
+        ".",
+        str(start),  # fiber start in genomic coords
+        str(stop),  # fiber stop in genomic coords]
+        "128,0,128",
+        blockCount,
+        blockSizes,
+        blockStarts,
+    ]
+    return "\t".join(bed_interval)
 
-                pos = np.abs(pos - int(interval.infer_read_length()))
-                ref_coords = aligned_pairs[1][np.isin(aligned_pairs[0], pos)] - start
 
-            else:
+def main():
 
-                ref_coords = (
-                    aligned_pairs[1][np.isin(aligned_pairs[0], pos)] - start
-                ) - 1
+    prefix = sys.argv[3]
+    threads = int(sys.argv[4]) if len(sys.argv) > 4 else 1
 
-            chrom = str(interval.reference_name)
+    # read in just the zmwids of the bam first, then read the csv
+    # a block at a time, skipping the zmwids that are not in the bam,
+    # and fit the molecules in a pool of processes
+    zmws = bam_zmws(sys.argv[2], threads=threads)
 
-            smrt_cell = str(interval.query_name.split("/")[0])
+    if sys.argv[1].endswith(".npz"):
+        molecules = npz_molecules(sys.argv[1], zmws)
+    else:
+        molecules = csv_molecules(sys.argv[1], zmws)
 
-            blockCount = str(len(ref_coords) + 2)
+    # the unaligned bed is written as the fits come in, and only the
+    # methylated positions are kept, in one array, for the aligned bed
+    calls = array("q")
+    call_index = {}
 
-            blockStarts = ",".join(
-                ["0"] + list((ref_coords).astype(str)) + [str((stop - start) - 1)]
-            )
+    molecule_out_name = prefix + ".unaligned.bed"
+    with open(molecule_out_name, "w") as handle:
+        for fit in tqdm.tqdm(trainGMMs(molecules, threads=threads)):
+            handle.write(unaligned_bed_line(*fit) + "\n")
+            molecule_name, _tpl, pos, _ec = fit
+            st = len(calls)
+            calls.frombytes(pos.astype(np.int64).tobytes())
+            call_index[molecule_zmw(molecule_name)] = (st, len(calls))
+    calls = np.frombuffer(calls, dtype=np.int64)
 
-            blockSizes = ",".join(list(np.ones(int(blockCount), dtype=int).astype(str)))
-
-            bed_interval = [
-                chrom,  # chromosome
-                str(start),  # fiber start in genomic coords
-                str(stop),  # fiber stop in genomic coords
-                str(zmwid) + "/" + smrt_cell,  # fiber name (zmwid + "/" + smrt cell )
-                str(interval.get_tag("ec")),  # effective coverage
-                ".",
-                str(start),  # fiber start in genomic coords
-                str(stop),  # fiber stop in genomic coords]
-                "128,0,128",
-                blockCount,
-                blockSizes,
-                blockStarts,
-            ]
-
-            aligned_file.append("\t".join(bed_interval))
+    # generate aligned coordinates
 
-    aligned_out_name = prefix + ".aligned.bed"
+    # iterate through bam and generate genome specific bed file
+    bam = pysam.AlignmentFile(sys.argv[2], "rb", threads=threads)
 
+    aligned_out_name = prefix + ".aligned.bed"
     with open(aligned_out_name, "w") as handle:
-        handle.write("\n".join(aligned_file))
-        handle.write("\n")
+        for interval in tqdm.tqdm(bam):
+
+            zmwid = int(interval.get_tag("zm"))
 
-        # print('\t'.join(bed_interval))
-        # print(ref_coords)
+            if zmwid in call_index:
+                st, en = call_index[zmwid]
+                handle.write(aligned_bed_line(interval, calls[st:en]) + "\n")
 
 
 if __name__ == "__main__":
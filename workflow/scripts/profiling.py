@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+import contextlib
+import json
+import logging
+import os
+import resource
+import sys
+import time
+from collections import defaultdict
+
+NULL_CONTEXT = contextlib.nullcontext()
+
+
+class Profile:
+    """Cumulative wall time per stage of a script, the number of fibers and
+    bases it processed, and its peak RSS, written as a JSON sidecar to file.
+    Without a file every method is a no-op so the hooks can stay in place."""
+
+    def __init__(self, file=None):
+        self.file = file
+        self.enabled = file is not None
+        self.started = time.perf_counter()
+        self.seconds = defaultdict(float)
+        self.fibers = 0
+        self.bases = 0
+
+    @contextlib.contextmanager
+    def _stage(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds[name] += time.perf_counter() - started
+
+    def stage(self, name):
+        """Context manager adding the time spent inside it to stage name."""
+        if not self.enabled:
+            return NULL_CONTEXT
+        return self._stage(name)
+
+    def _iterate(self, iterable, name):
+        iterator = iter(iterable)
+        while True:
+            started = time.perf_counter()
+            item = next(iterator, StopIteration)
+            self.seconds[name] += time.perf_counter() - started
+            if item is StopIteration:
+                return
+            yield item
+
+    def iterate(self, iterable, name):
+        """Yield from iterable, adding the time spent getting each item to
+        stage name, e.g. the time spent decoding records from a bam."""
+        if not self.enabled:
+            return iterable
+        return self._iterate(iterable, name)
+
+    def count(self, fibers=0, bases=0):
+        self.fibers += fibers
+        self.bases += bases
+
+    def count_records(self, records):
+        """Count an iterable of bam records as fibers and their query lengths
+        as bases, without consuming it when not profiling."""
+        if self.enabled:
+            lengths = [rec.query_length for rec in records]
+            self.count(fibers=len(lengths), bases=sum(lengths))
+
+    def summary(self):
+        wall = time.perf_counter() - self.started
+        # ru_maxrss is in KiB on linux
+        peak_rss = max(
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+        )
+        return {
+            "script": os.path.basename(sys.argv[0]),
+            "wall_seconds": wall,
+            "stages": dict(self.seconds),
+            "fibers": self.fibers,
+            "bases": self.bases,
+            "fibers_per_second": self.fibers / wall,
+            "bases_per_second": self.bases / wall,
+            "peak_rss_mb": peak_rss / 1024,
+        }
+
+    def write(self):
+        if not self.enabled:
+            return
+        summary = self.summary()
+        with open(self.file, "w") as handle:
+            json.dump(summary, handle, indent=2)
+        logging.debug(f"Profile: {summary}")
+
+
+# default for functions that take an optional profile
+NO_PROFILE = Profile()
@@ -9,32 +9,18 @@ import argparse
 import logging
 import tqdm
 import pickle
+import multiprocessing as mp
+from collections import deque
+from bgzf import split_threads
+from ipd_cache import load_ipd_cache, cache_molecules
+from gmm1d import SegmentedGMM
+from mod_tags import sequence_array, encode_mods, add_mods
+from profiling import Profile, NO_PROFILE
 
+MEANS_INIT = [0.5, 2.2]
 
-def coordinateConversion_MMTag(sequence, base, modification_coords):
-    """Sequence is array of bases. Base is a base
-    for conversion to the coordinate system
-    used in the MM tag."""
 
-    mask = sequence == bytes(base, encoding="utf-8")
-    # find all masks = boolean Array
-    coords = modification_coords[
-        sequence[modification_coords] == bytes(base, encoding="utf-8")
-    ]
-    # when working with double stranded data we can only use modifications
-    # on the specifc base that the modification would fall on on that strand
-    # i.e. As  on + , Ts on -, we only want the mods that = that base of interest
-    masked_coords = np.cumsum(mask)[coords] - 1
-    distance = np.diff(masked_coords) - 1
-    if coords.shape[0] < 1:
-        return "", 0
-    return (
-        ",".join([masked_coords[0].astype(str)] + list(distance.astype(str))),
-        coords.shape[0],
-    )
-
-
-def train_gmm(ipdRatios, means_init=[0.5, 2.2]):
+def train_gmm(ipdRatios, means_init=MEANS_INIT):
     means_init = np.array(means_init).reshape(-1, 1)
     gmm = GaussianMixture(
         n_components=2,
@@ -49,10 +35,11 @@ def train_gmm(ipdRatios, means_init=[0.5, 2.2]):
     return model
 
 
-def apply_model(model, tpl, ipdRatios, min_prediction_value):
-    labels = model.predict_proba(ipdRatios)
-    predictions = labels[:, np.argmax(model.means_[:, 0])]
-    return tpl[predictions >= min_prediction_value]
+def model_upper_proba(model, ipdRatios):
+    """Probability of each ipdRatio coming from the component of a
+    pre-trained GaussianMixture with the larger mean."""
+    labels = model.predict_proba(ipdRatios.reshape(-1, 1))
+    return labels[:, np.argmax(model.means_[:, 0])]
 
 
 def write_model(model, file):
@@ -65,116 +52,275 @@ def read_model(filename):
     return pickle.load(open(filename, "rb"))
 
 
-def apply_gmm(
-    csv,
-    bam,
-    out,
+def molecule_arrays(molecule_df):
+    return molecule_df.tpl.to_numpy(), molecule_df.ipdRatio.to_numpy()
+
+
+def lookup_molecules(csv, bam):
+    """Pair every bam record with its (tpl, ipdRatio) arrays
+    from a csv loaded by read_csv."""
+    for rec in tqdm.tqdm(bam.fetch(until_eof=True), total=csv.index.unique().shape[0]):
+        if not rec.query_name in csv.index:
+            yield rec, None
+            continue
+        yield rec, molecule_arrays(csv.loc[[rec.query_name]])
+
+
+def zmw_number(name):
+    return int(name.split("/")[1])
+
+
+def zmw_ordered(molecules):
+    """Pass (name, molecule) pairs through, raising if the ZMWs go backward."""
+    last_zmw = None
+    for name, molecule in molecules:
+        zmw = zmw_number(name)
+        if last_zmw is not None and zmw < last_zmw:
+            raise ValueError(f"Molecule {name} is out of order, sort by ZMW.")
+        last_zmw = zmw
+        yield name, molecule
+
+
+def merge_molecules(molecules, bam):
+    """Pair every bam record with its (tpl, ipdRatio) arrays from stream_csv
+    or stream_cache. Both the molecules and the bam must be sorted by ZMW,
+    so this is a merge join that only ever holds the molecules of one ZMW in
+    memory, which are matched by name in any order.
+    Raises ValueError if either goes out of order."""
+    molecules = zmw_ordered(molecules)
+    name, molecule = next(molecules, (None, None))
+    last_zmw = None
+    group = {}
+    for rec in tqdm.tqdm(bam.fetch(until_eof=True)):
+        zmw = zmw_number(rec.query_name)
+        if last_zmw is not None and zmw < last_zmw:
+            raise ValueError(f"Record {rec.query_name} is out of order, sort by ZMW.")
+        if zmw != last_zmw:
+            group = {}
+            # skip molecules in the csv on ZMWs that are not in the bam
+            while name is not None and zmw_number(name) < zmw:
+                name, molecule = next(molecules, (None, None))
+            # hold every molecule of the ZMW, e.g. both strands of by-strand ccs
+            while name is not None and zmw_number(name) == zmw:
+                group[name] = molecule
+                name, molecule = next(molecules, (None, None))
+        last_zmw = zmw
+        yield rec, group.pop(rec.query_name, None)
+
+
+def batched(molecules, batch_size):
+    batch = []
+    for molecule in molecules:
+        batch.append(molecule)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if len(batch) > 0:
+        yield batch
+
+
+def predict_m6a(
+    molecules,
     min_prediction_value=0.99999999,
     min_number_of_calls=25,
     pre_trained_model=None,
 ):
-    for rec in tqdm.tqdm(bam.fetch(until_eof=True), total=csv.index.unique().shape[0]):
-        if not rec.query_name in csv.index:
+    """Call m6A for a batch of (tpl, ipdRatio) pairs or None for missing
+    molecules. Without a pre-trained model a GMM is fit to every molecule
+    in the batch at once.
+    returns: list of zero based m6A positions on the read, None if skipped"""
+    # if there are not enough m6a calls, skip
+    keep = [
+        idx
+        for idx, molecule in enumerate(molecules)
+        if molecule is not None and molecule[0].shape[0] >= min_number_of_calls
+    ]
+    if len(keep) == 0:
+        return [None] * len(molecules)
+
+    # convert to zero based coordinates on the read
+    tpls = [molecules[idx][0].astype(np.int64) - 1 for idx in keep]
+    # ipd ratios for the above positions
+    ipdRatios = np.concatenate(
+        [np.zeros(0)] + [molecules[idx][1].astype(np.float64) for idx in keep]
+    )
+    offsets = np.zeros(len(keep) + 1, dtype=np.int64)
+    np.cumsum([tpl.shape[0] for tpl in tpls], out=offsets[1:])
+
+    # either do per molecule training or use a pre-trained model
+    if pre_trained_model is None:
+        model = SegmentedGMM(means_init=MEANS_INIT).fit(ipdRatios, offsets)
+        predictions = model.predict_upper_proba(ipdRatios, offsets)
+    else:
+        logging.debug("Using pre-trained model")
+        predictions = model_upper_proba(pre_trained_model, ipdRatios)
+
+    calls = [None] * len(molecules)
+    for idx, tpl, st, en in zip(keep, tpls, offsets[:-1], offsets[1:]):
+        # coordinates of m6a calls predicted by the gmm
+        calls[idx] = tpl[predictions[st:en] >= min_prediction_value]
+    return calls
+
+
+def add_m6a_tags(rec, mol_m6a):
+    sequence = sequence_array(rec)
+    # check the mod count is correct
+    bases = sequence[mol_m6a]
+    mod_count = ((bases == ord("A")) | (bases == ord("T"))).sum()
+    assert mol_m6a.shape[0] == mod_count, f"{mol_m6a.shape[0]} != {mod_count}"
+
+    # add modifications to bam
+    mods, probabilities = encode_mods(sequence, mol_m6a)
+    logging.debug(f"{rec.query_name} has {mod_count:,} m6A calls")
+    add_mods(rec, mods, probabilities)
+
+
+def write_m6a_batch(batch, calls, out, profile=NO_PROFILE):
+    profile.count_records(rec for rec, _molecule in batch)
+    for (rec, molecule), mol_m6a in zip(batch, calls):
+        if molecule is None:
             logging.debug(f"Missing {rec.query_name}")
+        if mol_m6a is not None:
+            with profile.stage("tags"):
+                add_m6a_tags(rec, mol_m6a)
+        with profile.stage("write"):
             out.write(rec)
-            continue
-        molecule_df = csv.loc[rec.query_name]
 
-        # if there are not enough m6a calls, skip
-        if molecule_df.shape[0] < min_number_of_calls:
-            out.write(rec)
-            continue
 
-        # convert to zero based coordinates on the read
-        tpl = molecule_df.tpl.to_numpy() - 1
-        # ipd ratios for the above positions
-        ipdRatios = molecule_df.ipdRatio.to_numpy().reshape(-1, 1)
+def apply_gmm(
+    molecules,
+    out,
+    min_prediction_value=0.99999999,
+    min_number_of_calls=25,
+    pre_trained_model=None,
+    batch_size=1000,
+    profile=NO_PROFILE,
+):
+    for batch in profile.iterate(batched(molecules, batch_size), "read"):
+        with profile.stage("gmm"):
+            calls = predict_m6a(
+                [molecule for _rec, molecule in batch],
+                min_prediction_value=min_prediction_value,
+                min_number_of_calls=min_number_of_calls,
+                pre_trained_model=pre_trained_model,
+            )
+        write_m6a_batch(batch, calls, out, profile=profile)
 
-        # either do per molecule training or use a pre-trained model
-        if pre_trained_model is None:
-            model = train_gmm(ipdRatios)
-        else:
-            logging.debug("Using pre-trained model")
-            model = pre_trained_model
 
-        # coordinates of m6a calls predicted by the gmm
-        mol_m6a = apply_model(model, tpl, ipdRatios, min_prediction_value)
+WORKER = {}
 
-        # check the mod count is correct
-        sequence = np.frombuffer(bytes(rec.query_sequence, "utf-8"), dtype="S1")
-        mod_count = ((sequence[mol_m6a] == b"A") | (sequence[mol_m6a] == b"T")).sum()
-        assert mol_m6a.shape[0] == mod_count, f"{mol_m6a.shape[0]} != {mod_count}"
-        if mod_count < 1:
-            out.write(rec)
-            continue
 
-        # add modifications to bam
-        A_mods, A_mod_count = coordinateConversion_MMTag(sequence, "A", mol_m6a)
-        T_mods, T_mod_count = coordinateConversion_MMTag(sequence, "T", mol_m6a)
-        logging.debug(
-            f"{rec.query_name} has {A_mod_count:,} A mods and {T_mod_count:,} T mods"
-        )
-        mods = ""
-        if A_mod_count > 0:
-            mods += "A+a," + A_mods + ";"
-        if T_mod_count > 0:
-            mods += "T-a," + T_mods + ";"
-        new_probabilities = [255] * mod_count
-
-        assert (
-            A_mod_count + T_mod_count == mod_count
-        ), f"{A_mod_count + T_mod_count} != {mod_count}"
-
-        assert (
-            len(new_probabilities) == mod_count
-        ), f"{len(new_probabilities)} != {mod_count}"
-
-        # check if tag exists
-        if rec.has_tag("MM"):
-            original_mods = rec.get_tag("MM")
-            new_mods = str(original_mods) + mods
-
-            original_probs = list(rec.get_tag("ML"))
-            new_probs = (
-                np.array(original_probs + new_probabilities).astype(int).tolist()
+def init_worker(min_prediction_value, min_number_of_calls, pre_trained_model):
+    WORKER["args"] = (min_prediction_value, min_number_of_calls, pre_trained_model)
+
+
+def predict_m6a_worker(molecules):
+    return predict_m6a(molecules, *WORKER["args"])
+
+
+def write_pending(pending, out, profile=NO_PROFILE):
+    batch, job = pending.popleft()
+    with profile.stage("gmm"):
+        calls = job.get()
+    write_m6a_batch(batch, calls, out, profile=profile)
+
+
+def apply_gmm_parallel(
+    molecules,
+    out,
+    threads,
+    min_prediction_value=0.99999999,
+    min_number_of_calls=25,
+    pre_trained_model=None,
+    batch_size=1000,
+    profile=NO_PROFILE,
+):
+    """Pair records with molecules and write them out in this process while
+    a pool of worker processes fits and applies the GMMs, keeping the input
+    order. At most two batches per worker are in flight at once. The gmm
+    stage of the profile is the time spent waiting on the workers."""
+    # compile the numba kernels once here so the forked workers inherit them
+    if pre_trained_model is None:
+        with profile.stage("compile"):
+            predict_m6a([(np.arange(2), np.arange(2.0))], min_number_of_calls=0)
+    init_args = (min_prediction_value, min_number_of_calls, pre_trained_model)
+    pending = deque()
+    with mp.Pool(threads, initializer=init_worker, initargs=init_args) as pool:
+        for batch in profile.iterate(batched(molecules, batch_size), "read"):
+            job = pool.apply_async(
+                predict_m6a_worker, ([molecule for _rec, molecule in batch],)
             )
+            pending.append((batch, job))
+            if len(pending) >= 2 * threads:
+                write_pending(pending, out, profile)
+        while len(pending) > 0:
+            write_pending(pending, out, profile)
 
-            new_tags = [("MM", new_mods, "Z"), ("ML", new_probs, "C")]
-            for tag_set in rec.get_tags():
-                if tag_set[0] != "MM" and tag_set[0] != "ML":
-                    new_tags.append(tag_set)
-            rec.set_tags(new_tags)
-        else:
-            rec.tags += [("MM:Z:", mods)]
-            rec.tags += [("ML:C:", new_probabilities)]
-        out.write(rec)
+
+CSV_COLUMNS = [0, 1, 2, 3, 8, 9]
+CSV_DTYPES = {
+    "refName": str,
+    "tpl": int,
+    "strand": bool,
+    "base": str,
+    "ipdRatio": float,
+    "coverage": int,
+}
 
 
 def read_csv(file):
-    csv = pd.read_csv(
-        file,
-        usecols=[0, 1, 2, 3, 8, 9],
-        dtype={
-            "refName": str,
-            "tpl": int,
-            "strand": bool,
-            "base": str,
-            "ipdRatio": float,
-            "coverage": int,
-        },
-    )
+    csv = pd.read_csv(file, usecols=CSV_COLUMNS, dtype=CSV_DTYPES)
     csv = csv[csv.base == "A"]
     csv.set_index("refName", inplace=True)
     logging.debug("Done reading csv")
     return csv
 
 
+def stream_csv(file, chunksize=10_000):
+    """Read the csv in chunks and yield (refName, (tpl, ipdRatio)) for one
+    molecule at a time. Rows of a molecule must be contiguous in the csv,
+    and the pieces of a molecule split across chunks are held back until it
+    is complete, so peak memory is about the largest molecule plus a chunk."""
+    pieces = []
+    for chunk in pd.read_csv(
+        file, usecols=CSV_COLUMNS, dtype=CSV_DTYPES, chunksize=chunksize
+    ):
+        chunk = chunk[chunk.base == "A"]
+        if chunk.shape[0] == 0:
+            continue
+        names = chunk.refName.to_numpy()
+        if len(pieces) > 0:
+            # the rows that finish the molecule held back from the last chunk
+            is_held = names == pieces[0].refName.iloc[0]
+            pieces.append(chunk[is_held])
+            if is_held.all():
+                continue
+            yield pieces[0].refName.iloc[0], molecule_arrays(pd.concat(pieces))
+            chunk, names = chunk[~is_held], names[~is_held]
+        is_last = names == names[-1]
+        pieces = [chunk[is_last]]
+        for name, molecule_df in chunk[~is_last].groupby("refName", sort=False):
+            yield name, molecule_arrays(molecule_df)
+    if len(pieces) > 0:
+        yield pieces[0].refName.iloc[0], molecule_arrays(pd.concat(pieces))
+    logging.debug("Done streaming csv")
+
+
+def stream_cache(cache):
+    """Yield (refName, (tpl, ipdRatio)) for each molecule in an ipd_cache.py npz."""
+    for name, tpl, ipdRatio, _coverage in cache_molecules(cache):
+        yield name, (tpl, ipdRatio)
+
+
 def parse():
     """Console script for fibertools."""
     parser = argparse.ArgumentParser(
         description="", formatter_class=argparse.ArgumentDefaultsHelpFormatter
     )
-    parser.add_argument("csv", help="csv file with tpl, ipdRatio, and coverage")
+    parser.add_argument(
+        "csv",
+        help="csv file with tpl, ipdRatio, and coverage, or a npz made from it by ipd_cache.py",
+    )
     parser.add_argument("bam", help="aligned bam file from actc")
     parser.add_argument(
         "-p",
@@ -200,7 +346,32 @@ def parse():
         help="train a GMM instead of writing a bam",
         action="store_true",
     )
+    parser.add_argument(
+        "-s",
+        "--stream",
+        help="Stream the csv in chunks alongside the bam instead of loading it all into memory. The csv and bam must both be in ZMW order. Always used for npz input.",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--chunksize",
+        help="Number of csv lines to read at a time with --stream. Peak memory "
+        "is about the largest molecule plus this many lines.",
+        type=int,
+        default=10_000,
+    )
+    parser.add_argument(
+        "-b",
+        "--batch-size",
+        help="Number of molecules to fit GMMs to at once.",
+        type=int,
+        default=1000,
+    )
     parser.add_argument("-o", "--out", help="Output bam file.", default=sys.stdout)
+    parser.add_argument(
+        "--profile",
+        help="Write time per stage, throughput, and peak memory to this json file.",
+        default=None,
+    )
     parser.add_argument("-t", "--threads", help="n threads to use", type=int, default=1)
     parser.add_argument(
         "-v", "--verbose", help="increase logging verbosity", action="store_true"
@@ -212,8 +383,8 @@ def parse():
     return args
 
 
-def train_model_on_csv(csv, args):
-    ipdRatios = csv.ipdRatio.to_numpy().reshape(-1, 1)
+def train_model_on_ipds(ipdRatios, args):
+    ipdRatios = np.asarray(ipdRatios, dtype=np.float64).reshape(-1, 1)
     logging.debug(f"Starting training on {ipdRatios.shape[0]:,} m6a calls")
     model = train_gmm(ipdRatios)
     write_model(model, args.out)
@@ -221,7 +392,6 @@ def train_model_on_csv(csv, args):
 
 def main():
     args = parse()
-    csv = read_csv(args.csv)
 
     if args.model is not None:
         logging.debug(f"Loading pre-trained model from {args.model}")
@@ -229,19 +399,36 @@ def main():
     else:
         model = None
 
-    if args.train:
-        train_model_on_csv(csv, args)
+    is_cache = args.csv.endswith(".npz")
+    if args.train and is_cache:
+        train_model_on_ipds(load_ipd_cache(args.csv)["ipdRatio"], args)
+    elif args.train:
+        train_model_on_ipds(read_csv(args.csv).ipdRatio.to_numpy(), args)
     else:
-        bam = pysam.AlignmentFile(args.bam, threads=args.threads, check_sq=False)
+        profile = Profile(args.profile)
+        htslib_threads, processes = split_threads(args.threads)
+        bam = pysam.AlignmentFile(args.bam, threads=htslib_threads, check_sq=False)
         out = pysam.AlignmentFile(args.out, "wb", template=bam)
-        apply_gmm(
-            csv,
-            bam,
-            out,
+        if is_cache:
+            molecules = merge_molecules(stream_cache(load_ipd_cache(args.csv)), bam)
+        elif args.stream:
+            molecules = merge_molecules(stream_csv(args.csv, args.chunksize), bam)
+        else:
+            molecules = lookup_molecules(read_csv(args.csv), bam)
+        kwargs = dict(
             min_prediction_value=args.min_prediction_value,
             min_number_of_calls=args.min_number_of_calls,
             pre_trained_model=model,
+            batch_size=args.batch_size,
+            profile=profile,
         )
+        if processes > 1:
+            apply_gmm_parallel(molecules, out, processes, **kwargs)
+        else:
+            apply_gmm(molecules, out, **kwargs)
+        with profile.stage("write"):
+            out.close()
+        profile.write()
     return 0
 
 